@@ -0,0 +1,43 @@
+"""
+Compare the time-domain (sosfilt) and frequency-domain (fft_filter) engines
+of block_filters.block_bandpass for zero-phase filtering of blocks of
+increasing length. Used to pick block_filters.FFT_MIN_NPTS.
+
+    python misc_testing/benchmark_fft_filter.py
+"""
+import time
+import numpy as np
+
+#-- To import a function on a relative path:
+import sys
+sys.path.append("./")
+from pydas_readers.util import block_filters
+
+FS = 1000.
+NCHAN = 256
+FREQMIN, FREQMAX = 1.0, 20.0
+NREPEAT = 3
+
+def timeit(func):
+    best = np.inf
+    for i in range(NREPEAT):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    print("{0:>10s} {1:>10s} {2:>10s} {3:>10s} {4:>10s}".format("npts", "sos [s]", "fft [s]", "speedup", "max diff"))
+    for npts in [2**12, 2**14, 2**15, 2**16, 2**18]:
+        data = rng.standard_normal((npts, NCHAN)).astype('float32')
+        t_sos = timeit(lambda: block_filters.block_bandpass(data, FREQMIN, FREQMAX, FS, zerophase=True, engine="sos"))
+        t_fft = timeit(lambda: block_filters.block_bandpass(data, FREQMIN, FREQMAX, FS, zerophase=True, engine="fft"))
+
+        #-- Away from the edges the two engines should agree
+        a = block_filters.block_bandpass(data, FREQMIN, FREQMAX, FS, zerophase=True, engine="sos")
+        b = block_filters.block_bandpass(data, FREQMIN, FREQMAX, FS, zerophase=True, engine="fft")
+        edge = npts//8
+        diff = np.max(np.abs(a[edge:-edge] - b[edge:-edge])) / np.max(np.abs(a))
+
+        print("{0:>10d} {1:>10.3f} {2:>10.3f} {3:>10.2f} {4:>10.1e}".format(npts, t_sos, t_fft, t_sos/t_fft, diff))
@@ -0,0 +1,60 @@
+"""
+Import time of the pydas_readers modules, each in a fresh interpreter
+(as a spawned multiprocessing worker or a short CLI job would pay it),
+compared to the bare numpy + h5py baseline.
+
+    python misc_testing/benchmark_import.py
+
+For a breakdown of what a module pulls in:
+    python -X importtime -c "import pydas_readers.util.block_filters" 2>&1 | sort -t'|' -k2 -n | tail
+"""
+import subprocess
+import sys
+
+MODULES = [
+    "numpy, h5py",
+    "pydas_readers.mapping.channel_mapping",
+    "pydas_readers.mapping.epoch_tables",
+    "pydas_readers.mapping.spatial_index",
+    "pydas_readers.readers.das_array",
+    "pydas_readers.readers.das_overview",
+    "pydas_readers.readers.das_timeseries",
+    "pydas_readers.readers.das_zarr",
+    "pydas_readers.readers.header_index",
+    "pydas_readers.readers.live_ingest",
+    "pydas_readers.readers.load_das_h5",
+    "pydas_readers.readers.qc_stats",
+    "pydas_readers.readers.write_das_h5",
+    "pydas_readers.util.block_cleaning",
+    "pydas_readers.util.block_detect",
+    "pydas_readers.util.block_filters",
+    "pydas_readers.util.block_fk",
+    "pydas_readers.util.block_resample",
+    "pydas_readers.util.block_spectra",
+    "pydas_readers.util.block_stream",
+    "pydas_readers.util.block_xcorr",
+    "pydas_readers.util.fft_backend",
+    "pydas_readers.util.parallel",
+    "pydas_readers.util.shared_blocks",
+]
+
+#-- Heavy packages that none of the imports above should load
+HEAVY = ["scipy.signal", "scipy.fft", "scipy.spatial", "scipy.ndimage", "pandas", "matplotlib"]
+
+NREPEAT = 5
+
+def import_time(module):
+    code = ("import time, sys; t = time.perf_counter(); import {0}; dt = time.perf_counter() - t; "
+            "print(dt, ','.join(m for m in {1} if m in sys.modules))".format(module, HEAVY))
+    best, heavy = float('inf'), ''
+    for i in range(NREPEAT):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd="./").stdout.split()
+        best = min(best, float(out[0]))
+        heavy = out[1] if len(out) > 1 else ''
+    return best, heavy
+
+if __name__ == "__main__":
+    print("{0:<42s} {1:>10s}   {2}".format("import", "time [s]", "heavy modules loaded"))
+    for module in MODULES:
+        dt, heavy = import_time(module)
+        print("{0:<42s} {1:>10.3f}   {2}".format(module, dt, heavy or "-"))
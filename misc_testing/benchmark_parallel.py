@@ -0,0 +1,36 @@
+"""
+Scaling of block_filters.block_bandpass with the workers= argument
+(channel chunks on a thread pool, see pydas_readers/util/parallel.py).
+
+    python misc_testing/benchmark_parallel.py [nchan]
+"""
+import os
+import time
+import numpy as np
+
+#-- To import a function on a relative path:
+import sys
+sys.path.append("./")
+from pydas_readers.util import block_filters
+
+FS = 1000.
+NPTS = 2**13
+FREQMIN, FREQMAX = 1.0, 20.0
+
+if __name__ == "__main__":
+    nchan = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    data = np.random.default_rng(0).standard_normal((NPTS, nchan))
+    ref = None
+
+    print("{0} channels x {1} samples, {2} cores".format(nchan, NPTS, os.cpu_count()))
+    print("{0:>8s} {1:>10s} {2:>10s}".format("workers", "time [s]", "speedup"))
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        t = time.perf_counter()
+        out = block_filters.block_bandpass(data, FREQMIN, FREQMAX, FS, zerophase=True, workers=workers)
+        dt = time.perf_counter() - t
+        if(ref is None):
+            ref, t_ref = out, dt
+        assert np.array_equal(out, ref)
+        print("{0:>8d} {1:>10.2f} {2:>10.2f}".format(workers, dt, t_ref/dt))
+        workers *= 2
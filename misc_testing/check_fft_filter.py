@@ -0,0 +1,42 @@
+"""
+Check the frequency-domain filters (block_filters.fft_filter, and the "fft" method of
+block_filter_bank) against time-domain sosfilt, including filters whose impulse
+response is longer than the block (low corner frequencies, short blocks), where
+too little zero-padding wraps the tail of the response around onto the start.
+
+    python misc_testing/check_fft_filter.py
+"""
+import numpy as np
+from scipy.signal import sosfilt
+
+#-- To import a function on a relative path:
+import sys
+sys.path.append("./")
+from pydas_readers.util import block_filters
+
+FS = 1000.
+TOL = 1e-6
+
+#-- (freqmin, freqmax, npts): the first three have impulse responses longer than the block
+CASES = [(0.05, 5., 8000), (0.5, 5., 5000), (0.1, 5., 20000), (1., 20., 50000)]
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    failed = 0
+    print("{0:>8s} {1:>8s} {2:>8s} {3:>10s} {4:>12s} {5:>12s}".format("fmin", "fmax", "npts", "halfwidth", "fft_filter", "filter_bank"))
+    for fmin, fmax, npts in CASES:
+        data = rng.standard_normal((npts, 3))
+        sos = block_filters.bandpass_sos(fmin, fmax, FS)
+        ref = sosfilt(sos, data, axis=0)
+        scale = np.max(np.abs(ref))
+
+        #-- Causal: fft_filter should reproduce sosfilt (zero before the block) to rounding
+        diff1 = np.max(np.abs(block_filters.fft_filter(data, sos) - ref)) / scale
+        bank = block_filters.block_filter_bank(data, [(fmin, fmax)], FS, method="fft")[0]
+        diff2 = np.max(np.abs(bank - ref)) / scale
+
+        halfwidth = block_filters._impulse_halfwidth(sos)
+        print("{0:>8.2f} {1:>8.2f} {2:>8d} {3:>10d} {4:>12.1e} {5:>12.1e}".format(fmin, fmax, npts, halfwidth, diff1, diff2))
+        failed += (diff1 > TOL) + (diff2 > TOL * 1e2)   # the bank returns float32
+    print("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
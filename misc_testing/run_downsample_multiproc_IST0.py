@@ -38,7 +38,8 @@ DRYRUN = False
 #--   just omit the "mapchan = ..." argument of load_das_custom()
 channel_mapping.update_filename("/media/Neda/Users/danielb/Istanbul/ETH_DAS_readers/pydas_readers/mapping/Channel_mapping_information_catalouge_v4.1.csv")
 nth_channel=2
-MAPPING = channel_mapping.get_mapping(data_type="mapped", d_start=0, d_end=8000, nth_channel=nth_channel) 
+CHAN_SPACING = 8
+MAPPING = channel_mapping.get_mapping(data_type="mapped", chan_spacing=CHAN_SPACING, d_start=0, d_end=8000, nth_channel=nth_channel) 
 print("number of channels: {0}".format(len(MAPPING['dd'])))
 
 def downsample_file(filename):
@@ -66,7 +67,8 @@ def downsample_file(filename):
                                                                  input_dir=INPUT_DIR,
                                                                  convert=False,
                                                                  verbose=VERBOSE,
-                                                                 mapchan=MAPPING['i0'],
+                                                                 mapchan=MAPPING['i0_native'],
+                                                                 mapchan_dx=channel_mapping.MAPPED_SPACING,
                                                                  return_axis=True)
 
         headers, axis = channel_mapping.fix_things(headers, axis, MAPPING)
@@ -189,7 +191,8 @@ def downsample_file(filename):
 
 if __name__ == "__main__":
     epochs = sorted(glob.glob(INPUT_DIR+"*epoch*"))
-    # epoch 1 has a different settings, deal with it later.
+    # epoch 1 has different settings (dx); mapchan_dx=MAPPED_SPACING lets the reader
+    #  translate MAPPING['i0_native'] to the exact HDF5 columns for each epoch.
     for epoch_dir in epochs:
     #for epoch_dir in epochs[0:1]:
 
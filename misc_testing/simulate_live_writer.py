@@ -0,0 +1,63 @@
+"""
+Write synthetic DAS files into a directory as an interrogator would, one file
+every file_seconds (divided by --speed), to test live_ingest.follow().
+A small event is added every few files so a detector has something to trigger on.
+
+    python misc_testing/simulate_live_writer.py /tmp/live/ --nfiles 10 --speed 10
+and in another terminal:
+    python -c "from pydas_readers.readers import live_ingest
+for d, h, a in live_ingest.follow('/tmp/live/', idle_timeout=30): print(h['t0'], d.shape)"
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from pydas_readers.readers import write_das_h5
+
+
+def make_block(t0, rng, fs, nchan, file_seconds, dx, fm, event=False):
+    npts = int(round(file_seconds*fs))
+    data = rng.normal(0., 100., (npts, nchan)).astype('float32')
+    if(event):
+        #-- A wavelet moving out from the middle of the cable at 2 km/s
+        tt = np.arange(npts) / fs
+        dd = np.abs(np.arange(nchan) - nchan//2) * dx * fm
+        arrival = file_seconds/2 + dd/2000.
+        data += (2000. * np.exp(-((tt[:, None] - arrival[None, :])*10.)**2)).astype('float32')
+    headers = dict(gauge=10., dx=dx, lx=nchan*dx, d0=0., d1=(nchan-1)*dx*fm, fm=fm, fs=fs, nchan=nchan, npts=npts,
+                   unit='(nm/m)/s * Hz/m', t0=t0, t1=t0+timedelta(seconds=(npts-1)/fs))
+    return data, headers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir")
+    parser.add_argument("--nfiles", type=int, default=10)
+    parser.add_argument("--file_seconds", type=float, default=30.)
+    parser.add_argument("--speed", type=float, default=1., help="write this many times faster than real time")
+    parser.add_argument("--fs", type=float, default=250.)
+    parser.add_argument("--nchan", type=int, default=500)
+    parser.add_argument("--dx", type=float, default=2.)
+    parser.add_argument("--event_every", type=int, default=3)
+    parser.add_argument("--gap_after", type=int, default=-1, help="leave out one file after this many (test gap handling)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    t0 = datetime.utcnow().replace(microsecond=0)
+    for i in range(args.nfiles):
+        t = t0 + timedelta(seconds=i*args.file_seconds)
+        if(i == args.gap_after):
+            continue
+        #-- A sub-directory per day, as the interrogator does
+        day_dir = os.path.join(args.output_dir, t.strftime('%Y%m%d'))
+        os.makedirs(day_dir, exist_ok=True)
+        filename = os.path.join(day_dir, 'live_UTC_{0}.h5'.format(t.strftime('%Y%m%d_%H%M%S.%f')[:-3]))
+
+        data, headers = make_block(t, rng, args.fs, args.nchan, args.file_seconds, args.dx, 1.02095,
+                                   event=(args.event_every > 0 and i % args.event_every == args.event_every-1))
+        write_das_h5.write_block(data, headers, filename)
+        print("wrote {0}".format(filename), flush=True)
+        time.sleep(args.file_seconds / args.speed)
@@ -1,5 +1,6 @@
+import os
+
 import numpy as np
-import pandas as pd
 
 MAPPED_FILENAME = "./pydas_readers/mapping/Channel_mapping_information_catalouge_v4.1.csv"
 """
@@ -7,6 +8,12 @@ Hardcoded the CSV file with lat/lon info. Not ideal practice!
 But one can update the path & name with:
   channel_mapping.update_filename("new_path")
 """
+#-- Channel spacing (m) the CSV was mapped at, i.e. what its 'i0' counts in
+MAPPED_SPACING = 2
+
+#-- ChannelMap objects already loaded in this process, keyed by CSV filename.
+#--  (with fork-based multiprocessing pools, workers inherit this for free)
+_LOADED_MAPS = dict()
 
 def update_filename(new_filename):
     global MAPPED_FILENAME
@@ -38,6 +45,10 @@ def get_mapping(data_type="raw", chan_spacing=8, d_start=0, d_end=0, nth_channel
                             the lat/lon mapping is imprecise, a given segment of cable might squish or stretch
                             channels a little bit. So one might have dx=1.9 for one segment and 2.1 for another.)
         mapping['flags'] -- any notes, if desired.
+        mapping['i0_native'] -- 'i0' as in the CSV, counting in MAPPED_SPACING channels (not divided down
+                            to chan_spacing). Use this with load_das_custom(..., mapchan_dx=MAPPED_SPACING)
+                            to read epochs of other channel spacings exactly: 'i0' is truncated to
+                            chan_spacing, so scaling it back up to a finer epoch can be off by a few channels.
     :
     :INPUTS:
     :As inputs, the field "data_type" might refer to different things:
@@ -53,6 +64,8 @@ def get_mapping(data_type="raw", chan_spacing=8, d_start=0, d_end=0, nth_channel
         nth_channel       -- returns only each n'th channel. This is different than chan_spacing, because we
                              need to know the 'ii' or 'i0' index. For nth_channel=4, 'ii' would be 0,4,8,etc.
                              so one can refer to the indices in an HDF5 block.
+                             (Picking channels aliases short wavelengths; load_das_custom(..., spatial_filter="boxcar")
+                             filters along the fibre before keeping each n'th channel.)
     :
     :USAGE:
     :The goal is to be able to specify one's distance, channel spacing, etc. to get: mapping['i0'], 
@@ -60,137 +73,10 @@ def get_mapping(data_type="raw", chan_spacing=8, d_start=0, d_end=0, nth_channel
     : thus loading the exact indices desired from an HDF5 block.
     """
 
-    mapping = dict()
-
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #-- LOAD CSV, PICK TYPE
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #-- Open a pandas dataframe
-    df = pd.read_csv(MAPPED_FILENAME,skiprows=10,)
-
-    #-- Case: You want all the data. No lat/lon will be given.
-    if(data_type == "raw"):
-        mapping['dd'] = df['Distance_IU (m)'].to_numpy()
-        mapping['ii'] = df['Chan Number'].to_numpy()
-
-    #-- Case: You want all channels that have a lat/lon assigned
-    #--  Note: using values from Distance_Calculated that are not "None", 
-    #--  which differs fom the "Keep" flag
-    elif(data_type == "mapped"):
-        dd = df['Distance_mapped (m)'] 
-        mapping['dd'] =  dd[dd != "None"].to_numpy(dtype=float)
-        mapping['ii'] =  df['Chan Number'][dd != "None"].to_numpy(dtype=int)
-        mapping['i0'] =  df['Chan Number Zeroed'][dd != "None"].to_numpy(dtype=int)
-        mapping['dx'] =  df['actual_dx'][dd != "None"].to_numpy(dtype=float)
-        mapping['lat'] = df['Latitude'][dd != "None"].to_numpy(dtype=float)
-        mapping['lon'] = df['Longitude'][dd != "None"].to_numpy(dtype=float)
-        mapping['flags'] = df['Flags/Hammers'][dd != "None"].to_list()
-
-    elif(data_type == "clean"):
-        iuse = []
-        for i in range(len(df['Keep (True/False)'])):
-            if(df['Good - not noise (True/False/None)'][i]=="TRUE" and df['Distance_mapped (m)'][i] != "None"):
-                iuse = np.append(iuse,i)
-
-        mapping['dd'] = df['Distance_mapped (m)'][iuse].to_numpy(dtype=float)
-        mapping['ii'] =  df['Chan Number'][iuse].to_numpy(dtype=int)
-        mapping['i0'] =  df['Chan Number Zeroed'][iuse].to_numpy(dtype=int)
-        mapping['dx'] =  df['actual_dx'][iuse].to_numpy(dtype=float)
-        mapping['lat'] = df['Latitude'][iuse].to_numpy(dtype=float)
-        mapping['lon'] = df['Longitude'][iuse].to_numpy(dtype=float)
-        mapping['flags'] = df['Flags/Hammers'][iuse].to_list()     
- 
-
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #-- MODIFICATIONS
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #-- Channel mapping was performed on a 2m resolution. 
-    #-- If something longer is used (e.g. 8m), scale it down
-    if(chan_spacing != 2):
-        factor = int(chan_spacing/2)
-        istart=0
-        #print(factor)
-        mapping['dd'] = mapping['dd'][istart::factor]
-        mapping['ii'] = mapping['ii'][istart::factor]/factor
-        mapping['ii'] = mapping['ii'].astype(int)
-        if(data_type != "raw"):
-            mapping['i0'] = mapping['i0'][istart::factor]/factor
-            mapping['i0'] = mapping['i0'].astype(int)
-            mapping['dx'] = mapping['dx'][::factor]*factor
-            mapping['lat'] = mapping['lat'][::factor]
-            mapping['lon'] = mapping['lon'][::factor]
-
-
-    #-- Further channel subdivision requested?
-    #--  Define "d_pull" as vector of indices to select
-    d_pull = []
-    if(nth_channel>1):
-        d_pull = np.arange(0, len(mapping['dd']))
-        d_pull = d_pull[::nth_channel]
-
-        #-- Apply it
-        mapping['dd'] = mapping['dd'][d_pull]
-        mapping['ii'] = mapping['ii'][d_pull]
-        if(data_type != "raw"):
-            mapping['i0'] = mapping['i0'][d_pull]
-            mapping['dx'] = mapping['dx'][d_pull]
-            mapping['lat'] = mapping['lat'][d_pull]
-            mapping['lon'] = mapping['lon'][d_pull]
-            #mapping['flags'] = mapping['flags'][d_pull]
-
-
-    #-- To keep track of distance modifications, just count off from zero.
-    mapping['index'] = np.arange(len(mapping['ii']))
-
-    #-- Subset requested?
-    if(d_end>0):
-        d_pull = []
-        id1 = np.searchsorted(mapping['dd'],[d_start,],side='right')[0]   
-        id2 = np.searchsorted(mapping['dd'],[d_end,],side='right')[0]-1
-        d_pull = np.arange(id1, id2+1)
-
-        #-- Apply it
-        mapping['dd'] = mapping['dd'][d_pull]
-        mapping['ii'] = mapping['ii'][d_pull]
-        mapping['index'] = mapping['index'][d_pull]
-        if(data_type != "raw"):
-            mapping['i0'] = mapping['i0'][d_pull]
-            mapping['dx'] = mapping['dx'][d_pull]
-            mapping['lat'] = mapping['lat'][d_pull]
-            mapping['lon'] = mapping['lon'][d_pull]
-            #mapping['flags'] = mapping['flags'][d_pull]
-
-
-        
-    ##-- Further channel subdivision requested?
-    ##--  Define "d_pull" as vector of indices to select
-    #d_pull = []
-    #if(nth_channel>1):
-    #    d_pull = np.arange(0, len(mapping['dd']))
-    #    d_pull = d_pull[::nth_channel]
-
-    ##-- Subset requested?
-    #if(d_end>0):
-    #    id1 = np.argmin(np.abs(mapping['dd']-d_start))
-    #    id2 = np.argmin(np.abs(mapping['dd']-d_end))
-    #    d_pull = np.arange(id1, id2+1)
-    #    if(nth_channel>1):
-    #        d_pull = d_pull[::nth_channel]
-    #    
-    ##-- Apply d_pull, if it exists
-    #if(len(d_pull)>0):
-    #    mapping['dd'] = mapping['dd'][d_pull]
-    #    mapping['ii'] = mapping['ii'][d_pull]
-    #    mapping['index'] = mapping['index'][d_pull]
-    #    if(data_type != "raw"):
-    #        mapping['i0'] = mapping['i0'][d_pull]
-    #        mapping['dx'] = mapping['dx'][d_pull]
-    #        mapping['lat'] = mapping['lat'][d_pull]
-    #        mapping['lon'] = mapping['lon'][d_pull]
-    #        #mapping['flags'] = mapping['flags'][d_pull]
-
-
-    return mapping
+    #-- The CSV is only parsed once per process (or read from its binary cache);
+    #--  see ChannelMap below.
+    return get_channel_map().get_mapping(data_type=data_type, chan_spacing=chan_spacing,
+                                         d_start=d_start, d_end=d_end, nth_channel=nth_channel)
 
 def fix_things(headers,axis,mapping):
     headers['d0'] = mapping['dd'][0]
@@ -202,3 +88,281 @@ def fix_things(headers,axis,mapping):
     return headers, axis
 
 
+
+
+def get_channel_map(filename=None, cache=True):
+    """
+    cmap = channel_mapping.get_channel_map()
+    :
+    :Return the ChannelMap for "filename" (default: MAPPED_FILENAME), loading it only once 
+    : per process. If the CSV is modified on disk, it is re-loaded on the next call.
+    :
+    :cache -- (optional) read/write a binary .npz copy of the parsed CSV next to it, 
+    :          so other processes can skip the CSV parsing entirely.
+    """
+    if(filename is None):
+        filename = MAPPED_FILENAME
+    key = os.path.abspath(filename)
+
+    cmap = _LOADED_MAPS.get(key)
+    if(cmap is None or cmap.csv_mtime != os.stat(filename).st_mtime_ns):
+        cmap = ChannelMap.load(filename, cache=cache)
+        _LOADED_MAPS[key] = cmap
+    return cmap
+
+def set_channel_map(cmap):
+    """
+    channel_mapping.set_channel_map(cmap)
+    :
+    :Install an already loaded ChannelMap in this process. Intended as a pool initializer,
+    : so workers never touch the CSV:
+    :   pool = multiprocessing.Pool(NPROC, initializer=channel_mapping.set_channel_map, initargs=(cmap,))
+    """
+    _LOADED_MAPS[os.path.abspath(cmap.filename)] = cmap
+
+
+class ChannelMap(object):
+    """
+    cmap = channel_mapping.ChannelMap.load(filename)
+    :
+    :The channel mapping CSV held as plain numpy arrays, one entry per CSV row:
+    :   cmap.ii        -- 'Chan Number', index in the HDF5 block of the interrogator
+    :   cmap.i0        -- 'Chan Number Zeroed', (-1 where not defined)
+    :   cmap.dd_iu     -- 'Distance_IU (m)', constant-dx distance from the interrogator
+    :   cmap.dd_mapped -- 'Distance_mapped (m)', (NaN where no mapping was possible)
+    :   cmap.dx        -- 'actual_dx'
+    :   cmap.lat, cmap.lon
+    :   cmap.keep      -- 'Keep (True/False)' as booleans
+    :   cmap.good      -- 'Good - not noise (True/False/None)' as booleans
+    :   cmap.flags     -- 'Flags/Hammers' as strings
+    :
+    :The object holds only numpy arrays (~0.5 MB), so it is cheap to pickle to pool workers.
+    :Lookups between distance, index and lat/lon use np.searchsorted, i.e. O(log n).
+    """
+
+    FIELDS = ('ii', 'i0', 'dd_iu', 'dd_mapped', 'dx', 'lat', 'lon', 'keep', 'good', 'flags')
+
+    #-- CSV layout: header lines to skip and the columns we need
+    SKIPROWS = 10
+    COLUMNS = {'ii': 'Chan Number',
+               'i0': 'Chan Number Zeroed',
+               'dd_iu': 'Distance_IU (m)',
+               'dd_mapped': 'Distance_mapped (m)',
+               'dx': 'actual_dx',
+               'lat': 'Latitude',
+               'lon': 'Longitude',
+               'keep': 'Keep (True/False)',
+               'good': 'Good - not noise (True/False/None)',
+               'flags': 'Flags/Hammers'}
+
+    def __init__(self, arrays, filename=None, csv_mtime=None):
+        for k in self.FIELDS:
+            setattr(self, k, arrays[k])
+        self.filename = filename
+        self.csv_mtime = csv_mtime
+        self._sorted = dict()
+
+    def __len__(self):
+        return len(self.ii)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- LOADING
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    @staticmethod
+    def cache_filename(filename):
+        return os.path.splitext(filename)[0] + ".npz"
+
+    @classmethod
+    def load(cls, filename=None, cache=True):
+        """
+        cmap = ChannelMap.load(filename, cache=True)
+        :
+        :Parse the CSV once into arrays. With cache=True a binary copy is kept in
+        : "<csv name>.npz", and re-used as long as its stored mtime matches the CSV.
+        """
+        if(filename is None):
+            filename = MAPPED_FILENAME
+        csv_mtime = os.stat(filename).st_mtime_ns
+        cache_file = cls.cache_filename(filename)
+
+        if(cache and os.path.exists(cache_file)):
+            try:
+                with np.load(cache_file, allow_pickle=False) as npz:
+                    if(int(npz['csv_mtime']) == csv_mtime):
+                        arrays = {k: npz[k] for k in cls.FIELDS}
+                        return cls(arrays, filename=filename, csv_mtime=csv_mtime)
+            except Exception:
+                #-- Unreadable / truncated cache (BadZipFile, EOFError, ...): treat as a miss
+                pass
+
+        arrays = cls.parse_csv(filename)
+        if(cache):
+            #-- Not being able to write the cache (read-only directory) is not a problem.
+            #-- Written to a temporary file and moved into place, so another process
+            #--  never sees a half-written cache.
+            tmp = cache_file + ".tmp{0}".format(os.getpid())
+            try:
+                with open(tmp, "wb") as f:
+                    np.savez(f, csv_mtime=np.int64(csv_mtime), **arrays)
+                os.replace(tmp, cache_file)
+            except OSError:
+                if(os.path.exists(tmp)):
+                    os.remove(tmp)
+        return cls(arrays, filename=filename, csv_mtime=csv_mtime)
+
+    @classmethod
+    def parse_csv(cls, filename):
+        """
+        Read the CSV with everything as strings, and convert columns ourselves so "None",
+        "TRUE", etc. are handled the same regardless of pandas version.
+        """
+        #-- pandas only for parsing the CSV (imported here, the binary cache doesn't need it)
+        import pandas as pd
+        df = pd.read_csv(filename, skiprows=cls.SKIPROWS, dtype=str, keep_default_na=False)
+
+        def to_float(col):
+            vals = df[cls.COLUMNS[col]].str.strip()
+            vals = vals.where(~vals.isin(["", "None", "nan", "NaN"]), "nan")
+            return vals.to_numpy(dtype=float)
+
+        def to_bool(col):
+            return df[cls.COLUMNS[col]].str.strip().str.upper().eq("TRUE").to_numpy()
+
+        arrays = dict()
+        arrays['ii'] = to_float('ii').astype(int)
+        i0 = to_float('i0')
+        arrays['i0'] = np.where(np.isfinite(i0), i0, -1).astype(int)
+        for col in ['dd_iu', 'dd_mapped', 'dx', 'lat', 'lon']:
+            arrays[col] = to_float(col)
+        arrays['keep'] = to_bool('keep')
+        arrays['good'] = to_bool('good')
+        arrays['flags'] = df[cls.COLUMNS['flags']].to_numpy(dtype=str)
+        return arrays
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- MASKS
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def mask(self, data_type="mapped"):
+        """
+        Boolean mask over CSV rows:
+        :   "raw"    -- all channels
+        :   "mapped" -- channels for which a mapping assignment was possible
+        :   "clean"  -- mapped channels that are also flagged as good (not noise)
+        """
+        if(data_type == "raw"):
+            return np.ones(len(self), dtype=bool)
+        elif(data_type == "mapped"):
+            return np.isfinite(self.dd_mapped)
+        elif(data_type == "clean"):
+            return np.isfinite(self.dd_mapped) & self.good
+        else:
+            raise ValueError("Unknown data_type: {0}".format(data_type))
+
+    def distance(self, data_type="mapped"):
+        if(data_type == "raw"):
+            return self.dd_iu
+        return self.dd_mapped
+
+    def _sorted_rows(self, key, data_type):
+        """ Row indices (and the values) of a column sorted ascending, built once per column """
+        if((key, data_type) not in self._sorted):
+            if(key == 'dd'):
+                vals = self.distance(data_type)
+                rows = np.flatnonzero(self.mask(data_type))
+            else:
+                vals = getattr(self, key)
+                rows = np.flatnonzero(vals >= 0)
+            rows = rows[np.argsort(vals[rows], kind='stable')]
+            self._sorted[(key, data_type)] = (rows, vals[rows])
+        return self._sorted[(key, data_type)]
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- LOOKUPS
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def row_from_distance(self, d, data_type="mapped"):
+        """
+        rows = cmap.row_from_distance(d)
+        :CSV row(s) of the channel(s) nearest to distance(s) d
+        """
+        rows, vals = self._sorted_rows('dd', data_type)
+        d = np.asarray(d, dtype=float)
+        j = np.clip(np.searchsorted(vals, d), 1, len(vals)-1)
+        j -= (d - vals[j-1]) < (vals[j] - d)
+        return rows[j]
+
+    def row_from_i0(self, i0):
+        """
+        rows = cmap.row_from_i0(i0)
+        :CSV row(s) of zeroed channel number(s) i0. Returns -1 where i0 is not in the CSV.
+        """
+        rows, vals = self._sorted_rows('i0', None)
+        i0 = np.asarray(i0)
+        j = np.clip(np.searchsorted(vals, i0), 0, len(vals)-1)
+        return np.where(vals[j] == i0, rows[j], -1)
+
+    def i0_from_distance(self, d, data_type="mapped"):
+        return self.i0[self.row_from_distance(d, data_type)]
+
+    def distance_from_i0(self, i0, data_type="mapped"):
+        rows = self.row_from_i0(i0)
+        dist = self.distance(data_type)[rows]
+        return np.where(rows >= 0, dist, np.nan)
+
+    def latlon_from_distance(self, d):
+        """
+        lat, lon = cmap.latlon_from_distance(d)
+        :Linearly interpolated between mapped channels
+        """
+        rows, vals = self._sorted_rows('dd', "mapped")
+        return np.interp(d, vals, self.lat[rows]), np.interp(d, vals, self.lon[rows])
+
+    def latlon_from_i0(self, i0):
+        rows = self.row_from_i0(i0)
+        ok = rows >= 0
+        return np.where(ok, self.lat[rows], np.nan), np.where(ok, self.lon[rows], np.nan)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- MAPPING DICT (as in get_mapping)
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def get_mapping(self, data_type="raw", chan_spacing=8, d_start=0, d_end=0, nth_channel=1):
+        """
+        mapping = cmap.get_mapping(data_type="mapped", chan_spacing=8, d_start=0, d_end=0, nth_channel=1)
+        :See channel_mapping.get_mapping() for the fields returned.
+        :All fields are fresh arrays, so callers may modify them freely.
+        """
+        rows = np.flatnonzero(self.mask(data_type))
+
+        #-- Channel mapping was performed on a 2m resolution (MAPPED_SPACING).
+        #-- If something longer is used (e.g. 8m), scale it down
+        factor = 1
+        if(chan_spacing != MAPPED_SPACING):
+            factor = int(chan_spacing/MAPPED_SPACING)
+            rows = rows[::factor]
+
+        #-- Further channel subdivision requested?
+        if(nth_channel>1):
+            rows = rows[::nth_channel]
+
+        #-- To keep track of distance modifications, just count off from zero.
+        index = np.arange(len(rows))
+
+        #-- Subset requested?
+        if(d_end>0):
+            dd = self.distance(data_type)[rows]
+            id1 = np.searchsorted(dd, d_start, side='right')
+            id2 = np.searchsorted(dd, d_end, side='right')
+            rows = rows[id1:id2]
+            index = index[id1:id2]
+
+        mapping = dict()
+        mapping['dd'] = self.distance(data_type)[rows]
+        mapping['ii'] = (self.ii[rows]/factor).astype(int)
+        if(data_type != "raw"):
+            mapping['i0'] = (self.i0[rows]/factor).astype(int)
+            mapping['i0_native'] = np.array(self.i0[rows], dtype=int)
+            mapping['dx'] = self.dx[rows]*factor
+            mapping['lat'] = self.lat[rows]
+            mapping['lon'] = self.lon[rows]
+            mapping['flags'] = self.flags[rows].tolist()
+        mapping['index'] = index
+        return mapping
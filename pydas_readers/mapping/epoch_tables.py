@@ -0,0 +1,117 @@
+"""
+Translation of mapped channel numbers ("mapchan", where d=0 is index=0) into
+absolute column indices of an HDF5 block.
+
+Different acquisition epochs can use different start distance (d0), channel
+spacing (dx) or fibre multiplier (fm), so the same mapped channel sits in a
+different HDF5 column depending on the file. Rather than recomputing this for
+every file, a table is built once per epoch geometry (as read from the
+headers) and re-used for every other file with the same settings.
+
+Example, one job across epochs recorded with 2m and 8m channel spacing. The CSV's own
+(2m) indices place each channel exactly in either epoch; mapping['i0'] has been divided
+down to 8m (and truncated), so scaling it back up for the 2m epoch would be off by up to 3 columns:
+    mapping = channel_mapping.get_mapping(data_type="mapped", chan_spacing=8)
+    data, headers, axis = load_das_h5.load_das_custom(t_start, t_end, mapchan=mapping['i0_native'],
+                                                      mapchan_dx=channel_mapping.MAPPED_SPACING, ...)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+#-- Tables already built in this process, least recently used dropped first
+MAX_TABLES = 32
+_TABLES = OrderedDict()
+
+
+def geometry_key(headers):
+    """
+    key = epoch_tables.geometry_key(headers)
+    :
+    :The settings that define which column a given distance falls in.
+    :Files with the same key share the same translation table.
+    """
+    return (round(headers['d0'], 3), round(headers['dx'], 6), round(headers['fm'], 6), headers['nchan'])
+
+
+class EpochTable(object):
+    """
+    table = EpochTable(mapchan, headers, mapchan_dx=None)
+    :
+    :table.columns -- absolute HDF5 column for each entry of mapchan
+    :table.dd      -- distance along the fibre of each of those columns
+    :table.sel     -- what to index the HDF5 dataset with: a slice if the columns are
+    :                  evenly spaced (much faster read in h5py), the columns array otherwise
+    :
+    :mapchan_dx -- nominal channel spacing that mapchan counts in. If None, mapchan is
+    :              assumed to count in the file's own spacing (headers['dx']).
+    :              For a coarser epoch, each entry goes to the nearest column; for a finer one,
+    :              mapchan is scaled up, which is only exact if it was not truncated (see the top of this file).
+    """
+
+    def __init__(self, mapchan, headers, mapchan_dx=None):
+        mapchan = np.asarray(mapchan, dtype=int)
+        dx = headers['dx']
+        fm = headers['fm']
+        d0 = headers['d0']
+        nchan = headers['nchan']
+        self.key = geometry_key(headers)
+
+        if(mapchan_dx is None or np.isclose(mapchan_dx, dx)):
+            ratio = 1
+        else:
+            ratio = mapchan_dx / dx
+
+        #-- Same correction as always used in load_das_custom, done once for the whole epoch
+        zero_correct = -int(np.round(d0 / (dx*fm)))
+        self.columns = np.round(mapchan * ratio).astype(int) + zero_correct
+
+        if(len(self.columns) > 0 and (self.columns.min() < 0 or self.columns.max() >= nchan)):
+            raise ValueError("mapchan outside of the channels recorded in epoch {0} "
+                             "(columns {1} to {2}, file has {3})".format(self.key, self.columns.min(), self.columns.max(), nchan))
+        if(np.any(np.diff(self.columns) <= 0)):
+            if(ratio < 1 and np.all(np.diff(mapchan) > 0)):
+                raise ValueError("mapchan ({0}m channels) puts several entries in the same {1}m column of epoch {2}; "
+                                 "use a mapping with chan_spacing >= {1}".format(mapchan_dx, dx, self.key))
+            raise ValueError("mapchan must be strictly increasing to read from HDF5")
+
+        self.dd = d0 + self.columns * dx * fm
+
+        #-- Evenly spaced columns can be read as a (strided) slice
+        steps = np.unique(np.diff(self.columns))
+        if(len(self.columns) > 1 and len(steps) == 1):
+            self.sel = slice(self.columns[0], self.columns[-1]+1, int(steps[0]))
+        elif(len(self.columns) == 1):
+            self.sel = slice(self.columns[0], self.columns[0]+1)
+        else:
+            self.sel = self.columns
+
+    def __len__(self):
+        return len(self.columns)
+
+
+def get_table(mapchan, headers, mapchan_dx=None):
+    """
+    table = epoch_tables.get_table(mapchan, headers, mapchan_dx=None)
+    :
+    :Return the translation table for this file's epoch, building it only the first time
+    : a given geometry (and mapchan) is seen in this process.
+    """
+    mapchan = np.asarray(mapchan, dtype=int)
+    key = (geometry_key(headers), mapchan_dx, mapchan.tobytes())
+    table = _TABLES.get(key)
+    if(table is None):
+        table = EpochTable(mapchan, headers, mapchan_dx=mapchan_dx)
+        _TABLES[key] = table
+        if(len(_TABLES) > MAX_TABLES):
+            _TABLES.popitem(last=False)
+    else:
+        _TABLES.move_to_end(key)
+    return table
+
+def clear_tables():
+    _TABLES.clear()
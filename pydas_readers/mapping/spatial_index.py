@@ -0,0 +1,174 @@
+"""
+Geographic queries on the channel mapping, e.g. "all channels within R km
+of an epicentre" or "all channels inside this polygon".
+
+Channel lat/lon are projected once onto a local flat plane (metres) and put
+into a KD-tree, so each query afterwards is only a tree lookup. Results are
+returned as 'i0' channel numbers, ready for:
+    load_das_h5.load_das_custom(..., mapchan = idx.within_radius(lat, lon, 5.0), ...)
+
+Example:
+    mapping = channel_mapping.get_mapping(data_type="clean", chan_spacing=8)
+    idx = spatial_index.ChannelIndex(mapping)
+    mapchan = idx.within_radius(40.97, 29.06, radius_km=2.0)
+
+NOTE: the readers take an empty mapchan (their default, []) to mean "all channels".
+So a query for one point or polygon that finds no channels raises a ValueError rather
+than returning an empty array (unless allow_empty=True). With arrays of points,
+check for empty results yourself before passing them on.
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import numpy as np
+
+from pydas_readers.mapping import channel_mapping
+
+EARTH_RADIUS = 6371000.0   # meters
+
+
+class ChannelIndex(object):
+    """
+    idx = spatial_index.ChannelIndex(mapping)
+    :
+    :mapping -- dict as returned by channel_mapping.get_mapping() (any data_type except "raw"),
+    :           needs at least 'lat', 'lon', 'i0' and 'dd'.
+    :
+    :The projection is an equirectangular one centered on the fibre. Over the few tens of km
+    : of a fibre this is accurate to well below the channel spacing.
+    """
+
+    def __init__(self, mapping):
+        lat = np.asarray(mapping['lat'], dtype=float)
+        lon = np.asarray(mapping['lon'], dtype=float)
+        ok = np.isfinite(lat) & np.isfinite(lon)
+
+        self.i0 = np.asarray(mapping['i0'])[ok]
+        self.dd = np.asarray(mapping['dd'])[ok]
+        self.lat = lat[ok]
+        self.lon = lon[ok]
+
+        self.lat0 = np.mean(self.lat)
+        self.lon0 = np.mean(self.lon)
+        self.xy = self.project(self.lat, self.lon)
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(self.xy)
+
+    @classmethod
+    def from_channel_map(cls, cmap=None, data_type="mapped", chan_spacing=8):
+        """
+        idx = ChannelIndex.from_channel_map(data_type="clean", chan_spacing=8)
+        :Build directly from a ChannelMap (default: the one for channel_mapping.MAPPED_FILENAME)
+        """
+        if(cmap is None):
+            cmap = channel_mapping.get_channel_map()
+        return cls(cmap.get_mapping(data_type=data_type, chan_spacing=chan_spacing))
+
+    def __len__(self):
+        return len(self.i0)
+
+    def project(self, lat, lon):
+        """ lat/lon in degrees --> [n, 2] array of x/y in meters, relative to the fibre center """
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        x = np.radians(lon - self.lon0) * np.cos(np.radians(self.lat0)) * EARTH_RADIUS
+        y = np.radians(lat - self.lat0) * EARTH_RADIUS
+        return np.column_stack((x, y))
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- QUERIES
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def within_radius(self, lat, lon, radius_km, return_distance=False, allow_empty=False):
+        """
+        mapchan = idx.within_radius(lat, lon, radius_km)
+        :
+        :All channels within radius_km of the point lat/lon. Returned i0 are sorted along the fibre.
+        :If lat/lon are arrays (many events), a list with one result per point is returned
+        : (entries can be empty).
+        :return_distance -- also return the distance in km of each channel from the point
+        :allow_empty -- for a single point, return an empty array instead of raising if nothing is found
+        """
+        xy = self.project(lat, lon)
+        found = self.tree.query_ball_point(xy, r=radius_km*1000.)
+
+        out = []
+        for p, rows in zip(xy, found):
+            rows = np.sort(np.asarray(rows, dtype=int))
+            if(return_distance):
+                dist = np.sqrt(np.sum((self.xy[rows] - p)**2, axis=1)) / 1000.
+                out.append((self.i0[rows], dist))
+            else:
+                out.append(self.i0[rows])
+
+        if(np.ndim(lat) == 0):
+            if(not allow_empty):
+                _check_found(out[0][0] if return_distance else out[0],
+                             "within {0} km of {1}, {2}".format(radius_km, lat, lon))
+            return out[0]
+        return out
+
+    def nearest(self, lat, lon, k=1):
+        """
+        mapchan, dist_km = idx.nearest(lat, lon, k=1)
+        :The k channels closest to lat/lon
+        """
+        dist, rows = self.tree.query(self.project(lat, lon), k=k)
+        if(np.ndim(lat) == 0):
+            dist, rows = dist[0], rows[0]
+        return self.i0[rows], dist / 1000.
+
+    def in_polygon(self, poly_lat, poly_lon, allow_empty=False):
+        """
+        mapchan = idx.in_polygon(poly_lat, poly_lon)
+        :
+        :All channels inside the polygon with vertices poly_lat/poly_lon (degrees).
+        :The tree is used to limit candidates to the circle around the polygon,
+        : then an even-odd (ray-casting) test is done on those only.
+        :allow_empty -- return an empty array instead of raising if no channel is inside
+        """
+        pxy = self.project(poly_lat, poly_lon)
+        center = np.mean(pxy, axis=0)
+        radius = np.max(np.sqrt(np.sum((pxy - center)**2, axis=1)))
+        rows = np.sort(np.asarray(self.tree.query_ball_point(center, r=radius), dtype=int))
+        if(len(rows) == 0):
+            if(not allow_empty):
+                _check_found(rows, "inside the polygon")
+            return self.i0[rows]
+
+        x = self.xy[rows, 0][:, None]
+        y = self.xy[rows, 1][:, None]
+        x1, y1 = pxy[:, 0][None], pxy[:, 1][None]
+        x2, y2 = np.roll(pxy[:, 0], -1)[None], np.roll(pxy[:, 1], -1)[None]
+
+        #-- For each edge: does a horizontal ray to the right of the point cross it?
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        crosses = ((y1 > y) != (y2 > y)) & (x < x_cross)
+        inside = np.count_nonzero(crosses, axis=1) % 2 == 1
+
+        if(not allow_empty):
+            _check_found(rows[inside], "inside the polygon")
+        return self.i0[rows[inside]]
+
+    def mapping_subset(self, mapping, mapchan):
+        """
+        sub = idx.mapping_subset(mapping, mapchan)
+        :Reduce a mapping dict to the channels in mapchan, e.g. to pass to channel_mapping.fix_things()
+        :Raises a ValueError if none of mapchan is in the mapping.
+        """
+        keep = np.isin(mapping['i0'], mapchan)
+        _check_found(np.flatnonzero(keep), "in the mapping for this mapchan")
+        sub = dict()
+        for k, v in mapping.items():
+            if(isinstance(v, list)):
+                sub[k] = [x for x, use in zip(v, keep) if use]
+            else:
+                sub[k] = np.asarray(v)[keep]
+        return sub
+
+
+def _check_found(found, where):
+    #-- An empty mapchan would make the readers return every channel, see the module notes
+    if(len(found) == 0):
+        raise ValueError("No channels found {0}".format(where))
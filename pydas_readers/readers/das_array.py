@@ -0,0 +1,465 @@
+"""
+Lazy access to the archive: a DASArray knows which files, samples and
+channels it covers (from the headers only), and reads nothing until
+.compute() (or np.asarray) is called. Selections are pushed down to the
+HDF5 reads, so only the needed hyperslabs are ever read.
+
+Example:
+    archive = das_array.DASArchive(t_start, t_end, input_dir="path/to/dir/")   # headers only
+    arr = archive.array()                                 # [ npts, nchan ], nothing read yet
+    sub = arr.sel(time=slice(t1, t2), distance=slice(0, 5000))[:, ::2]
+    print(sub)                                            # shape, times, distances, still nothing read
+    data = sub.compute()                                  # or np.asarray(sub)
+    data, headers, axis = sub.load(convert=True)          # as from load_das_h5.load_das_custom
+
+Times and distances are selected exactly as load_das_custom does (nearest sample,
+nearest channel), so arr.sel(time=slice(t_start, t_end), distance=slice(d_start, d_end))
+gives the same data as load_das_custom(t_start, t_end, d_start=d_start, d_end=d_end).
+
+As with load_das_custom, gaps between files are not handled: samples are counted
+continuously from the first file. An array can only span files with the same
+channel geometry (see mapping/epoch_tables.py).
+
+For out-of-core computation, arr.to_dask() gives a dask array with one task per
+chunk (chunks follow file boundaries and the HDF5 chunk layout). Headers come from
+the header index (header_index.py), so building it opens no files once the index exists:
+    x = archive.array().to_dask()
+    rms = np.sqrt((x.astype('float64')**2).mean(axis=0)).compute()
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+from datetime import timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.mapping import epoch_tables
+from pydas_readers.readers import header_index
+from pydas_readers.readers import load_das_h5
+
+DATASET = "Acquisition/Raw[0]/RawData"
+
+#-- Target size of one dask chunk
+DASK_CHUNK_BYTES = 2**26
+
+
+class DASArchive(object):
+    """
+    archive = das_array.DASArchive(t_start, t_end, input_dir="path/to/dir/")
+
+    The files of an archive that overlap t_start -- t_end, and their headers.
+    Files are found as in load_das_custom (load_das_h5.make_file_list).
+
+    archive.files   -- list of filenames, sorted by start time
+    archive.headers -- list of header dicts, one per file
+
+    :param cache: read headers through the header index of input_dir (header_index.py),
+                  so only new or changed files are opened
+    """
+
+    def __init__(self, t_start, t_end, input_dir='./', verbose=False, cache=True):
+        self.t_start = t_start
+        self.t_end = t_end
+        self.input_dir = input_dir
+        self.files = []
+        self.headers = []
+        self.layout = None
+
+        index = header_index.get_index(input_dir) if cache else None
+        consider_files = load_das_h5.make_file_list(t_start, t_end, input_dir, verbose=verbose)
+        for filename in (consider_files or []):
+            if(index is not None):
+                headers = index.headers(filename, verbose=verbose)
+            else:
+                headers = load_das_h5.load_headers_only(filename, verbose=verbose)
+            if(load_das_h5.file_in_window(headers, t_start, t_end)):
+                self.files.append(filename)
+                self.headers.append(headers)
+
+        order = np.argsort([h['t0'] for h in self.headers], kind='stable')
+        self.files = [self.files[i] for i in order]
+        self.headers = [self.headers[i] for i in order]
+
+        #-- dtype and HDF5 chunks of the data block (taken from the first file)
+        if(index is not None):
+            if(len(self.files) > 0):
+                self.layout = index.layout(self.files[0])
+            index.save(verbose=verbose)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __repr__(self):
+        if(len(self.files) == 0):
+            return "DASArchive(no files, {0})".format(self.input_dir)
+        return "DASArchive({0} files, {1} -- {2}, {3})".format(len(self.files), self.headers[0]['t0'],
+                                                              self.headers[-1]['t1'], self.input_dir)
+
+    def array(self):
+        """ DASArray over the requested time window and all channels (nothing is read) """
+        if(len(self.files) == 0):
+            raise ValueError("No files found between {0} and {1} in {2}".format(self.t_start, self.t_end, self.input_dir))
+        arr = DASArray([(f, h, range(h['npts'])) for f, h in zip(self.files, self.headers)], layout=self.layout)
+        return arr.sel(time=slice(self.t_start, self.t_end))
+
+    def sel(self, **kwargs):
+        """ Shortcut for archive.array().sel(...) """
+        return self.array().sel(**kwargs)
+
+
+class DASArray(object):
+    """
+    Lazy 2D array [ npts, nchan ] over one or more files. Usually made with DASArchive.array().
+
+    arr.shape, arr.dtype, arr.fs, arr.t0, arr.t1, arr.dd -- known without reading data
+    arr[i0:i1:step, c0:c1:step]   -- integer slicing (also index arrays for channels); always stays 2D
+    arr.sel(time=slice(t1, t2), distance=slice(d1, d2), mapchan=..., mapchan_dx=...)
+    arr.compute() / np.asarray(arr) / arr.load()  -- read the data
+
+    :param segments: list of (filename, headers, range of samples in that file)
+    :param columns: HDF5 columns (channels) to read, default all
+    :param layout: (optional) dict with 'dtype' and 'chunks' of the HDF5 data block,
+                   see header_index.HeaderIndex.layout()
+    """
+
+    def __init__(self, segments, columns=None, dd=None, layout=None):
+        self.segments = [(f, h, r) for f, h, r in segments if len(r) > 0]
+        if(len(self.segments) == 0):
+            raise ValueError("Selection contains no samples")
+
+        headers = self.segments[0][1]
+        key = epoch_tables.geometry_key(headers)
+        for filename, h, r in self.segments[1:]:
+            if(epoch_tables.geometry_key(h) != key):
+                raise ValueError("{0} has a different channel geometry ({1}) than {2} ({3}); "
+                                 "split the request at the change of epoch".format(filename, epoch_tables.geometry_key(h),
+                                                                                   self.segments[0][0], key))
+
+        if(columns is None):
+            columns = np.arange(headers['nchan'])
+        self.columns = np.asarray(columns, dtype=int)
+        if(dd is None):
+            dd = headers['d0'] + self.columns * headers['dx'] * headers['fm']
+        self.dd = np.asarray(dd)
+        self.layout = layout
+        self._dtype = None if layout is None else layout['dtype']
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- What's covered, from headers only
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    @property
+    def shape(self):
+        return (sum(len(r) for f, h, r in self.segments), len(self.columns))
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def dtype(self):
+        if(self._dtype is None):
+            with h5py.File(self.segments[0][0], "r") as f:
+                self._dtype = f[DATASET].dtype
+        return self._dtype
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    @property
+    def fs(self):
+        """ Sample rate, accounting for any step in time """
+        return self.segments[0][1]['fs'] / self.segments[0][2].step
+
+    @property
+    def t0(self):
+        filename, headers, r = self.segments[0]
+        return headers['t0'] + timedelta(seconds=r[0]/headers['fs'])
+
+    @property
+    def t1(self):
+        filename, headers, r = self.segments[-1]
+        return headers['t0'] + timedelta(seconds=r[-1]/headers['fs'])
+
+    @property
+    def tt(self):
+        """ Time in seconds since t0, as in load_das_custom's axis['tt'] """
+        return np.arange(self.shape[0]) / self.fs
+
+    @property
+    def files(self):
+        return [f for f, h, r in self.segments]
+
+    def __repr__(self):
+        return "DASArray(shape={0}, {1} -- {2}, fs={3}, d={4} -- {5}, {6} files)".format(
+            self.shape, self.t0, self.t1, self.fs, self.dd[0] if len(self.dd) else None,
+            self.dd[-1] if len(self.dd) else None, len(self.segments))
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Selections (no data read)
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def _new(self, segments=None, index=None):
+        if(segments is None):
+            segments = self.segments
+        if(index is None):
+            return DASArray(segments, self.columns, self.dd, self.layout)
+        return DASArray(segments, self.columns[index], self.dd[index], self.layout)
+
+    def __getitem__(self, key):
+        if(not isinstance(key, tuple)):
+            key = (key, slice(None))
+        if(len(key) != 2):
+            raise IndexError("DASArray is 2D [ npts, nchan ]")
+        tkey, ckey = key
+        segments = self._slice_time(_as_slice(tkey, self.shape[0]))
+        return self._new(segments, _as_index(ckey, self.shape[1]))
+
+    def _slice_time(self, tslice):
+        """ Apply a slice of the (concatenated) sample axis to the file segments """
+        wanted = range(self.shape[0])[tslice]
+        if(wanted.step < 1):
+            raise IndexError("Only positive steps are supported along time")
+        segments = []
+        offset = 0
+        for filename, headers, r in self.segments:
+            #-- Part of "wanted" that falls within this segment: [offset, offset+len(r))
+            ia = max(0, -(-(offset - wanted.start) // wanted.step))
+            ib = max(0, -(-(offset + len(r) - wanted.start) // wanted.step))
+            part = wanted[ia:ib]
+            if(len(part) > 0):
+                segments.append((filename, headers, r[part.start-offset : part[-1]-offset+1 : part.step]))
+            offset += len(r)
+        return segments
+
+    def sel(self, time=None, distance=None, mapchan=None, mapchan_dx=None):
+        """
+        sub = arr.sel(time=slice(t_start, t_end), distance=slice(d_start, d_end))
+
+        :param time: slice of datetimes (either end may be None), nearest samples are kept
+                     (as in load_das_custom)
+        :param distance: slice of distances along the fibre, nearest channels
+                     (as d_start/d_end in load_das_custom)
+        :param mapchan, mapchan_dx: mapped channel numbers, as in load_das_custom
+        :return: new DASArray
+        """
+        arr = self
+        if(time is not None):
+            arr = arr._new(arr._sel_time(time.start, time.stop))
+        if(distance is not None):
+            dd = arr.dd
+            id1 = 0 if distance.start is None else np.argmin(np.abs(dd - distance.start))
+            id2 = len(dd)-1 if distance.stop is None else np.argmin(np.abs(dd - distance.stop))
+            arr = arr._new(index=slice(id1, id2+1))
+        if(mapchan is not None):
+            table = epoch_tables.get_table(mapchan, arr.segments[0][1], mapchan_dx=mapchan_dx)
+            index = np.searchsorted(arr.columns, table.columns)
+            index = np.clip(index, 0, len(arr.columns)-1)
+            if(np.any(arr.columns[index] != table.columns)):
+                raise ValueError("mapchan asks for channels that are not in this array")
+            arr = DASArray(arr.segments, table.columns, table.dd, arr.layout)
+        return arr
+
+    def _sel_time(self, t_start, t_end):
+        segments = []
+        for filename, headers, r in self.segments:
+            ts = headers['t0'] if t_start is None else t_start
+            te = headers['t1'] if t_end is None else t_end
+            if(not load_das_h5.file_in_window(headers, ts, te)):
+                continue
+            a, b, tt = load_das_h5.time_indices(headers, ts, te)
+            #-- samples of r within [a, b]
+            ja = max(0, -(-(a - r.start) // r.step))
+            jb = max(0, (b - r.start) // r.step + 1)
+            segments.append((filename, headers, r[ja:jb]))
+        return segments
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Reading
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def compute(self, out=None, dtype=None, convert=False):
+        """
+        data = arr.compute()
+        :Read the selection into a numpy array [ npts, nchan ] (preallocated, no concatenation)
+        :param dtype: dtype of the array if out is not given (default: as stored, float64 when converting)
+        :param convert: scale to strain rate while reading (see load_das_h5.strain_rate_scale)
+        """
+        scales = [load_das_h5.strain_rate_scale(headers) if convert else None for filename, headers, r in self.segments]
+        if(out is None):
+            out = np.empty(self.shape, dtype=load_das_h5.output_dtype(self.dtype, scales[0] is not None, dtype))
+        elif(out.shape != self.shape):
+            raise ValueError("out must have shape {0}".format(self.shape))
+
+        i0 = 0
+        csel, corder = _column_selection(self.columns)
+        for (filename, headers, r), scale in zip(self.segments, scales):
+            if(corder is None):
+                with h5py.File(filename, "r") as f:
+                    load_das_h5.read_scaled(f[DATASET], slice(r.start, r[-1]+1, r.step), csel, out[i0:i0+len(r)], scale=scale)
+            else:
+                out[i0:i0+len(r)] = _read_block(filename, r, self.columns)
+                if(scale is not None):
+                    out[i0:i0+len(r)] *= scale
+            i0 += len(r)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.compute()
+        if(dtype is not None):
+            data = data.astype(dtype, copy=False)
+        return data
+
+    @property
+    def headers(self):
+        """ Headers describing the selection, as returned by load_das_custom """
+        headers = dict(self.segments[-1][1])
+        headers['t0'] = self.t0
+        headers['t1'] = self.t1
+        headers['npts'] = self.shape[0]
+        headers['nchan'] = self.shape[1]
+        headers['fs'] = self.fs
+        headers['d0'] = self.dd[0]
+        headers['d1'] = self.dd[-1]
+        steps = np.unique(np.diff(self.columns))
+        if(len(steps) == 1):
+            headers['dx'] = headers['dx'] * int(steps[0])
+        return headers
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Chunked (dask) export
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def chunk_plan(self, chunk_bytes=None):
+        """
+        time_chunks, channel_chunks = arr.chunk_plan()
+
+        How to cut the array into chunks of about chunk_bytes: never across a file boundary,
+        and on multiples of the HDF5 chunk shape where it is known (arr.layout).
+
+        :return: time_chunks    -- list of (segment number, range of file samples)
+                 channel_chunks -- list of (c0, c1), positions along the channel axis
+        """
+        if(chunk_bytes is None):
+            chunk_bytes = DASK_CHUNK_BYTES
+        npts, nchan = self.shape
+        itemsize = self.dtype.itemsize
+        rows, cols = (1, 1) if (self.layout is None or self.layout['chunks'] is None) else self.layout['chunks']
+
+        #-- Channels: whole HDF5 chunk columns, as many as fit with at least one HDF5 chunk of rows
+        max_cols = max(cols, int(chunk_bytes // (itemsize*max(rows, 1))) // cols * cols)
+        group = self.columns // max_cols
+        bounds = np.flatnonzero(np.diff(group) != 0) + 1
+        bounds = np.concatenate(([0], bounds, [nchan]))
+        channel_chunks = [(int(c0), int(c1)) for c0, c1 in zip(bounds[:-1], bounds[1:])]
+
+        #-- Time: within each file, blocks of whole HDF5 chunk rows
+        width = max(c1-c0 for c0, c1 in channel_chunks)
+        max_rows = max(rows, int(chunk_bytes // (itemsize*width)) // rows * rows)
+        time_chunks = []
+        for iseg, (filename, headers, r) in enumerate(self.segments):
+            #-- first sample of r in each new block of max_rows file samples
+            starts = np.arange(r.start // max_rows + 1, r[-1] // max_rows + 1) * max_rows
+            edges = -(-(starts - r.start) // r.step)
+            edges = np.unique(np.concatenate(([0], edges, [len(r)])))
+            time_chunks += [(iseg, r[a:b]) for a, b in zip(edges[:-1], edges[1:])]
+        return time_chunks, channel_chunks
+
+    def to_dask(self, chunk_bytes=None):
+        """
+        x = arr.to_dask()
+
+        The selection as a dask array. Each chunk is one HDF5 read (see chunk_plan()),
+        done only when computed. Requires dask.
+        """
+        try:
+            import dask.array as da
+        except ImportError:
+            raise ImportError("DASArray.to_dask() needs dask (pip install dask)")
+        from dask.base import tokenize
+
+        time_chunks, channel_chunks = self.chunk_plan(chunk_bytes)
+        name = "das-" + tokenize(self.files, [(iseg, r.start, r.stop, r.step) for iseg, r in time_chunks],
+                                 self.columns.tobytes())
+        dsk = dict()
+        for i, (iseg, r) in enumerate(time_chunks):
+            filename = self.segments[iseg][0]
+            for j, (c0, c1) in enumerate(channel_chunks):
+                dsk[(name, i, j)] = (_read_block, filename, r, self.columns[c0:c1])
+        chunks = (tuple(len(r) for iseg, r in time_chunks), tuple(c1-c0 for c0, c1 in channel_chunks))
+        return da.Array(dsk, name, chunks=chunks, dtype=self.dtype)
+
+    def load(self, convert=False, return_axis=True, verbose=False, dtype=None):
+        """
+        data, headers, axis = arr.load()
+        :Read the selection and return it like load_das_h5.load_das_custom
+        """
+        data = self.compute(dtype=dtype, convert=convert)
+        headers = self.headers
+        if(convert==True):
+            scale = load_das_h5.strain_rate_scale(headers, verbose=verbose)
+            if(scale is not None):
+                load_das_h5.mark_converted(headers, scale, verbose=verbose)
+        if(not return_axis):
+            return data, headers
+        axis = dict()
+        axis['dd'] = self.dd
+        axis['tt'] = self.tt
+        axis['date_times'] = [self.t0 + timedelta(seconds=t) for t in axis['tt']]
+        return data, headers, axis
+
+
+def _as_slice(key, n):
+    """ Integer or slice along time -> slice (an integer keeps the axis) """
+    if(isinstance(key, slice)):
+        return key
+    if(isinstance(key, (int, np.integer))):
+        i = int(key) + n if key < 0 else int(key)
+        if(i < 0 or i >= n):
+            raise IndexError("index {0} out of range for {1} samples".format(key, n))
+        return slice(i, i+1)
+    raise IndexError("Only integers and slices are supported along time")
+
+
+def _as_index(key, n):
+    """ Integer, slice or index array along channels -> something numpy can index with, keeping the axis """
+    if(isinstance(key, (int, np.integer))):
+        i = int(key) + n if key < 0 else int(key)
+        if(i < 0 or i >= n):
+            raise IndexError("index {0} out of range for {1} channels".format(key, n))
+        return slice(i, i+1)
+    if(isinstance(key, slice)):
+        return key
+    key = np.asarray(key)
+    if(key.dtype == bool):
+        return np.flatnonzero(key)
+    return key.astype(int)
+
+
+def _read_block(filename, r, columns):
+    """ Samples r (a range) of the given HDF5 columns of one file """
+    csel, corder = _column_selection(columns)
+    with h5py.File(filename, "r") as f:
+        block = f[DATASET][r.start:r[-1]+1:r.step, csel]
+    if(corder is not None):
+        block = block[:, corder]
+    return block
+
+
+def _column_selection(columns):
+    """
+    What to index the HDF5 dataset with for these columns: a slice when evenly spaced,
+    otherwise the sorted unique columns (h5py needs increasing indices) and the order
+    to put them back in.
+    """
+    steps = np.unique(np.diff(columns))
+    if(len(columns) == 1):
+        return slice(columns[0], columns[0]+1), None
+    if(len(steps) == 1 and steps[0] > 0):
+        return slice(columns[0], columns[-1]+1, int(steps[0])), None
+    if(np.all(steps > 0)):
+        return columns, None
+    unique, inverse = np.unique(columns, return_inverse=True)
+    return unique, inverse
@@ -0,0 +1,256 @@
+"""
+Overview pyramid for browsing long spans: decimated levels of RMS and min/max
+envelopes, binned in time (e.g. 1 s, 10 s, 60 s) and in distance (groups of
+channels), kept in one chunked HDF5 file. A day or a week of the whole fibre
+can then be shown as a waterfall from a few MB instead of the raw data.
+
+The pyramid is built incrementally: each new file adds to the bins it
+overlaps (bins that span two files are completed by the second one), and files
+already added are skipped. Each level stores sum of squares, sample count, min
+and max per bin, so the RMS is exact whichever files a bin came from. Every
+file is demeaned per channel first, so the RMS is not dominated by offsets.
+
+Build in time order: bins are counted from midnight of the first file's day.
+One pyramid holds one channel geometry (one epoch).
+
+Example:
+    das_overview.build_overview(t_start, t_end, input_dir)      # again later to add new files
+    img, axis = das_overview.read_overview(input_dir, t_start, t_end, npix_time=2000, npix_dist=1000)
+    plt.imshow(img.T, aspect='auto', extent=axis['extent'])
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import header_index
+from pydas_readers.readers import load_das_h5
+
+OVERVIEW_NAME = ".pydas_overview.h5"
+DATASET = "Acquisition/Raw[0]/RawData"
+
+#-- (seconds per time bin, channels per distance bin) of each level, finest first.
+#-- Each level must be a whole multiple of the first.
+LEVELS = ((1., 4), (10., 16), (60., 64))
+
+#-- HDF5 chunks of each level [ time bins, distance bins ]
+CHUNKS = (256, 256)
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_GEOMETRY = ('d0', 'dx', 'fm', 'nchan')
+
+
+def overview_path(input_dir):
+    return os.path.join(os.path.abspath(input_dir), OVERVIEW_NAME)
+
+
+def _bin_starts(bins):
+    """ Indices where a sorted array of bin numbers changes (for np.ufunc.reduceat) """
+    return np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+
+
+def _reduce(sumsq, count, vmin, vmax, rows, cols):
+    """ Combine bins [ row, col ] into coarser bins, given the coarse bin of every row and column """
+    rs, cs = _bin_starts(rows), _bin_starts(cols)
+    out = []
+    for ufunc, x in ((np.add, sumsq), (np.add, count), (np.minimum, vmin), (np.maximum, vmax)):
+        out.append(ufunc.reduceat(ufunc.reduceat(x, rs, axis=0), cs, axis=1))
+    return out, rows[rs], cols[cs]
+
+
+class Overview(object):
+    """
+    ov = Overview(path)
+
+    The overview pyramid in the HDF5 file "path" (created with the first file added).
+    """
+
+    def __init__(self, path, levels=LEVELS):
+        self.path = path
+        self.levels = levels
+        if(os.path.exists(path)):
+            with h5py.File(path, "r") as f:
+                self.levels = [(f[g].attrs['tbin'], int(f[g].attrs['cbin'])) for g in sorted(f.keys()) if g.startswith("level")]
+        for tbin, cbin in self.levels:
+            ratio = tbin / self.levels[0][0]
+            if(abs(ratio - round(ratio)) > 1e-9 or cbin % self.levels[0][1] != 0):
+                raise ValueError("Each level must be a whole multiple of the first: {0}".format(self.levels))
+
+    def __repr__(self):
+        return "Overview({0}, levels={1})".format(self.path, list(self.levels))
+
+    def files(self):
+        if(not os.path.exists(self.path)):
+            return set()
+        with h5py.File(self.path, "r") as f:
+            return set(k.decode() if isinstance(k, bytes) else k for k in f["files"][:])
+
+    def attrs(self):
+        with h5py.File(self.path, "r") as f:
+            attrs = dict(f.attrs)
+        attrs['t_origin'] = datetime.strptime(attrs['t_origin'], _TIME_FORMAT)
+        return attrs
+
+    def _create(self, f, headers):
+        t0 = headers['t0']
+        f.attrs['t_origin'] = datetime(t0.year, t0.month, t0.day).strftime(_TIME_FORMAT)
+        for k in _GEOMETRY:
+            f.attrs[k] = headers[k]
+        f.attrs['spacing'] = (headers['d1'] - headers['d0']) / max(headers['nchan'] - 1, 1)
+        f.create_dataset("files", (0,), maxshape=(None,), dtype=h5py.string_dtype())
+        for il, (tbin, cbin) in enumerate(self.levels):
+            g = f.create_group("level{0}".format(il))
+            g.attrs['tbin'] = tbin
+            g.attrs['cbin'] = cbin
+            ncol = -(-headers['nchan'] // cbin)
+            chunks = (CHUNKS[0], min(CHUNKS[1], ncol))
+            for name, fill in (("sumsq", 0.), ("count", 0.), ("min", np.nan), ("max", np.nan)):
+                g.create_dataset(name, (0, ncol), maxshape=(None, ncol), dtype='float32', chunks=chunks, fillvalue=fill)
+
+    def add(self, filename, data, headers, verbose=False):
+        """
+        ov.add(filename, data, headers)
+        :Add one file's data [ npts, nchan ] (all channels, raw units) to every level.
+        """
+        with h5py.File(self.path, "a") as f:
+            if("files" not in f):
+                self._create(f, headers)
+            for k in _GEOMETRY:
+                if(not np.isclose(headers[k], f.attrs[k])):
+                    raise ValueError("File {0} has {1}={2}, overview {3} has {4}".format(filename, k, headers[k], self.path, f.attrs[k]))
+            t_origin = datetime.strptime(f.attrs['t_origin'], _TIME_FORMAT)
+            offset = (headers['t0'] - t_origin).total_seconds()
+            if(offset < 0):
+                raise ValueError("File {0} starts before the overview ({1}); build in time order".format(filename, t_origin))
+
+            #-- Finest level straight from the data
+            x = np.asarray(data, dtype='float32')
+            x = x - np.mean(x, axis=0)
+            npts, nchan = np.shape(x)
+            tbin0, cbin0 = self.levels[0]
+            rows = np.floor((offset + np.arange(npts)/headers['fs']) / tbin0 + 1e-6).astype('int64')
+            cols = np.arange(nchan) // cbin0
+            ones = np.ones((npts, 1), dtype='float32')
+            rs, cs = _bin_starts(rows), _bin_starts(cols)
+            fine = [np.add.reduceat(np.add.reduceat(x*x, rs, axis=0), cs, axis=1),
+                    np.add.reduceat(ones, rs, axis=0) * np.diff(np.append(cs, nchan))[None, :],
+                    np.minimum.reduceat(np.minimum.reduceat(x, rs, axis=0), cs, axis=1),
+                    np.maximum.reduceat(np.maximum.reduceat(x, rs, axis=0), cs, axis=1)]
+            rows, cols = rows[rs], cols[cs]
+
+            #-- Coarser levels from the finest bins of this file
+            for il, (tbin, cbin) in enumerate(self.levels):
+                tstep = int(round(tbin / tbin0))
+                level, lrows, lcols = _reduce(*fine, rows // tstep, cols // (cbin // cbin0))
+                self._merge(f["level{0}".format(il)], level, lrows[0], lrows[-1]+1)
+
+            i = len(f["files"])
+            f["files"].resize(i+1, axis=0)
+            f["files"][i] = os.path.abspath(filename)
+        if(verbose):
+            print("Added {0} to overview {1}".format(filename, self.path))
+
+    def _merge(self, g, level, r0, r1):
+        if(g["sumsq"].shape[0] < r1):
+            for name in ("sumsq", "count", "min", "max"):
+                g[name].resize(r1, axis=0)
+        sumsq, count, vmin, vmax = level
+        ncol = np.shape(sumsq)[1]
+        g["sumsq"][r0:r1, :ncol] = g["sumsq"][r0:r1, :ncol] + sumsq
+        g["count"][r0:r1, :ncol] = g["count"][r0:r1, :ncol] + count
+        g["min"][r0:r1, :ncol] = np.fmin(g["min"][r0:r1, :ncol], vmin)
+        g["max"][r0:r1, :ncol] = np.fmax(g["max"][r0:r1, :ncol], vmax)
+
+    def choose_level(self, t_start, t_end, nchan=None, npix_time=2000, npix_dist=1000):
+        """ Finest level with at most npix_time x npix_dist bins over the extent (else the coarsest) """
+        seconds = (t_end - t_start).total_seconds()
+        for il, (tbin, cbin) in enumerate(self.levels):
+            if(seconds / tbin <= npix_time and (nchan is None or nchan / cbin <= npix_dist)):
+                return il
+        return len(self.levels) - 1
+
+    def read(self, t_start, t_end, d_start=None, d_end=None, stat="rms", level=None, npix_time=2000, npix_dist=1000):
+        """
+        img, axis = ov.read(t_start, t_end, d_start, d_end, stat="rms")
+
+        :param stat: "rms", "min", "max", or "envelope" (max |min|, |max|)
+        :param level: force a level, default: chosen from npix_time / npix_dist
+        :return: img [ time bins, distance bins ] (NaN where no data), axis with
+                 'tt' (datetime of each bin start), 'dd' (distance of each bin centre),
+                 'level', 'tbin', 'cbin' and 'extent' for plt.imshow(img.T, extent=...)
+                 (time in seconds from t_start)
+        """
+        attrs = self.attrs()
+        spacing = attrs['spacing']
+        nchan = int(attrs['nchan'])
+        c_first = 0 if d_start is None else max(0, int(np.floor((d_start - attrs['d0']) / spacing)))
+        c_last = nchan if d_end is None else min(nchan, int(np.ceil((d_end - attrs['d0']) / spacing)) + 1)
+        if(level is None):
+            level = self.choose_level(t_start, t_end, c_last - c_first, npix_time=npix_time, npix_dist=npix_dist)
+        tbin, cbin = self.levels[level]
+
+        r0 = max(0, int(np.floor((t_start - attrs['t_origin']).total_seconds() / tbin)))
+        r1 = int(np.floor((t_end - attrs['t_origin']).total_seconds() / tbin)) + 1
+        k0, k1 = c_first // cbin, -(-c_last // cbin)
+        with h5py.File(self.path, "r") as f:
+            g = f["level{0}".format(level)]
+            r1 = max(r0, min(r1, g["count"].shape[0]))
+            count = g["count"][r0:r1, k0:k1]
+            if(stat == "rms"):
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    img = np.sqrt(g["sumsq"][r0:r1, k0:k1] / count)
+            elif(stat in ("min", "max")):
+                img = g[stat][r0:r1, k0:k1]
+            elif(stat == "envelope"):
+                img = np.fmax(np.abs(g["min"][r0:r1, k0:k1]), np.abs(g["max"][r0:r1, k0:k1]))
+            else:
+                raise ValueError("Unknown stat: {0}".format(stat))
+        img[count == 0] = np.nan
+
+        axis = dict(level=level, tbin=tbin, cbin=cbin)
+        axis['tt'] = np.array([attrs['t_origin'] + timedelta(seconds=(r0+i)*tbin) for i in range(r1-r0)])
+        k = np.arange(k0, k1)
+        axis['dd'] = attrs['d0'] + (k*cbin + np.minimum((k+1)*cbin, nchan) - 1) / 2. * spacing
+        t_first = (attrs['t_origin'] + timedelta(seconds=r0*tbin) - t_start).total_seconds()
+        axis['extent'] = [t_first, t_first + (r1-r0)*tbin, attrs['d0'] + (k1*cbin-0.5)*spacing, attrs['d0'] + (k0*cbin-0.5)*spacing]
+        return img, axis
+
+
+def build_overview(t_start, t_end, input_dir='./', path=None, levels=LEVELS, verbose=False):
+    """
+    nadded = das_overview.build_overview(t_start, t_end, input_dir)
+    :Add every file of the time window that is not in the overview yet (path default: input_dir/OVERVIEW_NAME).
+    """
+    path = path if path is not None else overview_path(input_dir)
+    ov = Overview(path, levels=levels)
+    done = ov.files()
+    index = header_index.get_index(input_dir)
+
+    todo = []
+    for filename in (load_das_h5.make_file_list(t_start, t_end, input_dir, verbose=verbose) or []):
+        if(os.path.abspath(filename) in done):
+            continue
+        headers = index.headers(filename, verbose=verbose)
+        if(load_das_h5.file_in_window(headers, t_start, t_end)):
+            todo.append((headers['t0'], filename, headers))
+    index.save(verbose=verbose)
+
+    for t0, filename, headers in sorted(todo, key=lambda x: x[0]):
+        with h5py.File(filename, "r") as f:
+            data = f[DATASET][:]
+        ov.add(filename, data, headers, verbose=verbose)
+    return len(todo)
+
+
+def read_overview(input_dir, t_start, t_end, d_start=None, d_end=None, stat="rms", path=None, **kwargs):
+    """
+    img, axis = das_overview.read_overview(input_dir, t_start, t_end, npix_time=2000, npix_dist=1000)
+    :See Overview.read()
+    """
+    path = path if path is not None else overview_path(input_dir)
+    return Overview(path).read(t_start, t_end, d_start=d_start, d_end=d_end, stat=stat, **kwargs)
@@ -0,0 +1,404 @@
+"""
+Time-series-major companion store for long, narrow requests ("channel 1200 for
+the last 30 days"). The raw files are [ time, channel ] and 30 s long, so such a
+request opens tens of thousands of files and does a strided read in each. This
+store keeps a copy of the archive transposed, chunked by a group of channels
+by a whole day, so each channel's day is one contiguous run on disk:
+
+    input_dir/.pydas_timeseries/.zattrs          -- headers (as load_das_h5.load_headers_only())
+    input_dir/.pydas_timeseries/files.jsonl      -- ingested files, one line each: where each one sits in the store
+    input_dir/.pydas_timeseries/RawData/.zarray  -- shape [ nchan, npts ], chunks, dtype (Zarr v2, no compression)
+    input_dir/.pydas_timeseries/RawData/<j>.<i>  -- raw chunk (channel block j, day i)
+
+Sample i of the store is at headers['t0'] + i/fs, which is midnight of the first
+file's day. Data is kept as stored in the files (raw dtype, unconverted). Samples
+of a day that no file covered are not defined; they are never read, because a
+read is put together from the ingested files only, cut exactly as load_das_custom
+cuts the files themselves (gaps are skipped, not filled). Other tools opening the
+Zarr array directly see zeros there.
+
+The store is kept up to date incrementally (new or changed files only), by
+build_timeseries() or by live_ingest.follow(timeseries=...). The list of files is
+only ever appended to (a re-added file gets a new line, the last one counts), so
+adding a file costs the same however large the archive has grown. One store holds one
+channel geometry (one epoch); files of other epochs are left out. Only one
+process should write at a time.
+
+load_das_h5.load_das_custom() reads from the store by itself when a request is
+for at most ROUTE_MAX_CHANNELS channels over at least ROUTE_MIN_SECONDS and every
+file of the window is in the store (and unchanged); otherwise it reads the files as before.
+
+Example:
+    das_timeseries.build_timeseries(t_start, t_end, input_dir)      # again later to add new files
+    data, headers, axis = load_das_h5.load_das_custom(t_start, t_end, mapchan=[1200], input_dir=input_dir)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import header_index
+from pydas_readers.readers import load_das_h5
+
+TIMESERIES_NAME = ".pydas_timeseries"
+CATALOGUE = "files.jsonl"
+ARRAY = "RawData"
+DATASET = "Acquisition/Raw[0]/RawData"
+
+#-- Chunk: this many seconds of data (a day) ...
+CHUNK_SECONDS = 86400.
+#-- ... by this many channels
+CHUNK_CHANNELS = 64
+
+#-- Requests routed to the store by load_das_custom: at most this many channels ...
+ROUTE_MAX_CHANNELS = 64
+#-- ... over at least this long
+ROUTE_MIN_SECONDS = 3600.
+
+#-- Headers that describe one file rather than the store
+_BLOCK_KEYS = ('npts', 't1')
+#-- Headers that must agree between a file and the store
+_GEOMETRY_KEYS = ('fs', 'nchan', 'dx', 'fm', 'd0')
+
+#-- Stores already opened in this process, by path
+_STORES = dict()
+
+
+def timeseries_path(input_dir):
+    return os.path.join(os.path.abspath(input_dir), TIMESERIES_NAME)
+
+
+def get_timeseries(input_dir, path=None):
+    """ The (cached) TimeSeriesStore of an input directory; path defaults to input_dir/TIMESERIES_NAME """
+    path = path if path is not None else timeseries_path(input_dir)
+    if(path not in _STORES):
+        _STORES[path] = TimeSeriesStore(input_dir, path)
+    return _STORES[path]
+
+
+class TimeSeriesStore(object):
+    """
+    ts = TimeSeriesStore(input_dir, path)
+
+    The channel-major copy of the files of input_dir, in the directory "path"
+    (created with the first file added). Filenames are kept relative to input_dir.
+    """
+
+    def __init__(self, input_dir, path):
+        self.root = os.path.abspath(input_dir)
+        self.path = path
+        self._files = dict()    # key -> [ t0, t1, npts, i0, mtime, size ], times in seconds from the store's t0
+        self._files_read = 0    # bytes of the catalogue read into _files so far
+
+    def __repr__(self):
+        return "TimeSeriesStore({0}, {1} files)".format(self.path, len(self.files()))
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, ARRAY, ".zarray"))
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+    def files(self):
+        """ key -> [ t0, t1, npts, i0, mtime, size ] of every ingested file (only new lines of the catalogue are read) """
+        filename = os.path.join(self.path, CATALOGUE)
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if(size < self._files_read):
+            #-- Catalogue replaced (store re-made): start again
+            self._files = dict()
+            self._files_read = 0
+        if(size > self._files_read):
+            with open(filename, "rb") as f:
+                f.seek(self._files_read)
+                new = f.read(size - self._files_read)
+            #-- Only whole lines (a writer may be half way through the last one)
+            new = new[:new.rfind(b"\n")+1]
+            for line in new.splitlines():
+                entry = json.loads(line)
+                self._files[entry[0]] = entry[1:]
+            self._files_read += len(new)
+        return self._files
+
+    def _append_files(self, entries):
+        """ Add lines [ key, t0, t1, npts, i0, mtime, size ] to the catalogue, in one write """
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+        fd = os.open(os.path.join(self.path, CATALOGUE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines)
+        finally:
+            os.close(fd)
+        self.files()
+
+    @property
+    def headers(self):
+        with open(os.path.join(self.path, ".zattrs"), "r") as f:
+            return header_index.decode_headers(json.load(f))
+
+    def _meta(self):
+        with open(os.path.join(self.path, ARRAY, ".zarray"), "r") as f:
+            return json.load(f)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Writing
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def _create(self, headers, dtype):
+        t0 = headers['t0']
+        attrs = dict(headers)
+        attrs['t0'] = datetime(t0.year, t0.month, t0.day)
+        attrs = {k: v for k, v in header_index.encode_headers(attrs).items() if k not in _BLOCK_KEYS}
+        dtype = np.dtype(dtype)
+        chunks = [min(CHUNK_CHANNELS, int(headers['nchan'])), max(1, int(round(CHUNK_SECONDS*headers['fs'])))]
+        meta = dict(zarr_format=2, shape=[int(headers['nchan']), 0], chunks=chunks, dtype=dtype.str, compressor=None,
+                    fill_value="NaN" if dtype.kind == 'f' else 0, order="C", filters=None, dimension_separator=".")
+        os.makedirs(os.path.join(self.path, ARRAY), exist_ok=True)
+        _write_json(os.path.join(self.path, ".zgroup"), dict(zarr_format=2))
+        _write_json(os.path.join(self.path, ".zattrs"), attrs)
+        _write_json(os.path.join(self.path, ARRAY, ".zattrs"), dict(_ARRAY_DIMENSIONS=["distance", "time"]))
+        _write_json(os.path.join(self.path, ARRAY, ".zarray"), meta)
+        self._append_files([])
+
+    def fits(self, headers, dtype):
+        """ Can a file with these headers and data type go into this store? """
+        if(not self.exists()):
+            return True
+        attrs = self.headers
+        for k in _GEOMETRY_KEYS:
+            if(not np.isclose(headers[k], attrs[k])):
+                return False
+        return np.dtype(dtype) == np.dtype(self._meta()['dtype']) and headers['t0'] >= attrs['t0']
+
+    def add(self, filename, data, headers, stat=None, verbose=False):
+        """
+        ts.add(filename, data, headers)
+        :Put one file's data [ npts, nchan ] (all channels, as stored) into the store.
+        """
+        stat = stat if stat is not None else os.stat(filename)
+        if(not self.exists()):
+            self._create(headers, data.dtype)
+        if(not self.fits(headers, data.dtype)):
+            raise ValueError("File {0} does not fit the time-series store {1} (other geometry or dtype, "
+                             "or before its first day)".format(filename, self.path))
+        attrs = self.headers
+        meta = self._meta()
+        fs = attrs['fs']
+        dtype = np.dtype(meta['dtype'])
+        cc, ct = meta['chunks']
+
+        offset = (headers['t0'] - attrs['t0']).total_seconds()
+        npts, nchan = np.shape(data)
+        i0 = int(round(offset * fs))
+        i1 = i0 + npts
+        for it in range(i0 // ct, (i1-1) // ct + 1):
+            a = max(i0, it*ct)
+            b = min(i1, (it+1)*ct)
+            for ic in range(0, -(-nchan // cc)):
+                c0 = ic*cc
+                c1 = min(nchan, c0+cc)
+                #-- Each channel's samples are one contiguous run of its row of the chunk
+                rows = np.ascontiguousarray(data[a-i0:b-i0, c0:c1].T, dtype=dtype)
+                fd = self._open_chunk(ic, it, dtype, (cc, ct))
+                try:
+                    for r in range(c1-c0):
+                        os.pwrite(fd, rows[r], (r*ct + a-it*ct) * dtype.itemsize)
+                finally:
+                    os.close(fd)
+
+        if(i1 > meta['shape'][1]):
+            meta['shape'][1] = int(i1)
+            _write_json(os.path.join(self.path, ARRAY, ".zarray"), meta)
+        #-- Listed only once its data is in
+        self._append_files([[self._key(filename), offset, (headers['t1'] - attrs['t0']).total_seconds(),
+                             int(npts), int(i0), stat.st_mtime, stat.st_size]])
+        if(verbose):
+            print("Added {0} to time-series store {1}".format(filename, self.path))
+
+    def _chunk_file(self, ic, it):
+        return os.path.join(self.path, ARRAY, "{0}.{1}".format(ic, it))
+
+    def _open_chunk(self, ic, it, dtype, chunks):
+        """ File descriptor of a chunk, open for writing; new chunks are sparse files of the full size """
+        fd = os.open(self._chunk_file(ic, it), os.O_RDWR | os.O_CREAT, 0o644)
+        if(os.fstat(fd).st_size == 0):
+            os.ftruncate(fd, chunks[0] * chunks[1] * dtype.itemsize)
+        return fd
+
+    def update(self, t_start=None, t_end=None, files=None, verbose=False):
+        """
+        ts.update(t_start, t_end)  or  ts.update(files=[...])
+        :Add every file of the window (or of the list) that is not in the store yet or has changed
+        :since, in time order. Files of another geometry are left out. Returns the number of files added.
+        :A list of files (as from live_ingest.follow) is read directly, without the header index,
+        :so each new file costs the same however large the archive is.
+        """
+        index = None
+        if(files is None):
+            files = load_das_h5.make_file_list(t_start, t_end, self.root, verbose=verbose) or []
+            index = header_index.get_index(self.root)
+        stored = self.files()
+        todo = []
+        for filename in files:
+            stat = os.stat(filename)
+            entry = stored.get(self._key(filename))
+            if(entry is not None and (entry[4], entry[5]) == (stat.st_mtime, stat.st_size)):
+                continue
+            if(index is not None):
+                headers = index.headers(filename, verbose=verbose)
+            else:
+                headers = load_das_h5.load_headers_only(filename, verbose=verbose)
+            if(t_start is not None and t_end is not None and not load_das_h5.file_in_window(headers, t_start, t_end)):
+                continue
+            todo.append((headers['t0'], filename, headers, stat))
+        if(index is not None):
+            index.save(verbose=verbose)
+
+        nadded = 0
+        for t0, filename, headers, stat in sorted(todo, key=lambda x: x[0]):
+            with h5py.File(filename, "r") as f:
+                dset = f[DATASET]
+                if(not self.fits(headers, dset.dtype)):
+                    if(verbose):
+                        print("Leaving {0} out of the time-series store (other geometry)".format(filename))
+                    continue
+                data = dset[:]
+            self.add(filename, data, headers, stat=stat, verbose=verbose)
+            nadded += 1
+        return nadded
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Reading
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def covers(self, t_start, t_end, candidates, verbose=False):
+        """
+        Is every file of the window in the store, unchanged since it was added? candidates: files
+        that may be in the window (from load_das_h5.make_file_list); those not in the store, or
+        rewritten since (other mtime or size), are checked in the header index.
+        """
+        stored = self.files()
+        index = None
+        for filename in candidates:
+            entry = stored.get(self._key(filename))
+            if(entry is not None):
+                stat = os.stat(filename)
+                if((entry[4], entry[5]) == (stat.st_mtime, stat.st_size)):
+                    continue
+            index = index if index is not None else header_index.get_index(self.root)
+            if(load_das_h5.file_in_window(index.headers(filename, verbose=verbose), t_start, t_end)):
+                if(verbose):
+                    print("{0} is not in the time-series store, or changed since".format(filename))
+                return False
+        if(index is not None):
+            index.save(verbose=verbose)
+        return True
+
+    def pieces(self, t_start, t_end):
+        """
+        pieces, t0, t1 = ts.pieces(t_start, t_end)
+        :Store samples [ (i0, i1), ... ] (end exclusive) to read for the window, cut per file as
+        :load_das_custom cuts the files, merged where files follow on from each other; and the
+        :times of the first and last sample.
+        """
+        attrs = self.headers
+        origin = attrs['t0']
+        fs = attrs['fs']
+        s_start = (t_start - origin).total_seconds()
+        s_end = (t_end - origin).total_seconds()
+
+        pieces = []
+        t0 = t1 = None
+        #-- Rough selection in seconds first, then exactly as file_in_window / time_indices on the few at the edges
+        for f0, f1, npts, i0, mtime, size in sorted(self.files().values()):
+            if(f1 < s_start - 1. or f0 > s_end + 1.):
+                continue
+            headers = dict(t0=origin + timedelta(seconds=round(f0, 6)), t1=origin + timedelta(seconds=round(f1, 6)), npts=npts, fs=fs)
+            if(not load_das_h5.file_in_window(headers, t_start, t_end)):
+                continue
+            if(headers['t0'] >= t_start and headers['t1'] <= t_end):
+                i_pull_start, i_pull_end = 0, npts-1
+            else:
+                i_pull_start, i_pull_end, tt = load_das_h5.time_indices(headers, t_start, t_end)
+            a, b = i0 + i_pull_start, i0 + i_pull_end + 1
+            if(len(pieces) > 0 and pieces[-1][1] == a):
+                pieces[-1] = (pieces[-1][0], b)
+            else:
+                pieces.append((a, b))
+            if(t0 is None):
+                t0 = headers['t0'] + timedelta(seconds=i_pull_start/fs)
+            t1 = headers['t0'] + timedelta(seconds=i_pull_end/fs)
+        return pieces, t0, t1
+
+    def read(self, pieces, sel=slice(None)):
+        """
+        data = ts.read(pieces, sel)
+        :The store samples of each piece (see pieces()), one after the other, for the channels
+        :sel (slice or index array): data [ npts, nchan ]. Each channel is read as contiguous runs.
+        """
+        meta = self._meta()
+        dtype = np.dtype(meta['dtype'])
+        cc, ct = meta['chunks']
+        columns = np.arange(meta['shape'][0])[sel]
+        out = np.empty((sum(b-a for a, b in pieces), len(columns)), dtype=dtype)
+
+        blocks = columns // cc
+        o = 0
+        for i0, i1 in pieces:
+            for it in range(i0 // ct, (i1-1) // ct + 1):
+                a = max(i0, it*ct)
+                b = min(i1, (it+1)*ct)
+                for ic in np.unique(blocks):
+                    here = np.flatnonzero(blocks == ic)
+                    with open(self._chunk_file(ic, it), "rb") as f:
+                        for j, r in zip(here, columns[here] - ic*cc):
+                            f.seek((r*ct + a-it*ct) * dtype.itemsize)
+                            out[o+a-i0:o+b-i0, j] = np.fromfile(f, dtype=dtype, count=b-a)
+            o += i1 - i0
+        return out
+
+
+def build_timeseries(t_start, t_end, input_dir='./', path=None, verbose=False):
+    """
+    nadded = das_timeseries.build_timeseries(t_start, t_end, input_dir)
+    :Add every file of the time window that is not in the store yet (path default: input_dir/TIMESERIES_NAME).
+    """
+    return get_timeseries(input_dir, path=path).update(t_start, t_end, verbose=verbose)
+
+
+def read_window(input_dir, t_start, t_end, candidates, d_start=0, d_end=0, ichan=[], mapchan=[], nth_channel=1,
+                mapchan_dx=None, verbose=False):
+    """
+    data, headers, dd, dx, t0, t1 = das_timeseries.read_window(input_dir, t_start, t_end, candidates, ...)
+
+    A request of load_das_custom from the time-series store of input_dir, or None if the
+    request should read the files instead: no store, more than ROUTE_MAX_CHANNELS channels,
+    shorter than ROUTE_MIN_SECONDS, or not every file of the window in the store.
+    :param candidates: files that may be in the window, from load_das_h5.make_file_list
+    """
+    if((t_end - t_start).total_seconds() < ROUTE_MIN_SECONDS):
+        return None
+    ts = get_timeseries(input_dir)
+    if(not ts.exists()):
+        return None
+    headers = ts.headers
+    sel, dd, dx = load_das_h5.select_channels(headers, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                              nth_channel=nth_channel, mapchan_dx=mapchan_dx, verbose=verbose)
+    if(len(dd) > ROUTE_MAX_CHANNELS or not ts.covers(t_start, t_end, candidates, verbose=verbose)):
+        return None
+    pieces, t0, t1 = ts.pieces(t_start, t_end)
+    if(len(pieces) == 0):
+        return None
+    if(verbose):
+        print("Reading {0} channels from the time-series store {1} ({2} pieces)".format(len(dd), ts.path, len(pieces)))
+    data = ts.read(pieces, sel)
+    return data, headers, dd, dx, t0, t1
+
+
+def _write_json(filename, content):
+    tmp = filename + ".tmp{0}".format(os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp, filename)
@@ -0,0 +1,320 @@
+"""
+A chunked directory store for DAS data, as an alternative to one HDF5 file
+per block (write_das_h5).
+
+One store is one logical array [ npts, nchan ] that can span days. Each chunk
+is its own small file, so many processes can write different time ranges at
+the same time (HDF5 does not allow concurrent writers), and the array can be
+appended to along time. The layout is Zarr v2 with no compression, so zarr,
+xarray or dask can also open it, but nothing beyond numpy is needed here and
+it only uses the local filesystem:
+
+    store/.zgroup
+    store/.zattrs            -- headers, same names as load_das_h5.load_headers_only()
+    store/RawData/.zarray    -- shape, chunks, dtype
+    store/RawData/<i>.<j>    -- raw chunk (time block i, channel block j)
+
+Samples are placed by time: sample i of the store is at headers['t0'] + i/fs.
+Samples never written read as NaN.
+
+Example:
+    das_zarr.create_store("path/to/store", headers, t0=datetime(2023, 2, 5))   # once, before starting workers
+    das_zarr.write_block(data, headers, "path/to/store")     # from any number of processes
+    data, headers, axis = load_das_h5.load_das_custom(t_start, t_end, input_dir="path/to/store")
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+
+from pydas_readers.readers import header_index
+from pydas_readers.readers import load_das_h5
+
+ARRAY = "RawData"
+
+#-- Default chunk: this many seconds of data ...
+CHUNK_SECONDS = 10.
+#-- ... by this many channels
+CHUNK_CHANNELS = 256
+
+#-- Headers that describe one block rather than the store (they come from the shape instead)
+_BLOCK_KEYS = ('npts', 't1')
+#-- Headers that must agree between a block and the store it's written into
+_GEOMETRY_KEYS = ('fs', 'nchan', 'dx', 'fm', 'd0')
+
+
+def is_store(path):
+    """ Is path a chunked store (rather than a directory of HDF5 files)? """
+    return os.path.isfile(os.path.join(path, ARRAY, ".zarray"))
+
+
+def create_store(path, headers, t0=None, chunks=None, dtype='float32', exist_ok=True):
+    """
+    store = das_zarr.create_store(path, headers, t0=datetime(2023, 2, 5))
+
+    :param headers: headers of the data to go in
+    :param t0: time of sample 0 of the store (default: headers['t0']). Nothing can be written
+               before it, so with several writers, create the store first with the earliest time.
+    :param chunks: (samples, channels) per chunk, default CHUNK_SECONDS x CHUNK_CHANNELS
+    :param dtype: data type stored
+    :param exist_ok: if the store already exists, open it (must have the same geometry)
+    :return: DASStore
+    """
+    if(chunks is None):
+        chunks = (max(1, int(round(CHUNK_SECONDS*headers['fs']))), min(CHUNK_CHANNELS, headers['nchan']))
+    dtype = np.dtype(dtype)
+    os.makedirs(os.path.join(path, ARRAY), exist_ok=True)
+
+    headers = dict(headers)
+    if(t0 is not None):
+        headers['t0'] = t0
+    attrs = {k: v for k, v in header_index.encode_headers(headers).items() if k not in _BLOCK_KEYS}
+    meta = dict(zarr_format=2, shape=[0, int(headers['nchan'])], chunks=[int(c) for c in chunks],
+                dtype=dtype.str, compressor=None, fill_value="NaN" if dtype.kind == 'f' else 0,
+                order="C", filters=None, dimension_separator=".")
+
+    #-- Whoever gets here first creates it; the others open what they made
+    with _locked(path):
+        if(is_store(path)):
+            if(not exist_ok):
+                raise FileExistsError("Store already exists: {0}".format(path))
+        else:
+            _write_json(os.path.join(path, ".zgroup"), dict(zarr_format=2))
+            _write_json(os.path.join(path, ".zattrs"), attrs)
+            _write_json(os.path.join(path, ARRAY, ".zattrs"), dict(_ARRAY_DIMENSIONS=["time", "distance"]))
+            _write_json(os.path.join(path, ARRAY, ".zarray"), meta)
+    return DASStore(path)
+
+
+class DASStore(object):
+    """
+    store = das_zarr.DASStore(path)
+
+    store.headers -- headers of the whole array (t0, t1, npts follow the current shape)
+    store.shape, store.chunks, store.dtype
+    store.write(data, t0) / store.append(data) / store.read(i0, i1, sel)
+    """
+
+    def __init__(self, path):
+        if(not is_store(path)):
+            raise FileNotFoundError("Not a DAS chunked store: {0}".format(path))
+        self.path = path
+        with open(os.path.join(path, ".zattrs"), "r") as f:
+            self.attrs = header_index.decode_headers(json.load(f))
+        self._read_meta()
+
+    def _read_meta(self):
+        with open(os.path.join(self.path, ARRAY, ".zarray"), "r") as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        self.chunks = tuple(self.meta['chunks'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.fill_value = np.nan if self.meta['fill_value'] == "NaN" else self.meta['fill_value']
+
+    @property
+    def headers(self):
+        self._read_meta()
+        headers = dict(self.attrs)
+        headers['npts'] = self.shape[0]
+        headers['t1'] = headers['t0'] + timedelta(seconds=(self.shape[0]-1)/headers['fs'])
+        return headers
+
+    def __repr__(self):
+        h = self.headers
+        return "DASStore({0}, shape={1}, chunks={2}, {3} -- {4})".format(self.path, self.shape, self.chunks, h['t0'], h['t1'])
+
+    def index_of(self, t):
+        """ Sample number of time t (nearest sample) """
+        return int(round((t - self.attrs['t0']).total_seconds() * self.attrs['fs']))
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Writing
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def check_headers(self, headers):
+        """ Raise ValueError if a block with these headers doesn't fit this store """
+        for k in _GEOMETRY_KEYS:
+            if(k in headers and not np.isclose(headers[k], self.attrs[k])):
+                raise ValueError("Block has {0}={1}, store {2} has {3}".format(k, headers[k], self.path, self.attrs[k]))
+
+    def write(self, data, t0=None, i0=None):
+        """
+        store.write(data, t0=headers['t0'])
+
+        Write a block [ npts, nchan ] at time t0 (or at sample i0). Chunks that are only partly
+        covered are updated under a lock, so any number of processes can write at once.
+        The array grows as needed.
+        """
+        if(i0 is None):
+            i0 = self.index_of(t0)
+        if(i0 < 0):
+            raise ValueError("Block starts before the start of the store ({0})".format(self.attrs['t0']))
+        npts, nchan = np.shape(data)
+        if(nchan != self.shape[1]):
+            raise ValueError("Block has {0} channels, store has {1}".format(nchan, self.shape[1]))
+        i1 = i0 + npts
+        ct, cc = self.chunks
+
+        for it in range(i0 // ct, (i1-1) // ct + 1):
+            a = max(i0, it*ct)
+            b = min(i1, (it+1)*ct)
+            for ic in range(0, -(-nchan // cc)):
+                c0 = ic*cc
+                c1 = min(nchan, c0+cc)
+                part = data[a-i0:b-i0, c0:c1]
+                if(b - a == ct and c1 - c0 == cc):
+                    #-- Whole chunk: nobody else writes it, no need to read or lock
+                    self._write_chunk(it, ic, np.asarray(part, dtype=self.dtype))
+                else:
+                    with _locked(self.path):
+                        chunk = self._read_chunk(it, ic)
+                        chunk[a-it*ct:b-it*ct, :c1-c0] = part
+                        self._write_chunk(it, ic, chunk)
+        self._grow(i1)
+
+    def append(self, data):
+        """ Write a block right after the current end of the array (one appending process at a time) """
+        self._read_meta()
+        self.write(data, i0=self.shape[0])
+
+    def _grow(self, npts):
+        with _locked(self.path):
+            self._read_meta()
+            if(npts > self.shape[0]):
+                self.meta['shape'][0] = int(npts)
+                _write_json(os.path.join(self.path, ARRAY, ".zarray"), self.meta)
+                self.shape = tuple(self.meta['shape'])
+
+    def _chunk_file(self, it, ic):
+        return os.path.join(self.path, ARRAY, "{0}.{1}".format(it, ic))
+
+    def _read_chunk(self, it, ic):
+        filename = self._chunk_file(it, ic)
+        if(os.path.exists(filename)):
+            return np.fromfile(filename, dtype=self.dtype).reshape(self.chunks)
+        return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+
+    def _write_chunk(self, it, ic, chunk):
+        if(chunk.shape != self.chunks):
+            full = np.full(self.chunks, self.fill_value, dtype=self.dtype)
+            full[:chunk.shape[0], :chunk.shape[1]] = chunk
+            chunk = full
+        #-- Write then rename, so readers never see half a chunk
+        filename = self._chunk_file(it, ic)
+        tmp = filename + ".tmp{0}".format(os.getpid())
+        np.ascontiguousarray(chunk, dtype=self.dtype).tofile(tmp)
+        os.replace(tmp, filename)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- Reading
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def read(self, i0, i1, sel=slice(None)):
+        """
+        data = store.read(i0, i1, sel)
+        :Samples i0 to i1 (exclusive) of the channels sel (slice or index array), only
+        : reading the chunks that are needed.
+        """
+        self._read_meta()
+        i1 = min(i1, self.shape[0])
+        columns = np.arange(self.shape[1])[sel]
+        out = np.empty((max(0, i1-i0), len(columns)), dtype=self.dtype)
+        if(i1 <= i0):
+            return out
+        ct, cc = self.chunks
+        blocks = columns // cc
+        for ic in np.unique(blocks):
+            here = np.flatnonzero(blocks == ic)
+            local = columns[here] - ic*cc
+            for it in range(i0 // ct, (i1-1) // ct + 1):
+                a = max(i0, it*ct)
+                b = min(i1, (it+1)*ct)
+                chunk = self._read_chunk(it, ic)
+                out[a-i0:b-i0, here] = chunk[a-it*ct:b-it*ct][:, local]
+        return out
+
+
+def write_block(data, headers, path, chunks=None, dtype='float32'):
+    """
+    das_zarr.write_block(data, headers, "path/to/store")
+
+    Counterpart of write_das_h5.write_block: put a block into a store (created from these
+    headers if it doesn't exist yet) at the time headers['t0'].
+    """
+    store = create_store(path, headers, chunks=chunks, dtype=dtype, exist_ok=True)
+    store.check_headers(headers)
+    store.write(data, t0=headers['t0'])
+    return store
+
+
+def read_window(path, t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], nth_channel=1, mapchan_dx=None, verbose=False):
+    """
+    data, headers, dd, dx, t0, t1 = das_zarr.read_window(path, t_start, t_end, ...)
+
+    The part of a store between t_start and t_end (nearest samples, as load_das_custom),
+    for the channels chosen as in load_das_custom. Used by load_das_custom when
+    input_dir is a store.
+    """
+    store = DASStore(path)
+    headers = store.headers
+    fs = headers['fs']
+    npts = headers['npts']
+
+    i_pull_start = 0
+    i_pull_end = npts - 1
+    if(t_start > headers['t0']):
+        i_pull_start = min(max(store.index_of(t_start), 0), npts-1)
+    if(headers['t1'] > t_end):
+        i_pull_end = min(max(store.index_of(t_end), 0), npts-1)
+    if(verbose):
+        print("Reading samples {0} to {1} of store {2}".format(i_pull_start, i_pull_end, path))
+
+    sel, dd, dx = load_das_h5.select_channels(headers, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                              nth_channel=nth_channel, mapchan_dx=mapchan_dx, verbose=verbose)
+    data = store.read(i_pull_start, i_pull_end+1, sel)
+    t0 = headers['t0'] + timedelta(seconds=i_pull_start/fs)
+    t1 = headers['t0'] + timedelta(seconds=i_pull_end/fs)
+    return data, headers, dd, dx, t0, t1
+
+
+@contextmanager
+def _locked(path):
+    """ Exclusive lock over a store (between processes on the same machine / local filesystem) """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".lock"), "a+") as f:
+        try:
+            import fcntl
+        except ImportError:
+            #-- Windows: lock the first byte of the lock file instead
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    #-- LK_LOCK gives up after ~10 s, keep waiting
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(filename, content):
+    tmp = filename + ".tmp{0}".format(os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp, filename)
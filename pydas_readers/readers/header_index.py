@@ -0,0 +1,139 @@
+"""
+Cache of file headers, so scanning an archive (DASArchive, DASArray.to_dask)
+doesn't open every HDF5 file again each time.
+
+One small JSON index is kept per input_dir (INDEX_NAME), with the headers of
+each file as read by load_das_h5.load_headers_only(), plus the dtype, shape and
+HDF5 chunk shape of its data block. Entries are re-read when a file's size or
+modification time changes. If input_dir is not writable the index just lives
+in memory for this process.
+
+Example:
+    index = header_index.get_index(input_dir)
+    headers = index.headers(filename)
+    layout = index.layout(filename)      # dict(dtype=..., shape=..., chunks=...)
+    index.save()
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import json
+import os
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import load_das_h5
+
+INDEX_NAME = ".pydas_headers.json"
+DATASET = "Acquisition/Raw[0]/RawData"
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_TIME_KEYS = ('t0', 't1')
+
+#-- Indexes already loaded in this process, by index path
+_INDEXES = dict()
+
+
+def get_index(input_dir):
+    """ The (cached) HeaderIndex of an input directory """
+    path = os.path.join(os.path.abspath(input_dir), INDEX_NAME)
+    if(path not in _INDEXES):
+        _INDEXES[path] = HeaderIndex(path)
+    return _INDEXES[path]
+
+
+def clear_indexes():
+    _INDEXES.clear()
+
+
+class HeaderIndex(object):
+    """
+    index = HeaderIndex(path)
+
+    Headers and data layout of every file seen so far, stored in the JSON file "path".
+    Filenames are kept relative to the directory of the index, so an archive can be moved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.entries = dict()
+        self.dirty = False
+        if(os.path.exists(path)):
+            try:
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = dict()
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+    def _entry(self, filename, verbose=False):
+        key = self._key(filename)
+        stat = os.stat(filename)
+        entry = self.entries.get(key)
+        if(entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size):
+            headers = load_das_h5.load_headers_only(filename, verbose=verbose)
+            with h5py.File(filename, "r") as f:
+                dset = f[DATASET]
+                layout = dict(dtype=dset.dtype.str, shape=list(dset.shape),
+                              chunks=list(dset.chunks) if dset.chunks is not None else None)
+            entry = dict(mtime=stat.st_mtime, size=stat.st_size, headers=encode_headers(headers), layout=layout)
+            self.entries[key] = entry
+            self.dirty = True
+        elif(verbose):
+            print("Headers of {0} from index".format(filename))
+        return entry
+
+    def headers(self, filename, verbose=False):
+        """ Headers of a file, as from load_das_h5.load_headers_only() """
+        return decode_headers(self._entry(filename, verbose=verbose)['headers'])
+
+    def layout(self, filename):
+        """ dict(dtype=numpy dtype, shape=(npts, nchan), chunks=HDF5 chunk shape or None) """
+        layout = dict(self._entry(filename)['layout'])
+        layout['dtype'] = np.dtype(layout['dtype'])
+        layout['shape'] = tuple(layout['shape'])
+        if(layout['chunks'] is not None):
+            layout['chunks'] = tuple(layout['chunks'])
+        return layout
+
+    def save(self, verbose=False):
+        """ Write the index if anything changed (quietly skipped if the directory is read-only) """
+        if(not self.dirty):
+            return
+        tmp = self.path + ".tmp{0}".format(os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            if(verbose):
+                print("Could not write header index {0}: {1}".format(self.path, e))
+
+
+def encode_headers(headers):
+    """ Headers with datetimes as strings and numpy scalars as python numbers (for JSON) """
+    out = dict()
+    for k, v in headers.items():
+        if(k in _TIME_KEYS):
+            out[k] = v.strftime(_TIME_FORMAT)
+        elif(isinstance(v, np.generic)):
+            out[k] = v.item()
+        else:
+            out[k] = v
+    return out
+
+
+def decode_headers(headers):
+    """ Inverse of encode_headers() """
+    out = dict(headers)
+    for k in _TIME_KEYS:
+        if(k in out):
+            out[k] = datetime.strptime(out[k], _TIME_FORMAT)
+    return out
@@ -0,0 +1,209 @@
+"""
+Follow a directory that the interrogator is still writing to (like "tail -f"):
+pick up each new file once it is complete, read its headers once, and push
+the data through a chain of processing steps (see util/block_stream.py) whose
+state carries on from file to file.
+
+The directory is polled. Only sub-directories whose modification time changed
+are listed again, so the work per poll stays the same as the archive grows
+(new day directories are picked up as they appear). A file counts as complete
+once its size has stopped changing between two polls and its headers can be read.
+
+Example, bandpass + decimate + detect, printing triggers as they happen:
+    det = block_detect.Detector(fs=250., sta=0.5, lta=10., on=4., off=2., min_channels=20)
+    chain = [block_stream.StreamBandpass(1., 40.),
+             block_stream.StreamDecimate(4),
+             block_stream.StreamDetect(det, callback=print)]
+    for data, headers, axis in live_ingest.follow("/path/to/live/dir/", chain, mapchan=mapping['i0']):
+        pass
+
+misc_testing/simulate_live_writer.py writes synthetic files in real time, for testing.
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import fnmatch
+import os
+import time
+from datetime import timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import load_das_h5
+from pydas_readers.util import block_stream
+
+
+class DirectoryWatcher(object):
+    """
+    watcher = live_ingest.DirectoryWatcher(input_dir)
+    new_files = watcher.poll()
+
+    :param input_dir: directory to watch, including all sub-directories
+    :param pattern: filename pattern of data files
+    :param existing: if False (default), files already there when the watcher starts are ignored,
+                     except for the newest "backlog" of them
+    :param backlog: number of the most recent existing files to still hand out
+    """
+
+    def __init__(self, input_dir, pattern="*.h5", existing=False, backlog=0):
+        self.input_dir = os.path.abspath(input_dir)
+        self.pattern = pattern
+        self._dir_mtime = dict()    # directory -> mtime when last listed
+        self._children = dict()     # directory -> its sub-directories when last listed
+        self._sizes = dict()        # file -> size at the last poll, while not yet complete
+        self._done = set()          # files already handed out (or skipped)
+
+        if(not existing):
+            files = sorted(self._new_files(), key=os.path.basename)
+            skip = files[:len(files)-backlog] if backlog > 0 else files
+            self._done.update(skip)
+            self._sizes.update({f: os.path.getsize(f) for f in files[len(skip):]})
+
+    def _new_files(self):
+        """ Files not seen before, listing only directories that changed """
+        found = []
+        stack = [self.input_dir]
+        while(len(stack) > 0):
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                entries = list(os.scandir(path)) if self._dir_mtime.get(path) != mtime else None
+            except OSError:
+                #-- Directory gone: forget it
+                self._dir_mtime.pop(path, None)
+                self._children.pop(path, None)
+                continue
+            if(entries is None):
+                #-- Unchanged directory: no new files here, but sub-directories may have changed
+                stack += self._children.get(path, [])
+                continue
+            self._dir_mtime[path] = mtime
+            self._children[path] = [entry.path for entry in entries if entry.is_dir()]
+            stack += self._children[path]
+            for entry in entries:
+                if(entry.is_dir()):
+                    continue
+                elif(fnmatch.fnmatch(entry.name, self.pattern) and entry.path not in self._done
+                     and entry.path not in self._sizes):
+                    found.append(entry.path)
+        return found
+
+    def poll(self):
+        """
+        :return: list of files that became complete since the last poll, in filename (time) order
+        """
+        for filename in self._new_files():
+            self._sizes[filename] = -1
+
+        ready = []
+        for filename, size in list(self._sizes.items()):
+            try:
+                new_size = os.path.getsize(filename)
+            except OSError:
+                del self._sizes[filename]
+                continue
+            if(new_size == size and new_size > 0 and _readable(filename)):
+                ready.append(filename)
+                del self._sizes[filename]
+                self._done.add(filename)
+            else:
+                self._sizes[filename] = new_size
+        return sorted(ready, key=os.path.basename)
+
+
+def _readable(filename):
+    """ Can the headers and data block be opened yet (the writer may still hold the file) """
+    try:
+        with h5py.File(filename, "r") as f:
+            dset = f["Acquisition/Raw[0]/RawData"]
+            return dset.shape[0] > 0 and "PartEndTime" in dset.attrs
+    except (OSError, KeyError):
+        return False
+
+
+def follow(input_dir, chain=[], poll=1.0, idle_timeout=None, max_files=None, existing=False, backlog=0,
+           pattern="*.h5", d_start=0, d_end=0, ichan=[], mapchan=[], nth_channel=1, mapchan_dx=None,
+           convert=False, qc=None, timeseries=None, verbose=False):
+    """
+    for data, headers, axis in live_ingest.follow(input_dir, chain):
+        ...
+
+    Wait for new files in input_dir and yield each one after the processing chain.
+    Files that don't follow on from the previous one in time (a gap) reset the chain.
+
+    :param chain: list of steps, each step(data, headers, axis) -> (data, headers, axis),
+                  see util/block_stream.py. Files whose chain returns None are not yielded.
+    :param poll: seconds between looking for new files
+    :param idle_timeout: stop after this many seconds without a new file (default: never)
+    :param max_files: stop after this many files (default: never)
+    :param existing, backlog, pattern: see DirectoryWatcher
+    :param d_start, d_end, ichan, mapchan, nth_channel, mapchan_dx, convert: channel selection
+                  and conversion, as in load_das_h5.load_das_custom()
+    :param qc: (optional) qc_stats.QCStats to store the QC summaries of each new file in,
+               e.g. qc_stats.get_qc(input_dir)
+    :param timeseries: (optional) das_timeseries.TimeSeriesStore to add each new file to,
+               e.g. das_timeseries.get_timeseries(input_dir)
+    """
+    watcher = DirectoryWatcher(input_dir, pattern=pattern, existing=existing, backlog=backlog)
+    t_expected = None
+    nfiles = 0
+    last_new = time.monotonic()
+
+    while True:
+        files = watcher.poll()
+        for filename in files:
+            if(qc is not None):
+                qc.update(files=[filename], verbose=verbose)
+            if(timeseries is not None):
+                timeseries.update(files=[filename], verbose=verbose)
+            data, headers, axis = read_file(filename, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                            nth_channel=nth_channel, mapchan_dx=mapchan_dx, convert=convert, verbose=verbose)
+            if(t_expected is not None and abs((headers['t0'] - t_expected).total_seconds()) > 1.5/headers['fs']):
+                if(verbose):
+                    print("Gap before {0}, resetting the processing chain".format(filename))
+                block_stream.reset_chain(chain)
+            t_expected = headers['t1'] + timedelta(seconds=1/headers['fs'])
+
+            out = block_stream.run_chain(chain, data, headers, axis)
+            if(out is not None):
+                yield out
+            nfiles += 1
+            if(max_files is not None and nfiles >= max_files):
+                return
+
+        if(len(files) > 0):
+            last_new = time.monotonic()
+        elif(idle_timeout is not None and time.monotonic() - last_new > idle_timeout):
+            return
+        time.sleep(poll)
+
+
+def read_file(filename, d_start=0, d_end=0, ichan=[], mapchan=[], nth_channel=1, mapchan_dx=None, convert=False, verbose=False):
+    """
+    data, headers, axis = live_ingest.read_file(filename, ...)
+    :One whole file, with the channel selection of load_das_custom, headers read only once.
+    :axis has 'dd' and 'tt' (as load_das_h5.stream_das).
+    """
+    headers = load_das_h5.load_headers_only(filename, verbose=verbose)
+    sel, dd, dx = load_das_h5.select_channels(headers, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                              nth_channel=nth_channel, mapchan_dx=mapchan_dx, verbose=verbose)
+    scale = load_das_h5.strain_rate_scale(headers, verbose=verbose) if convert==True else None
+    with h5py.File(filename, "r") as f:
+        dset = f["Acquisition/Raw[0]/RawData"]
+        data = np.empty((dset.shape[0], len(dd)), dtype=load_das_h5.output_dtype(dset.dtype, scale is not None))
+        load_das_h5.read_scaled(dset, slice(None), sel, data, scale=scale)
+
+    headers['npts'] = np.shape(data)[0]
+    headers['nchan'] = np.shape(data)[1]
+    headers['d0'] = dd[0]
+    headers['d1'] = dd[-1]
+    headers['dx'] = dx
+    if(scale is not None):
+        load_das_h5.mark_converted(headers, scale, verbose=verbose)
+
+    axis = dict()
+    axis['dd'] = dd
+    axis['tt'] = np.arange(np.shape(data)[0]) / headers['fs']
+    return data, headers, axis
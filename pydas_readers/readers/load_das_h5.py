@@ -27,9 +27,18 @@ import h5py
 import os
 from re import split
 
+from pydas_readers.mapping import epoch_tables
+from pydas_readers.readers import das_timeseries
+from pydas_readers.readers import das_zarr
+
 l_fields = []
 l_attrs = []
 
+#-- Spatial decimation (spatial_filter=...): working memory per block of rows read
+SPATIAL_CHUNK_BYTES = 2**26
+#-- Filter taps along the channel axis, keyed by (spatial_filter, step)
+_SPATIAL_TAPS = dict()
+
 def browse_file_attributes(name):
     l_fields.append(str(name))
     return(None)
@@ -155,11 +164,13 @@ def load_headers_only(file, verbose=False):
 
     return(headers)
 
-def load_file(file, convert=False, return_axis=True, verbose=False):
+def load_file(file, convert=False, return_axis=True, verbose=False, dtype=None):
     """
     data, headers, axis = load_das_h5.load_file( file )
 
     :Load a single HDF5 file, based solely on the filename
+    :dtype -- (optional) dtype of the returned data, e.g. 'float32' to halve the memory of converted data.
+    :         Default: as stored (float64 when converting)
     :OUTPUTS:
     :data    -- 2D numpy array [ num_samples, num_channels ]
     :headers -- dict of header information
@@ -173,39 +184,14 @@ def load_file(file, convert=False, return_axis=True, verbose=False):
     #-- (Using this other function to load headers is cleaner, but currently
     #--   it means the file is opened and closed twice)
 
+    #-- Convert everything (scaled while reading, straight into the output array)
+    scale = strain_rate_scale(headers, verbose=verbose) if convert==True else None
     with h5py.File(file, "r") as f:
-        data = f["Acquisition/Raw[0]/RawData"][:]
-
-
-    #-- Convert everything
-    if(convert==True):
-        #-- DCB note: Silixa raw PRODML files report units as strain rate, even when 
-        #--  the following conversion has not yet been applied. Up to the user to mark 
-        #--  whether data has actually been converted yet or not...
-        #-- We started writing a custom header defining any amplitude scaling that has been 
-        #--  applied (i.e., 1.0 if no scaling, some number otherwise)
-        scale = True
-        if('amp_scaling' in headers):
-            #-- Check if amplitude has been scaled yet or is still 1.0
-            #--  (close to 1.0, possible rounding errors with read/write)
-            if(np.abs(headers['amp_scaling']-1.0)>0.0001):
-                 print("WARNING: flag \"convert\" is TRUE, but units are already scaled somehow")
-                 print("   Doing nothing regarding conversion.")
-                 scale = False
-       
-        #-- DCB note: the sample rate (fs) used below is the ORIGINAL sample rate
-        #--  at which data is recorded. If files have been downsampled, use the custom
-        #--  header['fs_orig']
-        if(scale):
-            if('fs_orig' in headers.keys()):
-               fs = headers['fs_orig']
-
-            data = 116. * data / 8192. * fs / 10. 
-            headers['amp_scaling'] = 116. / 8192. * fs / 10.
-            headers['unit'] = '(nm/m)/s'
-            if(verbose):
-                print("Converted to strain rate!")
-
+        dset = f["Acquisition/Raw[0]/RawData"]
+        data = np.empty(dset.shape, dtype=output_dtype(dset.dtype, scale is not None, dtype))
+        read_scaled(dset, slice(None), slice(None), data, scale=scale)
+    if(scale is not None):
+        mark_converted(headers, scale, verbose=verbose)
 
     ##########################
     #-- One could stop here...
@@ -428,7 +414,275 @@ def make_file_list(t_start, t_end, input_dir, verbose=False):
 
     return consider_files
 
-def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], convert=False, verbose=False, input_dir='./', return_axis=True, nth_channel=1):
+def strain_rate_scale(headers, verbose=False):
+    """
+    scale = strain_rate_scale(headers)
+    :Factor from raw Silixa units to strain rate, (nm/m)/s, or None if headers say it was already applied.
+    """
+    #-- DCB note: Silixa raw PRODML files report units as strain rate, even when 
+    #--  the following conversion has not yet been applied. Up to the user to mark 
+    #--  whether data has actually been converted yet or not...
+    #-- We started writing a custom header defining any amplitude scaling that has been 
+    #--  applied (i.e., 1.0 if no scaling, some number otherwise)
+    if('amp_scaling' in headers):
+        #-- Check if amplitude has been scaled yet or is still 1.0
+        #--  (close to 1.0, possible rounding errors with read/write)
+        if(np.abs(headers['amp_scaling']-1.0)>0.0001):
+             print("WARNING: flag \"convert\" is TRUE, but units are already scaled somehow")
+             print("   Doing nothing regarding conversion.")
+             return None
+
+    #-- DCB note: the sample rate (fs) used below is the ORIGINAL sample rate
+    #--  at which data is recorded. If files have been downsampled, use the custom
+    #--  header['fs_orig']
+    fs = headers['fs']
+    if('fs_orig' in headers.keys()):
+       fs = headers['fs_orig']
+    return 116. / 8192. * fs / 10.
+
+
+def mark_converted(headers, scale, verbose=False):
+    headers['amp_scaling'] = scale
+    headers['unit'] = '(nm/m)/s'
+    if(verbose):
+        print("Converted to strain rate!")
+
+
+def convert_to_strain_rate(data, headers, verbose=False):
+    """
+    data, headers = convert_to_strain_rate(data, headers)
+    :Scale raw Silixa units to strain rate, (nm/m)/s, unless headers say it was already done.
+    :(The readers below do this while reading, with convert=True; this is for data already in memory.)
+    """
+    scale = strain_rate_scale(headers, verbose=verbose)
+    if(scale is None):
+        return data, headers
+    data = np.multiply(data, scale)
+    mark_converted(headers, scale, verbose=verbose)
+    return data, headers
+
+
+def output_dtype(raw_dtype, convert, dtype=None):
+    """ Output dtype of a read: as requested, else the raw dtype (float64 for converted data) """
+    if(dtype is not None):
+        return np.dtype(dtype)
+    if(convert):
+        return np.dtype('float64')
+    return np.dtype(raw_dtype)
+
+
+def read_scaled(dset, rows, sel, out, scale=None):
+    """
+    out = read_scaled(dset, rows, sel, out, scale=None)
+    :Read dset[rows, sel] straight into out (e.g. a block of rows of a preallocated float32 array)
+    : and multiply by scale in place. With slices, HDF5 converts the raw int16 to the dtype of out
+    : while reading, so no temporary of the raw block is made.
+    """
+    if(out.size == 0):
+        return out
+    if(isinstance(sel, slice) and out.flags['C_CONTIGUOUS']):
+        dset.read_direct(out, source_sel=np.s_[rows, sel])
+    else:
+        out[...] = dset[rows, sel]
+    if(scale is not None):
+        out *= scale
+    return out
+
+
+def spatial_selection(sel, spatial_filter):
+    """ Taps to filter a channel selection with, or None if it isn't a strided slice (or no filter) """
+    if(spatial_filter is None or not isinstance(sel, slice) or sel.step is None or sel.step <= 1):
+        return None
+    return spatial_taps(spatial_filter, sel.step)
+
+
+def spatial_taps(spatial_filter, step):
+    """
+    taps = spatial_taps(spatial_filter, step)
+    :Anti-alias filter along the channel axis before keeping every step-th channel (cached):
+    :  "boxcar"  -- average of the step channels around each kept one (a stack)
+    :  "lowpass" -- FIR lowpass at the new spatial Nyquist (as scipy.signal.decimate with ftype='fir')
+    """
+    key = (spatial_filter, int(step))
+    if(key not in _SPATIAL_TAPS):
+        if(spatial_filter == "boxcar"):
+            #-- Odd length, centred on the kept channel (half weights at the ends for even steps)
+            taps = np.ones(step + 1 - step % 2)
+            if(step % 2 == 0):
+                taps[0] = taps[-1] = 0.5
+        elif(spatial_filter == "lowpass"):
+            from scipy.signal import firwin
+            taps = firwin(20*step + 1, 1. / step, window='hamming')
+        else:
+            raise ValueError("Unknown spatial_filter: {0}".format(spatial_filter))
+        _SPATIAL_TAPS[key] = taps / np.sum(taps)
+    return _SPATIAL_TAPS[key]
+
+
+def read_spatial(dset, rows, sel, out, taps, scale=None, chunk_bytes=None):
+    """
+    out = read_spatial(dset, rows, sel, out, taps, scale=None)
+    :Like read_scaled, for a strided channel slice sel: reads the contiguous channels around the
+    : selection (a block of rows at a time), filters them with taps along the channel axis and
+    : keeps only the channels of sel. Near the ends of the fibre the taps that fall outside are
+    : left out and the rest re-normalised.
+    """
+    if(chunk_bytes is None):
+        chunk_bytes = SPATIAL_CHUNK_BYTES
+    nchan = dset.shape[1]
+    cols = np.arange(nchan)[sel]
+    step = sel.step
+    half = len(taps) // 2
+    lo = max(0, cols[0] - half)
+    hi = min(nchan, cols[-1] + half + 1)
+
+    #-- For each tap: the range of output channels whose neighbour is inside [lo, hi), and its weight
+    terms = []
+    wsum = np.zeros(len(cols))
+    for k, w in enumerate(taps):
+        c = cols - half + k
+        ok = np.flatnonzero((c >= lo) & (c < hi))
+        if(len(ok) == 0):
+            continue
+        j0, j1 = ok[0], ok[-1]+1
+        terms.append((w, j0, j1, slice(c[j0]-lo, c[j1-1]-lo+1, step)))
+        wsum[j0:j1] += w
+    norm = (1. if scale is None else scale) / wsum
+
+    i0 = rows.start
+    nrow = max(1, int(chunk_bytes // (8*(hi-lo))))
+    for r0 in range(0, np.shape(out)[0], nrow):
+        r1 = min(r0 + nrow, np.shape(out)[0])
+        block = dset[i0+r0:i0+r1, lo:hi].astype('float64')
+        acc = np.zeros((r1-r0, len(cols)))
+        for w, j0, j1, cs in terms:
+            acc[:, j0:j1] += w * block[:, cs]
+        out[r0:r1] = acc * norm
+    return out
+
+
+def file_in_window(headers, t_start, t_end):
+    """
+    Does a file with these headers contain any data between t_start and t_end?
+    """
+    t0 = headers['t0']
+    t1 = headers['t1']
+    ## Consider the 4 cases for requests
+    ##   t_0                                               t_1
+    ##    |***************file******************************|
+    ##
+    ## |---case1---|
+    ## ts         te
+    ##                                                    |----case2---|
+    ##                                                    ts          te
+    ##                      |---case3---|
+    ##                      ts          te
+    ##
+    ## |-------------------------------case4----------------------------|
+    ## ts                                                               te
+    ##
+    ##      # case 1 & 4                    # case 2 & 4             # case 3
+    return ( (t_start<t0 and t0<t_end) or (t_start<t1 and t1<t_end)) or (t0<t_start and t_start<t1) or (t0==t_start) or (t1==t_end)
+
+
+def time_indices(headers, t_start, t_end, filename=None, verbose=False):
+    """
+    i_pull_start, i_pull_end, tt = time_indices(headers, t_start, t_end)
+    :First and last (inclusive) sample of a file to read for the request t_start to t_end,
+    : and the relative time vector of the file.
+    """
+    t0 = headers['t0']
+    t1 = headers['t1']
+    npts = headers['npts']
+    fs = headers['fs']
+
+    tt = np.arange(0, npts/fs, 1.0/fs) 
+    #-- Initial values: full range
+    i_pull_start = 0
+    i_pull_end   = npts-1
+    
+    if(t_start>t0):    # See if we should pull less on the front end
+        t_rel = (t_start-t0).total_seconds()  
+        i_pull_start = np.argmin(np.abs(tt-t_rel))
+        if(verbose):
+            print("~~~ cut front ~~~~~~~~")
+            print(filename)
+            print("Requested start: {0}".format(t_start))
+            print("This file start: {0}".format(t0))
+            print("Starting at {0} seconds in".format(tt[i_pull_start]))
+        
+    if(t1>t_end):      # See if we should cut some off the end
+        t_rel = (t_end-t0).total_seconds()  
+        i_pull_end = np.argmin(np.abs(tt-t_rel))
+        if(verbose):
+            print("~~~ cut end   ~~~~~~~~")
+            print(filename)
+            print("Requested end: {0}".format(t_end))
+            print("This file end: {0}".format(t1))
+            print("Cutting at {0} seconds in".format(tt[i_pull_end]))                
+    return i_pull_start, i_pull_end, tt
+
+
+def select_channels(headers, d_start=0, d_end=0, ichan=[], mapchan=[], nth_channel=1, mapchan_dx=None, verbose=False):
+    """
+    sel, dd, dx = select_channels(headers, ...)
+    :What to index the channel axis of "RawData" with (a slice or an index array), the distance of
+    : each of those channels, and the channel spacing. Arguments are those of load_das_custom.
+    """
+    d0 = headers['d0']
+    d1 = headers['d1']
+    dx = headers['dx']
+    fm = headers['fm']
+
+    #-- Set up axis of distances / channels
+    #dd = np.arange(d0, d1+dx*fm, dx*fm) 
+    #dd = np.arange(d0, d1, dx*fm) 
+    #-- NOTE: The end channel location calculated this way can differ from "d1" ("StopDistance") by 
+    #--  order 0.01m, especially when accumulated over a long (>30km) fibre. Rounding erorrs?
+    #-- Possibly one would need to add/subtract one index to dd to get the dimensions correct.
+    #-- Temporary solution? Add 1/2 a sample to the end target of np.arange, to make sure the final sample is reached
+    dd = np.arange(d0, d1+dx*fm/2, dx*fm) 
+
+    #-- Did the user specify any cutting along distance axis?
+    #-- TODO: Logic is a bit rigid, requiring d_end to be specified and -then- check for nth_channel downsample.
+    #--        Surely a better way is possible...
+    if(d_end>0):
+        id1 = np.argmin(np.abs(dd-d_start))
+        id2 = np.argmin(np.abs(dd-d_end))
+        if(nth_channel>1):
+            if(verbose):
+                print("pulling every {0} traces".format(nth_channel))
+            sel = slice(id1, id2+1, nth_channel)
+            dx = dx*nth_channel
+            if(verbose):
+                print("New dx = {0}".format(dx))
+        else:
+            sel = slice(id1, id2+1)
+        dd = dd[sel]
+
+    #-- Did the user specify an array of specific indices?
+    #--   ichan would refer to the simplest, absolute index within an HDF5 block.
+    #--   mapchan considers d=0 to be index=0, thus accounting for potentially different negative distances within the iDAS.
+    elif(len(ichan)>0):
+        sel = ichan
+        dd = dd[ichan]
+
+    #--   The mapchan -> column translation is built once per epoch geometry (d0, dx, fm, nchan)
+    #--   and re-used for all other files of that epoch. See mapping/epoch_tables.py
+    elif(len(mapchan)>0):
+        table = epoch_tables.get_table(mapchan, headers, mapchan_dx=mapchan_dx)
+        sel = table.sel
+        dd = table.dd
+
+    #-- Otherwise just return all channels
+    else:
+        sel = slice(None)
+        if(verbose):
+            print("Returning all channels")
+    return sel, dd, dx
+
+
+def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], convert=False, verbose=False, input_dir='./', return_axis=True, nth_channel=1, mapchan_dx=None, dtype=None, spatial_filter=None, timeseries=True):
     """
     data, heades, axis = load_das_custom(t_start, t_end, d_start=0, d_end=0, convert=False, verbose=False, input_dir='./')
     :Custom function to load files in a flexible way. 
@@ -454,12 +708,27 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
     :mapchan -- (optional) np array of specific indices to load (not compatible with d_start/d_end) 
                 mapchan considers d=0 to be index=0, thus accounting for potentially different negative 
                 distances within the iDAS.
+    :mapchan_dx -- (optional) nominal channel spacing (m) that mapchan counts in, e.g. the chan_spacing
+                given to channel_mapping.get_mapping(). If given, files from epochs recorded with a
+                different dx are translated correctly. If None, mapchan counts in each file's own dx.
+                For exact columns in every epoch, use mapchan=mapping['i0_native'] with
+                mapchan_dx=channel_mapping.MAPPED_SPACING (see mapping/epoch_tables.py).
 
     :convert -- (optional) boolean to convert to strain rate if not already done
     :            WARNING: This requires knowing the sample rate of the raw data.
     :            If data had been downsampled but not converted, you will need to change "fs" in that conversion
+    :            Each file is scaled as it is read, into the preallocated output.
+    :dtype   -- (optional) dtype of the returned data, e.g. 'float32' to halve the memory of converted data.
+    :            Default: as stored (float64 when converting)
+    :spatial_filter -- (optional) anti-alias along the fibre when keeping every n-th channel
+    :            (nth_channel, or a mapchan with a regular step), instead of just picking channels:
+    :            "boxcar" (average of neighbouring channels) or "lowpass" (FIR at the new spatial Nyquist).
+    :            The neighbouring channels are read as contiguous blocks of rows and filtered as they come in.
+    :timeseries -- (optional) read narrow, long requests from the time-series store of input_dir
+    :            (see das_timeseries.py) when it has every file of the window. False: always read the files.
     :verbose -- (optional) boolean to print more information about what is being loaded
     :input_dir -- (optional) string of directory in which to look for data
+    :             (or a chunked store written by das_zarr, which is read directly)
     :
     :OUTPUTS:
     :data    -- 2D numpy array [ num_samples, num_channels ]
@@ -474,7 +743,32 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
     ##############################################
     ## STEP 1: Find possible files that need loading
     ##############################################
-    consider_files = make_file_list(t_start, t_end, input_dir, verbose=verbose)
+    from_store = das_zarr.is_store(input_dir)
+    if(from_store):
+        #-- One chunked store rather than many files: read the window directly
+        data, headers, dd, dx, final_t0, final_t1 = das_zarr.read_window(input_dir, t_start, t_end, d_start=d_start, d_end=d_end,
+                                                                       ichan=ichan, mapchan=mapchan, nth_channel=nth_channel,
+                                                                       mapchan_dx=mapchan_dx, verbose=verbose)
+        d0 = headers['d0']
+        d1 = headers['d1']
+        fs = headers['fs']
+        consider_files = []
+    else:
+        consider_files = make_file_list(t_start, t_end, input_dir, verbose=verbose)
+
+        #-- A few channels over a long window: one contiguous run per channel and day from the
+        #-- time-series store, rather than a strided read from every file
+        if(timeseries and spatial_filter is None and consider_files):
+            window = das_timeseries.read_window(input_dir, t_start, t_end, consider_files, d_start=d_start, d_end=d_end,
+                                                ichan=ichan, mapchan=mapchan, nth_channel=nth_channel,
+                                                mapchan_dx=mapchan_dx, verbose=verbose)
+            if(window is not None):
+                data, headers, dd, dx, final_t0, final_t1 = window
+                d0 = headers['d0']
+                d1 = headers['d1']
+                fs = headers['fs']
+                from_store = True
+                consider_files = []
 
     
     ##############################################
@@ -488,7 +782,9 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
         print("----------------------------------------------")
         
 
-    found_data_yet = False
+    #-- First only plan what to read from each file, so the output can be allocated once
+    #-- and each file read straight into its rows (no concatenation, conversion fused into the read)
+    pieces = []
     for filename in consider_files:
 
         #-- Reset containers for headers      
@@ -497,135 +793,51 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
         #-- Open the headers of each file and look at the times
         headers = load_headers_only(filename, verbose=verbose)
         t0 = headers['t0']
-        t1 = headers['t1']
-        npts = headers['npts']
-        nchan= headers['nchan']
         fs = headers['fs']
         dx = headers['dx']
-        fm = headers['fm']
         d0 = headers['d0']
         d1 = headers['d1']
 
 
-        #-- Check if either t0 or t1 (or both) lies within the desired bounds of t_start and t_end
-        #print(t_start.strftime('%Y-%m-%d %H:%M:%S.%f'))
-        #print(t_end.strftime('%Y-%m-%d %H:%M:%S.%f'))
-        #print(t0.strftime('%Y-%m-%d %H:%M:%S.%f'))
-        #print(t1.strftime('%Y-%m-%d %H:%M:%S.%f'))
-        ## Do we use any of the data in this file? Consider the 4 cases for requests
-        ##   t_0                                               t_1
-        ##    |***************file******************************|
-        ##
-        ## |---case1---|
-        ## ts         te
-        ##                                                    |----case2---|
-        ##                                                    ts          te
-        ##                      |---case3---|
-        ##                      ts          te
-        ##
-        ## |-------------------------------case4----------------------------|
-        ## ts                                                               te
-        ##
-        ##      # case 1 & 4                    # case 2 & 4             # case 3
-        if( (t_start<t0 and t0<t_end) or (t_start<t1 and t1<t_end)) or (t0<t_start and t_start<t1) or (t0==t_start) or (t1==t_end):
+        #-- Do we use any of the data in this file?
+        if(file_in_window(headers, t_start, t_end)):
             if(verbose):
                 print("Use it!")
             
             #-- Define the time index from which to pull
-            tt = np.arange(0, npts/fs, 1.0/fs) 
-            #-- Initial values: full range
-            i_pull_start = 0
-            i_pull_end   = npts-1
-            
-            if(t_start>t0):    # See if we should pull less on the front end
-                t_rel = (t_start-t0).total_seconds()  
-                i_pull_start = np.argmin(np.abs(tt-t_rel))
-                if(verbose):
-                    print("~~~ cut front ~~~~~~~~")
-                    print(filename)
-                    print("Requested start: {0}".format(t_start))
-                    print("This file start: {0}".format(t0))
-                    print("Starting at {0} seconds in".format(tt[i_pull_start]))
-                
-            if(t1>t_end):      # See if we should cut some off the end
-                t_rel = (t_end-t0).total_seconds()  
-                i_pull_end = np.argmin(np.abs(tt-t_rel))
-                if(verbose):
-                    print("~~~ cut end   ~~~~~~~~")
-                    print(filename)
-                    print("Requested end: {0}".format(t_end))
-                    print("This file end: {0}".format(t1))
-                    print("Cutting at {0} seconds in".format(tt[i_pull_end]))                
+            i_pull_start, i_pull_end, tt = time_indices(headers, t_start, t_end, filename=filename, verbose=verbose)
             
-            #-- Set up axis of distances / channels
-            #dd = np.arange(d0, d1+dx*fm, dx*fm) 
-            #dd = np.arange(d0, d1, dx*fm) 
-            #-- NOTE: The end channel location calculated this way can differ from "d1" ("StopDistance") by 
-            #--  order 0.01m, especially when accumulated over a long (>30km) fibre. Rounding erorrs?
-            #-- Possibly one would need to add/subtract one index to dd to get the dimensions correct.
-            #-- Temporary solution? Add 1/2 a sample to the end target of np.arange, to make sure the final sample is reached
-            dd = np.arange(d0, d1+dx*fm/2, dx*fm) 
-
-            #-- Open the file again for actual reading of data
-            with h5py.File(filename, "r") as f:
-                #-- Did the user specify any cutting along distance axis?
-                #-- TODO: Logic is a bit rigid, requiring d_end to be specified and -then- check for nth_channel downsample.
-                #--        Surely a better way is possible...
-                if(d_end>0):
-                    id1 = np.argmin(np.abs(dd-d_start))
-                    id2 = np.argmin(np.abs(dd-d_end))
-                    if(nth_channel>1):
-                        d_pull = np.arange(id1,id2+1)
-                        d_pull = d_pull[::nth_channel]
-                        if(verbose):
-                            print("pulling every {0} traces".format(nth_channel))
-                        data_tmp = f["Acquisition/Raw[0]/RawData"][i_pull_start:i_pull_end+1, d_pull]
-                        dd = dd[d_pull]
-                        dx = dx*nth_channel
-                        if(verbose):
-                            print("New dx = {0}".format(dx))
-                    else:
-                        data_tmp = f["Acquisition/Raw[0]/RawData"][i_pull_start:i_pull_end+1, id1:id2+1]
-                        dd = dd[id1:id2+1]
-
-                    if(verbose):
-                        print("Returning channels over distances: {0}  --  {1}".format(dd[0],dd[-1]))
-                        print("data: {0} x {1},  dd: {2}".format(np.shape(data_tmp)[0],np.shape(data_tmp)[1],np.shape(dd)))
-
-                #-- Did the user specify an array of specific indices?
-                #--   ichan would refer to the simplest, absolute index within an HDF5 block.
-                #--   mapchan considers d=0 to be index=0, thus accounting for potentially different negative distances within the iDAS.
-                elif(len(ichan)>0):
-                    dd = dd[ichan]
-                    data_tmp = f["Acquisition/Raw[0]/RawData"][i_pull_start:i_pull_end+1, ichan]
-
-                elif(len(mapchan)>0):
-                    zero_correct = -int(np.round(headers['d0'] / (headers['dx']*headers['fm'])))
-                    dd = dd[mapchan+zero_correct].astype(int)
-                    data_tmp = f["Acquisition/Raw[0]/RawData"][i_pull_start:i_pull_end+1, mapchan+zero_correct]
-
-
-                #-- Otherwise just return all channels
-                else:
-                    data_tmp = f["Acquisition/Raw[0]/RawData"][i_pull_start:i_pull_end+1,:]
-                    if(verbose):
-                        print("Returning all channels")
-                
-            # See if we've defined data yet, otherwise concatenate with previous
-            if(found_data_yet == False):
-                data = data_tmp
+            #-- Which channels (HDF5 columns) to read, and their distances
+            sel, dd, dx = select_channels(headers, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                          nth_channel=nth_channel, mapchan_dx=mapchan_dx, verbose=verbose)
+            if(verbose and d_end>0):
+                print("Returning channels over distances: {0}  --  {1}".format(dd[0],dd[-1]))
+
+            scale = strain_rate_scale(headers, verbose=verbose) if convert==True else None
+            taps = spatial_selection(sel, spatial_filter)
+            pieces.append((filename, slice(i_pull_start, i_pull_end+1), sel, len(dd), scale, taps))
+
+            if(len(pieces) == 1):
                 final_t0 = t0 + timedelta(seconds=tt[i_pull_start])
-                final_t1 = t0 + timedelta(seconds=tt[i_pull_end])
-                found_data_yet = True
+            final_t1 = t0 + timedelta(seconds=tt[i_pull_end])
+
+    #-- Now read every piece into its rows of the output
+    i0 = 0
+    ntotal = sum(rows.stop - rows.start for filename, rows, sel, ncol, scale, taps in pieces)
+    for filename, rows, sel, ncol, scale, taps in pieces:
+        with h5py.File(filename, "r") as f:
+            dset = f["Acquisition/Raw[0]/RawData"]
+            if(i0 == 0):
+                data = np.empty((ntotal, ncol), dtype=output_dtype(dset.dtype, scale is not None or taps is not None, dtype))
+            if(ncol != np.shape(data)[1]):
+                raise ValueError("{0} has {1} channels selected, previous files had {2}".format(filename, ncol, np.shape(data)[1]))
+            if(taps is not None):
+                read_spatial(dset, rows, sel, data[i0:i0+rows.stop-rows.start], taps, scale=scale)
             else:
-                data = np.concatenate((data,data_tmp))
-                final_t1 = t0 + timedelta(seconds=tt[i_pull_end])
-                
-            #print(np.shape(data))
-            # NOTE, growing large arrays like this is slow.
-            # Better would be to determine all the useful times, 
-            #  init an emtpy array of the correct size,
-            #  and then fill elements
+                read_scaled(dset, rows, sel, data[i0:i0+rows.stop-rows.start], scale=scale)
+        i0 += rows.stop - rows.start
+    if(len(pieces) > 0 and pieces[-1][4] is not None):
+        mark_converted(headers, pieces[-1][4], verbose=verbose)
                 
                 
     #print(final_t0)
@@ -648,10 +860,7 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
     headers['t1'] = final_t1
     headers['npts'] = np.shape(data)[0]
     headers['nchan'] = np.shape(data)[1]
-    if(d_end>0 and nth_channel > 0):
-        dx = dx*nth_channel
-        if(verbose):
-            print("New dx = {0}".format(dx))
+    #-- (dx from select_channels already includes nth_channel)
     headers['dx'] = dx
 
 
@@ -690,33 +899,13 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
         print(headers)
 
 
-    #-- Convert everything
-    if(convert==True):
-        #-- DCB note: Silixa raw PRODML files report units as strain rate, even when 
-        #--  the following conversion has not yet been applied. Up to the user to mark 
-        #--  whether data has actually been converted yet or not...
-        #-- We started writing a custom header defining any amplitude scaling that has been 
-        #--  applied (i.e., 1.0 if no scaling, some number otherwise)
-        scale = True
-        if('amp_scaling' in headers):
-            #-- Check if amplitude has been scaled yet or is still 1.0
-            #--  (close to 1.0, possible rounding errors with read/write)
-            if(np.abs(headers['amp_scaling']-1.0)>0.0001):
-                 print("WARNING: flag \"convert\" is TRUE, but units are already scaled somehow")
-                 print("   Doing nothing regarding conversion.")
-                 scale = False
-        if(scale==True):
-            #-- DCB note: the sample rate (fs) used below is the ORIGINAL sample rate
-            #--  at which data is recorded. If files have been downsampled, use the custom
-            #--  header['fs_orig']
-            if('fs_orig' in headers.keys()):
-               fs = headers['fs_orig']
-
-            data = 116. * data / 8192. * fs / 10. 
-            headers['amp_scaling'] = 116. / 8192. * fs / 10.
-            headers['unit'] = '(nm/m)/s'
-            if(verbose):
-                print("Converted to strain rate!")
+    #-- Convert a chunked store's data (HDF5 files were converted while reading, above)
+    if(from_store):
+        scale = strain_rate_scale(headers, verbose=verbose) if convert==True else None
+        data = data.astype(output_dtype(data.dtype, scale is not None, dtype), copy=False)
+        if(scale is not None):
+            data *= scale
+            mark_converted(headers, scale, verbose=verbose)
 
     if(return_axis):
         return data, headers, axis
@@ -724,3 +913,57 @@ def load_das_custom(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], co
         return data, headers
 
 
+def stream_das(t_start, t_end, d_start=0, d_end=0, ichan=[], mapchan=[], convert=False, verbose=False, input_dir='./', nth_channel=1, mapchan_dx=None, dtype=None, spatial_filter=None):
+    """
+    for data, headers, axis in load_das_h5.stream_das(t_start, t_end, input_dir="path/to/dir/"):
+        ...
+    :
+    :Same request as load_das_custom(), but yields the data file by file instead of
+    : concatenating everything, so arbitrarily long time ranges can be processed 
+    : with the memory of a single file. Files are yielded in time order, each cut to 
+    : the requested window.
+    :
+    :OUTPUTS (per file):
+    :data    -- 2D numpy array [ num_samples, num_channels ]
+    :headers -- dict of header information, updated to this piece of data
+    :axis    -- dict with 'dd' (channel distances) and 'tt' (seconds since headers['t0'])
+    :            (no 'date_times', which is slow to build for every file)
+    """
+    consider_files = make_file_list(t_start, t_end, input_dir, verbose=verbose)
+    if(consider_files is None):
+        return
+
+    for filename in consider_files:
+        headers = load_headers_only(filename, verbose=verbose)
+        if(not file_in_window(headers, t_start, t_end)):
+            continue
+
+        i_pull_start, i_pull_end, tt = time_indices(headers, t_start, t_end, filename=filename, verbose=verbose)
+        sel, dd, dx = select_channels(headers, d_start=d_start, d_end=d_end, ichan=ichan, mapchan=mapchan,
+                                      nth_channel=nth_channel, mapchan_dx=mapchan_dx, verbose=verbose)
+        scale = strain_rate_scale(headers, verbose=verbose) if convert==True else None
+        taps = spatial_selection(sel, spatial_filter)
+        with h5py.File(filename, "r") as f:
+            dset = f["Acquisition/Raw[0]/RawData"]
+            data = np.empty((i_pull_end+1-i_pull_start, len(dd)), dtype=output_dtype(dset.dtype, scale is not None or taps is not None, dtype))
+            if(taps is not None):
+                read_spatial(dset, slice(i_pull_start, i_pull_end+1), sel, data, taps, scale=scale)
+            else:
+                read_scaled(dset, slice(i_pull_start, i_pull_end+1), sel, data, scale=scale)
+
+        t0 = headers['t0']
+        headers['t0'] = t0 + timedelta(seconds=tt[i_pull_start])
+        headers['t1'] = t0 + timedelta(seconds=tt[i_pull_end])
+        headers['npts'] = np.shape(data)[0]
+        headers['nchan'] = np.shape(data)[1]
+        headers['d0'] = dd[0]
+        headers['d1'] = dd[-1]
+        headers['dx'] = dx
+        if(scale is not None):
+            mark_converted(headers, scale, verbose=verbose)
+
+        axis = dict()
+        axis['dd'] = dd
+        axis['tt'] = np.arange(np.shape(data)[0]) / headers['fs']
+        yield data, headers, axis
+
@@ -0,0 +1,325 @@
+"""
+Per-file, per-channel quality-control summaries, computed once when files are
+ingested and queried later without touching the raw data again: finding noisy
+periods or dead channels over a week then only reads a few small arrays.
+
+For each file and channel:
+    mean    -- mean value
+    rms     -- RMS after removing the mean
+    maxabs  -- largest absolute value
+    nclip   -- number of samples at or beyond the clipping level
+    band    -- mean-square amplitude in each frequency band of BANDS [ nband per channel ]
+               (the bands add up to rms**2 if they cover 0 -- fs/2)
+
+All files of an input_dir are kept in one HDF5 file (QC_NAME, next to the header
+index of header_index.py), one row per file, so a query is one read of a block
+of rows. Channels beyond a file's nchan are NaN. Rows are updated when a file's
+size or modification time changes. Only one process should write at a time.
+
+Example:
+    qc = qc_stats.get_qc(input_dir)
+    qc.update(t_start, t_end)                            # ingest (only new or changed files are read)
+    files, t0, rms = qc.query("rms", t_start, t_end, chan=slice(1000, 2000))
+    rms_week = qc.channel_rms(t_start, t_end, chan=slice(1000, 2000))
+    dead = qc.dead_files(1500, t_start, t_end)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import load_das_h5
+from pydas_readers.util import fft_backend
+
+QC_NAME = ".pydas_qc.h5"
+DATASET = "Acquisition/Raw[0]/RawData"
+
+#-- Default frequency bands (Hz) for the band energies; the last band is cut at fs/2
+BANDS = ((0.01, 1.), (1., 10.), (10., 100.))
+STATS = ("mean", "rms", "maxabs", "nclip")
+
+#-- Channels per piece while computing (bounds the float64 copy of a file)
+CHUNK_CHANNELS = 512
+#-- HDF5 chunk shape of the stored rows [ files, channels ]
+ROW_CHUNKS = (64, 1024)
+
+_EPOCH = datetime(1970, 1, 1)
+
+#-- QC stores already opened in this process, by path
+_STORES = dict()
+
+
+def get_qc(input_dir, path=None):
+    """ The (cached) QCStats of an input directory; path defaults to input_dir/QC_NAME """
+    if(path is None):
+        path = os.path.join(os.path.abspath(input_dir), QC_NAME)
+    if(path not in _STORES):
+        _STORES[path] = QCStats(input_dir, path)
+    return _STORES[path]
+
+
+def compute_stats(data, fs, bands=BANDS, clip=None):
+    """
+    stats = qc_stats.compute_stats(data, fs)
+    :Summaries of a block [ npts, nchan ], one value per channel (see the top of this file).
+    :param clip: clipping level in raw units. Default: the largest value of an integer dtype;
+                 for float data nclip is only counted if clip is given.
+    """
+    npts, nchan = np.shape(data)
+    if(clip is None and np.issubdtype(data.dtype, np.integer)):
+        clip = np.iinfo(data.dtype).max
+    freqs = fft_backend.rfftfreq(npts, 1./fs)
+    #-- One-sided spectrum: every bin but DC (and Nyquist for even npts) counts twice
+    weight = np.full(len(freqs), 2.)
+    weight[0] = 1.
+    if(npts % 2 == 0):
+        weight[-1] = 1.
+    weight /= npts**2
+
+    stats = dict((k, np.empty(nchan)) for k in STATS)
+    stats['band'] = np.empty((len(bands), nchan))
+    for c0 in range(0, nchan, CHUNK_CHANNELS):
+        c1 = min(c0 + CHUNK_CHANNELS, nchan)
+        x = np.asarray(data[:, c0:c1], dtype='float64')
+        stats['maxabs'][c0:c1] = np.max(np.abs(x), axis=0)
+        stats['nclip'][c0:c1] = np.count_nonzero(np.abs(x) >= clip, axis=0) if clip is not None else 0
+        mean = np.mean(x, axis=0)
+        stats['mean'][c0:c1] = mean
+        x -= mean
+        stats['rms'][c0:c1] = np.sqrt(np.mean(x**2, axis=0))
+        power = np.abs(fft_backend.rfft(x, axis=0))**2 * weight[:, None]
+        for ib, (fmin, fmax) in enumerate(bands):
+            band = (freqs >= fmin) & (freqs < fmax) if fmax < fs/2 else (freqs >= fmin)
+            stats['band'][ib, c0:c1] = np.sum(power[band], axis=0)
+    return stats
+
+
+def _seconds(t):
+    return (t - _EPOCH).total_seconds()
+
+
+class QCStats(object):
+    """
+    qc = QCStats(input_dir, path)
+
+    The QC summaries of every ingested file of input_dir, stored in the HDF5 file "path".
+    Filenames are kept relative to input_dir.
+    """
+
+    def __init__(self, input_dir, path):
+        self.root = os.path.abspath(input_dir)
+        self.path = path
+        self._rows = None       # filename -> row, read from the store when first needed
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+    def _row_index(self, f):
+        #-- Re-read if another process added files since
+        nrow = len(f["files"]) if "files" in f else 0
+        if(self._rows is None or len(self._rows) != nrow):
+            self._rows = dict()
+            if(nrow > 0):
+                self._rows = dict((k.decode() if isinstance(k, bytes) else k, i) for i, k in enumerate(f["files"][:]))
+        return self._rows
+
+    def __len__(self):
+        if(not os.path.exists(self.path)):
+            return 0
+        with h5py.File(self.path, "r") as f:
+            return len(f["files"]) if "files" in f else 0
+
+    def _create(self, f, bands, nchan):
+        f.attrs['bands'] = np.array(bands, dtype='float64')
+        f.create_dataset("files", (0,), maxshape=(None,), dtype=h5py.string_dtype())
+        for name in ("t0", "t1", "fs", "d0", "dx", "mtime"):
+            f.create_dataset(name, (0,), maxshape=(None,), dtype='float64')
+        for name in ("npts", "nchan", "size"):
+            f.create_dataset(name, (0,), maxshape=(None,), dtype='int64')
+        chunks = (ROW_CHUNKS[0], min(ROW_CHUNKS[1], nchan))
+        for name in STATS:
+            f.create_dataset(name, (0, nchan), maxshape=(None, None), dtype='float32', chunks=chunks, fillvalue=np.nan)
+        f.create_dataset("band", (0, len(bands), nchan), maxshape=(None, len(bands), None), dtype='float32',
+                         chunks=(ROW_CHUNKS[0], 1, chunks[1]), fillvalue=np.nan)
+
+    def add(self, filename, data, headers, bands=BANDS, clip=None, stat=None, verbose=False):
+        """
+        qc.add(filename, data, headers)
+        :Store the summaries of a file whose (full, unselected) data block is already in memory.
+        """
+        stats = compute_stats(data, headers['fs'], bands=bands, clip=clip)
+        stat = stat if stat is not None else os.stat(filename)
+        nchan = np.shape(data)[1]
+
+        with h5py.File(self.path, "a") as f:
+            if("files" not in f):
+                self._create(f, bands, nchan)
+            if(not np.allclose(f.attrs['bands'], np.array(bands, dtype='float64'))):
+                raise ValueError("QC store {0} was made with bands {1}".format(self.path, f.attrs['bands'].tolist()))
+            rows = self._row_index(f)
+            key = self._key(filename)
+            i = rows.get(key)
+            if(i is None):
+                i = len(f["files"])
+                for name in f:
+                    f[name].resize(i+1, axis=0)
+                rows[key] = i
+            if(f["rms"].shape[1] < nchan):
+                for name in STATS:
+                    f[name].resize(nchan, axis=1)
+                f["band"].resize(nchan, axis=2)
+
+            f["files"][i] = key
+            f["t0"][i] = _seconds(headers['t0'])
+            f["t1"][i] = _seconds(headers['t1'])
+            f["fs"][i] = headers['fs']
+            f["d0"][i] = headers['d0']
+            f["dx"][i] = headers['dx']
+            f["npts"][i] = np.shape(data)[0]
+            f["nchan"][i] = nchan
+            f["mtime"][i] = stat.st_mtime
+            f["size"][i] = stat.st_size
+            for name in STATS:
+                f[name][i, :nchan] = stats[name]
+            f["band"][i, :, :nchan] = stats['band']
+        if(verbose):
+            print("QC stats of {0} stored".format(filename))
+
+    def update(self, t_start=None, t_end=None, files=None, bands=BANDS, clip=None, verbose=False):
+        """
+        qc.update(t_start, t_end)  or  qc.update(files=[...])
+        :Ingest: compute the summaries of every file in the window (or in the list)
+        :that is not in the store yet or has changed since. Returns the number of files read.
+        """
+        if(files is None):
+            files = load_das_h5.make_file_list(t_start, t_end, self.root, verbose=verbose) or []
+        stored = self._stored()
+        nread = 0
+        for filename in files:
+            stat = os.stat(filename)
+            if(stored.get(self._key(filename)) == (stat.st_mtime, stat.st_size)):
+                continue
+            headers = load_das_h5.load_headers_only(filename, verbose=verbose)
+            if(t_start is not None and t_end is not None and not load_das_h5.file_in_window(headers, t_start, t_end)):
+                continue
+            with h5py.File(filename, "r") as f:
+                data = f[DATASET][:]
+            self.add(filename, data, headers, bands=bands, clip=clip, stat=stat, verbose=verbose)
+            nread += 1
+        return nread
+
+    def _stored(self):
+        """ filename -> (mtime, size) of every stored row """
+        if(not os.path.exists(self.path)):
+            return dict()
+        with h5py.File(self.path, "r") as f:
+            if("files" not in f):
+                return dict()
+            rows = self._row_index(f)
+            mtime = f["mtime"][:]
+            size = f["size"][:]
+        return dict((k, (mtime[i], size[i])) for k, i in rows.items())
+
+    def bands(self):
+        with h5py.File(self.path, "r") as f:
+            return [tuple(b) for b in f.attrs['bands']]
+
+    def query(self, stat, t_start=None, t_end=None, chan=None, band=None):
+        """
+        files, t0, values = qc.query("rms", t_start, t_end, chan=slice(1000, 2000))
+
+        :param stat: one of "mean", "rms", "maxabs", "nclip", "band", or a per-file field
+                     ("fs", "npts", "nchan", "d0", "dx")
+        :param t_start, t_end: files overlapping this window (default: all)
+        :param chan: channel index, slice or list of channels (default: all)
+        :param band: for "band", index into the bands (default: all bands)
+        :return: filenames and start times (sorted by time), values [ nfile, nchan ]
+                 ("band" with band=None: [ nfile, nband, nchan ])
+        """
+        if(not os.path.exists(self.path)):
+            return [], [], np.zeros((0, 0))
+        with h5py.File(self.path, "r") as f:
+            if("files" not in f):
+                return [], [], np.zeros((0, 0))
+            t0 = f["t0"][:]
+            t1 = f["t1"][:]
+            keep = np.ones(len(t0), dtype=bool)
+            if(t_start is not None):
+                keep &= t1 >= _seconds(t_start)
+            if(t_end is not None):
+                keep &= t0 <= _seconds(t_end)
+            rows = np.flatnonzero(keep)
+            if(len(rows) == 0):
+                return [], [], np.zeros((0, 0))
+
+            #-- One read of the block of rows between the first and last match
+            r0, r1 = rows[0], rows[-1]+1
+            dset = f[stat]
+            if(dset.ndim == 1):
+                values = dset[r0:r1]
+            else:
+                if(chan is None):
+                    chan = slice(None)
+                elif(np.ndim(chan) == 0 and not isinstance(chan, slice)):
+                    chan = slice(int(chan), int(chan)+1)
+                #-- h5py reads slices directly; channel lists are picked from the block in memory
+                if(stat == "band"):
+                    key = (slice(r0, r1), slice(None) if band is None else band)
+                else:
+                    key = (slice(r0, r1),)
+                if(isinstance(chan, slice)):
+                    values = dset[key + (chan,)]
+                else:
+                    values = dset[key][..., chan]
+            values = values[rows - r0]
+            files = f["files"][r0:r1][rows - r0]
+
+        order = np.argsort(t0[rows], kind='stable')
+        files = [os.path.join(self.root, k.decode() if isinstance(k, bytes) else k) for k in files[order]]
+        times = [_EPOCH + timedelta(seconds=s) for s in t0[rows][order]]
+        return files, times, values[order]
+
+    def channel_rms(self, t_start=None, t_end=None, chan=None):
+        """
+        rms = qc.channel_rms(t_start, t_end, chan=slice(1000, 2000))
+        :RMS of each channel over the whole window, combined from the per-file values
+        :(weighted by the number of samples of each file).
+        """
+        files, times, rms = self.query("rms", t_start, t_end, chan=chan)
+        if(len(files) == 0):
+            return np.zeros(0)
+        _, _, npts = self.query("npts", t_start, t_end)
+        ms = np.nansum(rms.astype('float64')**2 * npts[:, None], axis=0)
+        n = np.sum(np.isfinite(rms) * npts[:, None], axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(ms / n)
+
+    def dead_files(self, channel, t_start=None, t_end=None, level=None):
+        """
+        files = qc.dead_files(channel, t_start, t_end)
+        :Files in which a channel was dead: RMS at or below level. Default level: 1% of the
+        :median RMS over all channels of that file.
+        """
+        files, times, rms = self.query("rms", t_start, t_end)
+        if(len(files) == 0):
+            return []
+        ref = level if level is not None else 0.01 * np.nanmedian(rms, axis=1)
+        dead = rms[:, channel] <= ref
+        return [f for f, d in zip(files, dead) if d]
+
+    def dead_channels(self, t_start=None, t_end=None, level=None, fraction=0.5):
+        """
+        channels = qc.dead_channels(t_start, t_end)
+        :Channels that were dead (see dead_files) in at least this fraction of the files in the window.
+        """
+        files, times, rms = self.query("rms", t_start, t_end)
+        if(len(files) == 0):
+            return np.zeros(0, dtype=int)
+        ref = level if level is not None else 0.01 * np.nanmedian(rms, axis=1)[:, None]
+        dead = np.mean(rms <= ref, axis=0)
+        return np.flatnonzero(dead >= fraction)
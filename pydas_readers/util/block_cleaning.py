@@ -1,4 +1,3 @@
-import scipy.signal as ss
 import numpy as np
 from datetime import datetime, timedelta
 import glob
@@ -6,6 +5,8 @@ import pathlib
 import sys
 import os
 
+from pydas_readers.util import parallel
+
 def taper(data, taper_ratio=0.01):
     """
     Taper both edges of timeseries
@@ -33,14 +34,19 @@ def taper(data, taper_ratio=0.01):
     return data
 
 
-def demean(data):
+def demean(data, workers=None):
     """
     Demean each individual trace separately
 
     :param data: Data to remove mean. 2D numpy array [ npts, nchan ]
                   OR a 1D numpy array [ npts, ]
+    :param workers: process chunks of channels in parallel on this many threads
+                  (-1: all cores, default: one), see parallel.run_channels()
     :return: demeaned data
     """
+    if(parallel.get_workers(workers) > 1):
+        return parallel.run_channels(demean, data, workers=workers)
+
     vector_input = False
     if(data.ndim==1):
         vector_input = True
@@ -49,23 +55,27 @@ def demean(data):
     if(data.dtype!="float64"):
         data = data.astype('float64')
 
-    for i in range(np.shape(data)[1]):
-        data[:,i] = data[:,i] - np.mean(data[:,i])
+    data -= np.mean(data, axis=0)[None,:]
 
     if(vector_input):
         return np.squeeze(data)
     else:
         return data
 
-def detrend(data, type='linear'):
+def detrend(data, type='linear', workers=None):
     """
     Detrend each individual trace separately
 
     :param data: Data to taper. 2D numpy array [ npts, nchan ]
                   OR a 1D numpy array [ npts, ]
     :param type: type of detrending, now only linear or simple
+    :param workers: process chunks of channels in parallel on this many threads
+                  (-1: all cores, default: one), see parallel.run_channels()
     :return: detrended data
     """
+    if(parallel.get_workers(workers) > 1):
+        return parallel.run_channels(detrend, data, type=type, workers=workers)
+
     vector_input = False
     if(data.ndim==1):
         vector_input = True
@@ -78,28 +88,47 @@ def detrend(data, type='linear'):
     
     ###################
     if type == 'linear':
-        for i in range(np.shape(data)[1]):
-            data[:,i] = ss.detrend(data[:,i])
+        import scipy.signal as ss
+        data[:] = ss.detrend(data, axis=0)
         
     ###################
     if type == 'simple':
-        for i in range(np.shape(data)[1]):
-            x1, x2 = data[0,i], data[-1,i]
-            data[:,i] -= x1 + np.arange(npts) * (x2 - x1) / float(npts-1)
+        x1, x2 = data[0,:].copy(), data[-1,:].copy()
+        data -= x1[None,:] + np.arange(npts)[:,None] * (x2 - x1)[None,:] / float(npts-1)
             
     if(vector_input):
         return np.squeeze(data)
     else:
         return data
     
-def trim(data, t_start, t_end, headers, axis=[]):
+def sample_index(t, t0, fs):
     """
-    Detrend each individual trace separately.
-    Performs deepcopies - more memory but safer.
-    
-    Simply rounds to the nearest sample. 
-     (See obspy documentation for how this could be improved in the future: 
-      https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.trim.html)
+    Index of the sample nearest to time t, for a block starting at t0 with sample rate fs.
+    Computed from whole microseconds, so it doesn't drift for long blocks.
+    """
+    us = (t - t0) // timedelta(microseconds=1)
+    return int(np.floor(us * fs / 1e6 + 0.5))
+
+
+def sample_time(t0, i, fs):
+    """
+    Time of sample i of a block starting at t0 (to the microsecond, exact for integer fs).
+    """
+    i = int(i)
+    if(float(fs).is_integer()):
+        fs = int(fs)
+        return t0 + timedelta(microseconds=(2*i*1000000 + fs) // (2*fs))
+    return t0 + timedelta(microseconds=round(i * 1e6 / fs))
+
+
+def trim(data, t_start, t_end, headers, axis=[], copy=True):
+    """
+    Cut a block to the samples nearest t_start up to (not including) t_end.
+    Returns a copy as it always has; with copy=False a view of data instead
+    (nothing is copied, but writing to it changes data too).
+
+    Sample indices are computed from whole microseconds (sample_index), and the
+    new t0 / t1 are the times of the first / last sample kept, not t_start itself.
 
     :param data: Data to trim. 2D numpy array [ npts, nchan ]
     :param t_start: python datetime object for start
@@ -108,40 +137,185 @@ def trim(data, t_start, t_end, headers, axis=[]):
     :optional param axis: dict of pre-computed axis vectors
       (actually the function doesn't need "axis", but if you pass it,
        the function will update it for you)
+    :param copy: return a copy (default) or, if False, a view of data
     :return: data, headers [, axis]
     """
-    
-
     t0 = headers['t0']
     fs = headers['fs']
+    npts = np.shape(data)[0]
 
-    trim0 = round((t_start - t0).total_seconds() * fs)
-    trim1 = round((t_end   - t0).total_seconds() * fs)
+    trim0 = min(max(sample_index(t_start, t0, fs), 0), npts)
+    trim1 = min(max(sample_index(t_end, t0, fs), trim0), npts)
 
-    # Update headers
-    # This is imprecise: t0 is set to whatever was input, 
-    #  ignoring rounding differences to actual samples
-    # TODO: figure out exact rounding error and adjust:
-    ## print(  ((t_start - t0).total_seconds() * fs) - trim0)    
     headers2 = headers.copy()
-    headers2['t0'] = t_start
+    headers2['t0'] = sample_time(t0, trim0, fs)
+    headers2['t1'] = sample_time(t0, trim1-1, fs)
     headers2['npts'] = trim1-trim0
-    
+
+    out = data[trim0:trim1]
+    if(copy):
+        out = out.copy()
+
     if(len(axis)>0):
         axis2 = axis.copy()
         
-        # Better estimate of t0 if "axis" was given
-        headers2['t0'] = axis['date_times'][trim0]
-        
         # Update the timing axis 
         axis2['tt'] = axis['tt'][trim0:trim1]
-        axis2['date_times'] = axis['date_times'][trim0:trim1]
+        if('date_times' in axis):
+            axis2['date_times'] = axis['date_times'][trim0:trim1]
         
-        return data[trim0:trim1, :].copy(), headers2, axis2
+        return out, headers2, axis2
+    else:
+        return out, headers2
+
+
+def sliding_windows(data, nsamp, step=None, headers=None):
+    """
+    wins = sliding_windows(data, nsamp, step)
+    wins, t0s = sliding_windows(data, nsamp, step, headers)
+
+    All windows of nsamp samples, every step samples, as one read-only strided view
+    [ nwin, nsamp, nchan ] of data (no copy; np.array(wins) makes one). Incomplete
+    windows at the end are left out.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param nsamp: samples per window
+    :param step: samples between window starts (default: nsamp, no overlap)
+    :param headers: (optional) if given, also return the exact start time of each window
+    """
+    step = nsamp if step is None else step
+    npts = np.shape(data)[0]
+    nwin = max(0, (npts - nsamp) // step + 1)
+    s0, s1 = data.strides
+    wins = np.lib.stride_tricks.as_strided(data, shape=(nwin, nsamp, np.shape(data)[1]),
+                                           strides=(step*s0, s0, s1), writeable=False)
+    if(headers is None):
+        return wins
+    return wins, [sample_time(headers['t0'], i*step, headers['fs']) for i in range(nwin)]
+
+
+def extract_windows(data, t_starts, nsamp, headers, out=None):
+    """
+    wins, t0s = extract_windows(data, t_starts, nsamp, headers)
+
+    Windows of nsamp samples starting at the samples nearest each of t_starts
+    (e.g. event times), gathered in one go into an array [ nwin, nsamp, nchan ].
+    Windows that would run off either end of the block raise a ValueError.
+
+    :param out: (optional) array [ nwin, nsamp, nchan ] to fill, e.g. a batch buffer that is re-used
+    :return: windows and the exact start time of each
+    """
+    npts = np.shape(data)[0]
+    i0 = np.array([sample_index(t, headers['t0'], headers['fs']) for t in t_starts], dtype=int)
+    bad = (i0 < 0) | (i0 + nsamp > npts)
+    if(np.any(bad)):
+        raise ValueError("Windows starting at {0} are not inside the block".format([t_starts[i] for i in np.flatnonzero(bad)]))
+
+    if(out is None):
+        out = np.empty((len(i0), nsamp, np.shape(data)[1]), dtype=data.dtype)
+
+    #-- Regularly spaced starts are copied from a strided view, anything else is one gather
+    steps = np.unique(np.diff(i0))
+    if(len(i0) > 1 and len(steps) == 1 and steps[0] > 0):
+        out[...] = sliding_windows(data[i0[0]:], nsamp, int(steps[0]))[:len(i0)]
     else:
-        return data[trim0:trim1, :].copy(), headers2
+        np.take(data, i0[:, None] + np.arange(nsamp)[None, :], axis=0, out=out)
+    return out, [sample_time(headers['t0'], i, headers['fs']) for i in i0]
+
+
+#-- Rows per piece in remove_common_mode: a few MB, so a piece stays in cache while it is partitioned
+COMMON_MODE_CHUNK_BYTES = 2**22
+
+
+def _central_value(block, method, trim):
+    """ Median / mean / trimmed mean of each row of block [ nrow, n ] """
+    n = np.shape(block)[1]
+    if(method == "median"):
+        return np.median(block, axis=1)
+    elif(method == "mean"):
+        return np.mean(block, axis=1)
+    elif(method == "trimmed"):
+        k = int(trim * n)
+        if(k == 0 or n - 2*k < 1):
+            return np.mean(block, axis=1)
+        part = np.partition(block, (k, n-k-1), axis=1)
+        return np.mean(part[:, k:n-k], axis=1)
+    raise ValueError("Unknown method: {0}".format(method))
+
+
+def common_mode_windows(nchan, window=None, step=None):
+    """
+    starts, width, assign = common_mode_windows(nchan, window, step)
+    :Windows of channels for remove_common_mode: their first channels and width, and for each
+    : channel the window whose centre is nearest.
+    """
+    if(window is None or window >= nchan):
+        return np.array([0]), nchan, np.zeros(nchan, dtype=int)
+    step = max(1, window // 2) if step is None else step
+    starts = np.arange(0, nchan - window + 1, step)
+    if(starts[-1] != nchan - window):
+        starts = np.append(starts, nchan - window)
+    centres = starts + (window - 1) / 2.
+    #-- Nearest centre: the boundaries between windows are half way between centres
+    assign = np.searchsorted((centres[1:] + centres[:-1]) / 2., np.arange(nchan))
+    return starts, window, assign
+
+
+def remove_common_mode(data, method="median", window=None, step=None, trim=0.1, inplace=False, return_common=False, workers=None):
+    """
+    Remove the signal common to all channels (interrogator / laser noise): at each sample,
+    the median (or mean, or trimmed mean) across channels is subtracted from every channel.
+
+    The block is done a few rows at a time (COMMON_MODE_CHUNK_BYTES), over the contiguous
+    channel axis, so each piece stays in cache.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param method: "median", "mean" or "trimmed" (mean of the channels between the trim and
+                  1-trim quantiles)
+    :param window: (optional) number of channels: estimate the common mode in windows of this
+                  many channels every step channels, each channel taking the one centred
+                  nearest to it. Default: one estimate over all channels.
+    :param step: channels between windows (default: window//2; each sample is partitioned window/step times)
+    :param trim: fraction cut off each end for method="trimmed"
+    :param inplace: subtract in data itself (must be a float array, e.g. float32) instead of a copy
+    :param return_common: also return the common mode [ npts, nwindow ]
+    :param workers: do pieces of rows in parallel on this many threads (-1: all cores, default: one)
+    :return: cleaned data [, common mode]
+    """
+    if(np.ndim(data) != 2):
+        raise ValueError("data must be 2D [ npts, nchan ]")
+    if(inplace):
+        if(not np.issubdtype(data.dtype, np.floating)):
+            raise ValueError("inplace needs float data, not {0}".format(data.dtype))
+        out = data
+    else:
+        out = np.array(data, dtype=data.dtype if np.issubdtype(data.dtype, np.floating) else 'float64')
+
+    npts, nchan = np.shape(out)
+    starts, width, assign = common_mode_windows(nchan, window, step)
+    common = np.empty((npts, len(starts)), dtype=out.dtype) if return_common else None
+
+    nrow = max(1, int(COMMON_MODE_CHUNK_BYTES // (nchan * out.dtype.itemsize)))
+    chunks = [(r0, min(r0+nrow, npts)) for r0 in range(0, npts, nrow)]
+
+    def job(r0, r1):
+        block = out[r0:r1]
+        if(len(starts) == 1):
+            cm = _central_value(block, method, trim)[:, None]
+            block -= cm
+        else:
+            cm = np.stack([_central_value(block[:, c0:c0+width], method, trim) for c0 in starts], axis=1)
+            block -= cm[:, assign]
+        if(common is not None):
+            common[r0:r1] = cm
+
+    parallel.run_chunks(job, chunks, workers=workers)
+    if(return_common):
+        return out, common
+    return out
+
 
-def pws_rolling_average(data,ns,exp=2):
+def pws_rolling_average(data,ns,exp=2,workers=None):
     """
     Smooth data and remove incoherent traces
     Returned N'th trace is a phase-weighted average of [-ns:ns] neighboring traces
@@ -149,8 +323,14 @@ def pws_rolling_average(data,ns,exp=2):
     
     :param data: Data to clean. 2D numpy array [ npts, nchan ]
     :param ns: number of traces to average over
+    :param workers: process chunks of channels in parallel on this many threads
+                  (-1: all cores, default: one). Each chunk also gets ns+1
+                  neighbouring traces on either side, so the result is the same.
     :return: data_pws
     """
+    if(parallel.get_workers(workers) > 1):
+        return parallel.run_channels(pws_rolling_average, data, ns, exp=exp, workers=workers,
+                                     backend="thread", halo=ns+1)
     data_pws = np.zeros(np.shape(data))
     nchan = np.shape(data)[1]
     # Note: There's a few ways to set this up. 
@@ -163,6 +343,7 @@ def pws_rolling_average(data,ns,exp=2):
     #		    data_pws[:,i] = np.real(pw**exp * np.mean(data[:,i-ns:i+ns+1],axis=1))
 
     # Option 3: rather than averaging traces each time, add 1 new one to the front and pop one off the back
+    import scipy.signal as ss
     dh = ss.hilbert(data,axis=0)
     for i in range(ns,nchan-ns-1):
         if(i==ns):
@@ -0,0 +1,266 @@
+"""
+Event detection over all channels at once: recursive STA/LTA or
+band-limited energy, with spatial coincidence (at least N neighbouring
+channels over threshold) to cut false triggers from single noisy channels.
+
+The detector keeps its state (filter memory, STA/LTA memory, and any run over
+the "off" threshold still going at the end of a block, whether or not it has
+reached "on" yet) between blocks, so it can be fed file by file from
+load_das_h5.stream_das() and gives the same result as one long block with
+method="stalta". With method="energy" the noise level is updated once per block,
+so results there depend a little on the block length.
+
+Example:
+    det = block_detect.Detector(fs=headers['fs'], sta=0.5, lta=10., on=4., off=2.,
+                                freqmin=2., freqmax=20., min_channels=20, neighbourhood=50)
+    triggers = block_detect.detect_archive(det, t_start, t_end, input_dir=input_dir, mapchan=mapping['i0'])
+    block_detect.write_triggers(triggers, "triggers.csv")
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import csv
+from datetime import timedelta
+
+import numpy as np
+
+from pydas_readers.readers import load_das_h5
+from pydas_readers.util import block_filters
+
+
+def _one_pole(n):
+    """ y[i] = y[i-1] + (x[i] - y[i-1]) / n, as a second-order section """
+    c = 1. / n
+    return np.array([[c, 0., 0., 1., c-1., 0.]])
+
+
+class Detector(object):
+    """
+    det = block_detect.Detector(fs, sta=1., lta=20., on=3.5, off=1.5)
+
+    :param fs: sample rate in Hz
+    :param sta, lta: short and long time average windows in seconds
+    :param on, off: trigger on / off thresholds of the characteristic function
+    :param freqmin, freqmax: (optional) Butterworth bandpass applied first
+    :param corners: bandpass corners
+    :param method: "stalta" -- recursive STA/LTA (as in obspy's recursive_sta_lta)
+                   "energy" -- STA of the band-limited energy divided by a per-channel noise level,
+                               which is only updated from channels that are not triggered, once per
+                               block (so results depend a little on how the data is split into blocks)
+    :param min_channels: minimum number of channels over threshold ...
+    :param neighbourhood: ... within this many neighbouring channels
+    :param min_duration: triggers shorter than this (seconds) are dropped
+    :param noise_update: (energy) weight of each new block in the running noise level
+    """
+
+    def __init__(self, fs, sta=1., lta=20., on=3.5, off=1.5, freqmin=None, freqmax=None, corners=4,
+                 method="stalta", min_channels=5, neighbourhood=10, min_duration=0., noise_update=0.1):
+        if(method not in ("stalta", "energy")):
+            raise ValueError("Unknown method: {0}".format(method))
+        self.fs = fs
+        self.nsta = max(1, int(sta*fs))
+        self.nlta = max(1, int(lta*fs))
+        self.on = on
+        self.off = off
+        self.method = method
+        self.min_channels = min_channels
+        self.neighbourhood = neighbourhood
+        self.min_duration = min_duration
+        self.noise_update = noise_update
+
+        self.sos = None
+        if(freqmin is not None and freqmax is not None):
+            self.sos = block_filters.bandpass_sos(freqmin, freqmax, fs, corners=corners)
+        self.reset()
+
+    def reset(self):
+        """ Forget all state, e.g. before a gap in the data """
+        self._zi_bp = None
+        self._zi_sta = None
+        self._zi_lta = None
+        self._noise = None
+        self._nseen = 0
+        self._open = None
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- CHARACTERISTIC FUNCTION
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def characteristic(self, data):
+        """
+        cf = det.characteristic(data)
+        :STA/LTA (or energy ratio) [ npts, nchan ] of a block, continuing from the previous block.
+        """
+        from scipy.signal import sosfilt
+        x = np.asarray(data, dtype='float64')
+        nchan = np.shape(x)[1]
+
+        if(self.sos is not None):
+            if(self._zi_bp is None):
+                self._zi_bp = np.zeros((self.sos.shape[0], 2, nchan))
+            x, self._zi_bp = sosfilt(self.sos, x, axis=0, zi=self._zi_bp)
+        energy = x**2
+
+        #-- Recursive averages are one-pole IIR filters, so sosfilt runs them
+        #--  over all channels in C and returns the state for the next block
+        #--  (a single section with sosfilt is faster than lfilter along axis 0)
+        if(self._zi_sta is None):
+            self._zi_sta = np.zeros((1, 2, nchan))
+        sta, self._zi_sta = sosfilt(_one_pole(self.nsta), energy, axis=0, zi=self._zi_sta)
+
+        if(self.method == "stalta"):
+            if(self._zi_lta is None):
+                self._zi_lta = np.zeros((1, 2, nchan))
+            lta, self._zi_lta = sosfilt(_one_pole(self.nlta), energy, axis=0, zi=self._zi_lta)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cf = np.where(lta > 0, sta / lta, 0.)
+        else:
+            if(self._noise is None):
+                self._noise = np.median(sta, axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cf = np.where(self._noise > 0, sta / self._noise, 0.)
+            #-- Update the noise level only from samples that are not triggered
+            quiet = np.where(cf < self.off, sta, np.nan)
+            level = np.nanmedian(quiet, axis=0)
+            ok = np.isfinite(level)
+            self._noise[ok] = (1-self.noise_update)*self._noise[ok] + self.noise_update*level[ok]
+
+        #-- Warm-up, as in obspy: no triggers until the LTA is filled
+        warm = self.nlta - self._nseen
+        if(warm > 0):
+            cf[:warm] = 0.
+        self._nseen += np.shape(cf)[0]
+        return cf
+
+    def _coincidence(self, over):
+        """ Max number of channels over threshold within any window of 'neighbourhood' channels, per sample """
+        nb = min(self.neighbourhood, np.shape(over)[1])
+        csum = np.cumsum(over, axis=1, dtype=np.int32)
+        csum = np.concatenate((np.zeros((np.shape(over)[0], 1), dtype=np.int32), csum), axis=1)
+        return np.max(csum[:, nb:] - csum[:, :-nb], axis=1)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #-- TRIGGERS
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    def process(self, data, headers, dd=None):
+        """
+        triggers = det.process(data, headers, dd=axis['dd'])
+
+        :param data: block [ npts, nchan ], continuing the previous block in time
+        :param headers: dict of headers, needs 't0'
+        :param dd: (optional) channel distances, to report the trigger extent in meters
+        :return: list of triggers finished within this block. Each is a dict with:
+                 t_on, t_off (datetime), duration (s), peak (max of the characteristic function),
+                 ch_first, ch_last, nchan (channels over threshold), and d_first, d_last if dd given
+        """
+        cf = self.characteristic(data)
+        npts = np.shape(cf)[0]
+        t0 = headers['t0']
+
+        #-- A trigger starts where enough neighbouring channels are over "on",
+        #--  and lasts as long as enough of them stay over "off".
+        start = self._coincidence(cf > self.on) >= self.min_channels
+        keep = self._coincidence(cf > self.off) >= self.min_channels
+
+        #-- Runs of "keep" that contain a "start" are triggers
+        edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+        run_on = np.flatnonzero(edges == 1)
+        run_off = np.flatnonzero(edges == -1)
+
+        finished = []
+        if(self._open is not None and (len(run_on) == 0 or run_on[0] > 0)):
+            #-- A run still going at the end of the previous block ended at the block boundary
+            if(self._open['started']):
+                finished.append(self._close(self._open))
+            self._open = None
+
+        for i0, i1 in zip(run_on, run_off):
+            continues = (i0 == 0 and self._open is not None)
+            over = cf[i0:i1] > self.on
+            trig = dict(t_on=t0 + timedelta(seconds=i0/self.fs),
+                        t_off=t0 + timedelta(seconds=i1/self.fs),
+                        peak=float(np.max(cf[i0:i1])),
+                        channels=np.any(over, axis=0),
+                        started=bool(np.any(start[i0:i1])))
+            if(continues):
+                trig = self._merge(self._open, trig)
+                self._open = None
+
+            if(i1 == npts):
+                #-- Still going at the end of the block: carried over, even if it has not
+                #--  reached "on" yet (it may in the next block, and then starts here)
+                self._open = trig
+            elif(trig['started']):
+                finished.append(self._close(trig))
+
+        return [self._describe(t, dd) for t in finished if t['duration'] >= self.min_duration]
+
+    def flush(self, dd=None):
+        """ Triggers still open after the last block """
+        if(self._open is None or not self._open['started']):
+            self._open = None
+            return []
+        trig = self._close(self._open)
+        self._open = None
+        return [self._describe(trig, dd)] if trig['duration'] >= self.min_duration else []
+
+    @staticmethod
+    def _merge(a, b):
+        return dict(t_on=a['t_on'], t_off=b['t_off'], peak=max(a['peak'], b['peak']),
+                    channels=a['channels'] | b['channels'], started=a['started'] or b['started'])
+
+    @staticmethod
+    def _close(trig):
+        trig['duration'] = (trig['t_off'] - trig['t_on']).total_seconds()
+        return trig
+
+    @staticmethod
+    def _describe(trig, dd=None):
+        ich = np.flatnonzero(trig.pop('channels'))
+        trig.pop('started')
+        trig['nchan'] = len(ich)
+        trig['ch_first'] = int(ich[0]) if len(ich) else -1
+        trig['ch_last'] = int(ich[-1]) if len(ich) else -1
+        if(dd is not None and len(ich)):
+            trig['d_first'] = float(dd[ich[0]])
+            trig['d_last'] = float(dd[ich[-1]])
+        return trig
+
+
+def detect_archive(detector, t_start, t_end, input_dir='./', verbose=False, **stream_kwargs):
+    """
+    triggers = block_detect.detect_archive(det, t_start, t_end, input_dir=input_dir)
+
+    Run a Detector over an archive time range, one file at a time (load_das_h5.stream_das).
+    Files that don't follow on from the previous one (a gap) reset the detector state.
+
+    :param stream_kwargs: channel selection etc., passed to load_das_h5.stream_das()
+    :return: list of triggers, see Detector.process()
+    """
+    triggers = []
+    t_expected = None
+    dd = None
+    for data, headers, axis in load_das_h5.stream_das(t_start, t_end, input_dir=input_dir, verbose=verbose, **stream_kwargs):
+        dd = axis['dd']
+        if(t_expected is not None and abs((headers['t0'] - t_expected).total_seconds()) > 1.5/headers['fs']):
+            if(verbose):
+                print("Gap before {0}, resetting detector".format(headers['t0']))
+            triggers += detector.flush(dd)
+            detector.reset()
+        triggers += detector.process(data, headers, dd=dd)
+        t_expected = headers['t1'] + timedelta(seconds=1/headers['fs'])
+    triggers += detector.flush(dd)
+    return triggers
+
+
+def write_triggers(triggers, filename):
+    """ Save a trigger list as CSV, one trigger per line """
+    fields = ['t_on', 't_off', 'duration', 'peak', 'nchan', 'ch_first', 'ch_last', 'd_first', 'd_last']
+    with open(filename, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for trig in triggers:
+            row = dict(trig)
+            row['t_on'] = trig['t_on'].strftime('%Y-%m-%dT%H:%M:%S.%f')
+            row['t_off'] = trig['t_off'].strftime('%Y-%m-%dT%H:%M:%S.%f')
+            writer.writerow(row)
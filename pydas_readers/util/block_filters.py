@@ -11,12 +11,8 @@ daniel.bowden@erdw.ethz.ch
 Last updated: Jan 2023
 """
 
-from scipy.signal import butter, lfilter, filtfilt, firwin, resample, hilbert
-import scipy.signal as signal
-from scipy.signal import (cheb2ord, cheby2, convolve, get_window, iirfilter,
-                          remez)
-from scipy.signal import sosfilt, sosfiltfilt
-from scipy.signal import zpk2sos
+#-- scipy.signal takes ~1s to import, so it's imported inside the functions that use it
+#--  (not by every worker process that only imports this module; see misc_testing/benchmark_import.py)
 import numpy as np
 from datetime import datetime, timedelta
 #from obspy.core import UTCDateTime
@@ -27,9 +23,11 @@ import sys
 import os
 
 from pydas_readers.util import block_cleaning
+from pydas_readers.util import fft_backend
+from pydas_readers.util import parallel
 
 
-def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper=0, verbose=False):
+def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper=0, verbose=False, engine="sos", block_size=None, workers=None):
     """
     Butterworth-Bandpass Filter. Taken directly from OBSPY
     
@@ -51,10 +49,22 @@ def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper
         the resulting filtered trace.
     :param taper: Value between 0 and 0.5 (i.e., 0.01 means 1%)
         Linear taper the edges in time-domain
+    :param engine: "sos"  -- time-domain sosfilt (default, as always)
+                   "fft"  -- apply the filter response in the frequency domain, see fft_filter()
+                   "auto" -- "fft" for zerophase filtering of blocks with at least FFT_MIN_NPTS samples
+    :param block_size: (fft engine only) blocks longer than this are filtered with overlap-save
+        in segments of about this many samples. Default: FFT_BLOCK_SIZE
+    :param workers: filter chunks of channels in parallel on this many threads
+        (-1: all cores, default: one), see parallel.run_channels()
     :return: Filtered data.
     """
     if(verbose):
         print("Filtering {0}Hz to {1}Hz".format(freqmin,freqmax))
+    if(parallel.get_workers(workers) > 1):
+        return parallel.run_channels(block_bandpass, data, freqmin, freqmax, df, corners=corners, zerophase=zerophase,
+                                     taper=taper, engine=engine, block_size=block_size, workers=workers)
+    from scipy.signal import sosfilt
+
     if(data.dtype!="float64"):
         data = data.astype('float64')
 
@@ -63,16 +73,7 @@ def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper
         vector_input = True
         data = data[:,None]
 
-    fe = 0.5 * df
-    low = freqmin / fe
-    high = freqmax / fe
-    
-    if low > 1:
-        msg = "Selected low corner frequency is above Nyquist."
-        raise ValueError(msg)
-    z, p, k = iirfilter(corners, [low, high], btype='band',
-                        ftype='butter', output='zpk')
-    sos = zpk2sos(z, p, k)
+    sos = bandpass_sos(freqmin, freqmax, df, corners=corners)
 
 
     # Taper
@@ -85,6 +86,18 @@ def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper
         data = block_cleaning.taper(data, taper_ratio=taper)
 
 
+    if(engine == "auto"):
+        engine = "fft" if (zerophase and np.shape(data)[0] >= FFT_MIN_NPTS) else "sos"
+    if(engine == "fft"):
+        if(verbose):
+            print("   (frequency-domain engine)")
+        filtered = fft_filter(data, sos, zerophase=zerophase, block_size=block_size)
+        if(vector_input):
+            return np.squeeze(filtered)
+        return filtered
+    elif(engine != "sos"):
+        raise ValueError("Unknown engine: {0}".format(engine))
+
     if(zerophase):
         if(vector_input):
             firstpass = sosfilt(sos, data, axis=0)
@@ -99,47 +112,294 @@ def block_bandpass(data, freqmin, freqmax, df, corners=4, zerophase=False, taper
             return sosfilt(sos, data, axis=0)
     
 
-def chebychev_lowpass_downsamp(data, fs, factor, zerophase=False, verbose=False):
+def chebychev_lowpass_downsamp(data, fs, factor, zerophase=False, verbose=False, workers=None):
     """
     Custom Chebychev type two lowpass filter useful for
     decimation filtering.
 
     This filter is stable up to a reduction in frequency with a factor of
-    10. If more reduction is desired, simply decimate in steps.
+    10. Larger (or non-integer) factors are done in steps, as planned by
+    block_resample.plan_resample().
 
     Partly based on a filter in ObsPy.
 
     :param trace: The trace to be filtered.
     :param freqmax: The desired lowpass frequency.
+    :param workers: filter chunks of channels in parallel on this many threads
+        (-1: all cores, default: one), see parallel.run_channels()
     """
     freqout = fs/factor
-    freqmax = fs/factor/2
+    if(factor > 10 or factor != int(factor)):
+        from pydas_readers.util import block_resample
+        return block_resample.block_resample(data, fs, freqout, zerophase=zerophase, verbose=verbose, workers=workers)
+    factor = int(factor)
     if(verbose):
         print("Downsampling {0}Hz to {1}Hz".format(fs,freqout))
-    
-    # rp - maximum ripple of passband, rs - attenuation of stopband
-    rp, rs, order = 1, 96, 1e99
-    ws = freqmax / (fs * 0.5)  # stop band frequency
-    wp = ws  # pass band frequency
+    if(parallel.get_workers(workers) > 1):
+        return parallel.run_channels(chebychev_lowpass_downsamp, data, fs, factor, zerophase=zerophase, workers=workers)
+    from scipy.signal import sosfilt, sosfiltfilt
 
-    while True:
-        if order <= 12:
-            break
-        wp *= 0.99
-        order, wn = signal.cheb2ord(wp, ws, rp, rs, analog=0)
+    sos = decimation_sos(fs, factor)
 
-    sos = cheby2(order, rs, wn, btype='low', analog=0, output='sos')
-
-    data2 = np.zeros([  int(np.ceil(np.shape(data)[0]/factor)), np.shape(data)[1]])
-    
+    #-- All channels at once along axis 0 (same as filtering channel by channel)
     if(zerophase):
-        for i in range(np.shape(data)[1]):
-            y = sosfiltfilt(sos, data[:,i])   
-            data2[:,i] = y[::factor]
+        data2 = sosfiltfilt(sos, data, axis=0)[::factor]
     else:
-        for i in range(np.shape(data)[1]):
-            y = sosfilt(sos, data[:,i])   
-            data2[:,i] = y[::factor]
+        data2 = sosfilt(sos, data, axis=0)[::factor]
+    data2 = np.ascontiguousarray(data2, dtype='float64')
     if(verbose):
         print("   Downsampling completed.")
     return data2
+
+
+#-- Designed filters, so repeated calls (or many bands) don't re-design them each time.
+#--  Keyed by (freqmin, freqmax, df, corners), or ("cheby2", fs, factor) for decimation
+_SOS_CACHE = dict()
+
+#-- Working memory per channel chunk when filtering a bank of bands
+CHUNK_BYTES = 2**23
+
+#-- Frequency-domain engine: engine="auto" switches to it for zerophase filtering of at least
+#--  FFT_MIN_NPTS samples, and longer blocks than FFT_BLOCK_SIZE are done with overlap-save.
+#--  (see misc_testing/benchmark_fft_filter.py)
+FFT_MIN_NPTS = 2**15
+FFT_BLOCK_SIZE = 2**18
+
+#-- Length over which a filter's impulse response is significant, keyed by (sos, zerophase)
+_HALFWIDTH_CACHE = dict()
+
+
+def decimation_sos(fs, factor):
+    """
+    Chebychev type two lowpass design of chebychev_lowpass_downsamp, cached per (fs, factor).
+
+    :param fs: Sampling rate in Hz.
+    :param factor: Decimation factor, the stop band starts at the new Nyquist fs/factor/2
+    :return: second-order sections, [n_sections, 6]
+    """
+    key = ("cheby2", float(fs), int(factor))
+    if(key not in _SOS_CACHE):
+        from scipy.signal import cheb2ord, cheby2
+        freqmax = fs/factor/2
+
+        # rp - maximum ripple of passband, rs - attenuation of stopband
+        rp, rs, order = 1, 96, 1e99
+        ws = freqmax / (fs * 0.5)  # stop band frequency
+        wp = ws  # pass band frequency
+
+        while True:
+            if order <= 12:
+                break
+            wp *= 0.99
+            order, wn = cheb2ord(wp, ws, rp, rs, analog=0)
+
+        _SOS_CACHE[key] = cheby2(order, rs, wn, btype='low', analog=0, output='sos')
+    return _SOS_CACHE[key]
+
+
+def bandpass_sos(freqmin, freqmax, df, corners=4):
+    """
+    Butterworth bandpass design, as used in block_bandpass, cached per (band, df, corners).
+
+    :param freqmin: Pass band low corner frequency.
+    :param freqmax: Pass band high corner frequency.
+    :param df: Sampling rate in Hz.
+    :param corners: Filter corners / order.
+    :return: second-order sections, [n_sections, 6]
+    """
+    key = (float(freqmin), float(freqmax), float(df), int(corners))
+    if(key not in _SOS_CACHE):
+        from scipy.signal import iirfilter, zpk2sos
+        fe = 0.5 * df
+        low = freqmin / fe
+        high = freqmax / fe
+        if low > 1:
+            msg = "Selected low corner frequency is above Nyquist."
+            raise ValueError(msg)
+        z, p, k = iirfilter(corners, [low, high], btype='band',
+                            ftype='butter', output='zpk')
+        _SOS_CACHE[key] = zpk2sos(z, p, k)
+    return _SOS_CACHE[key]
+
+
+def block_filter_bank(data, bands, df, corners=4, zerophase=False, taper=0, method="sos", out=None, verbose=False, workers=None):
+    """
+    Butterworth-Bandpass filter the same block in several bands at once.
+
+    Equivalent to calling block_bandpass() once per band, but the block is 
+    converted and tapered only once, filters are designed once (and cached),
+    and the work is done per chunk of channels so each chunk stays in cache 
+    while all bands are applied to it.
+
+    :type data: numpy.ndarray
+    :param data: Data to filter. 2D numpy array [ npts, nchan ]
+                  OR a 1D numpy array [ npts, ]
+    :param bands: list of (freqmin, freqmax) pairs
+    :param df: Sampling rate in Hz.
+    :param corners: Filter corners / order.
+    :param zerophase: If True, apply filter once forwards and once backwards.
+    :param taper: Value between 0 and 0.5 (i.e., 0.01 means 1%)
+        Linear taper the edges in time-domain
+    :param method: "sos" -- time-domain sosfilt, as in block_bandpass
+                   "fft" -- multiply by the filter response in the frequency domain. 
+                            One forward FFT is shared by all bands; faster for long blocks
+                            and many bands.
+    :param out: (optional) preallocated float32 array [ nband, npts, nchan ] to write into
+                ([ nband, npts ] for 1D input)
+    :param workers: process the channel chunks in parallel on this many threads
+        (-1: all cores, default: one)
+    :return: Filtered data, float32 array [ nband, npts, nchan ] 
+             (or [ nband, npts ] for 1D input)
+    """
+    from scipy.signal import sosfilt
+
+    vector_input = False
+    if(data.ndim==1):
+        vector_input = True
+        data = data[:,None]
+    npts, nchan = np.shape(data)
+    nband = len(bands)
+
+    shape = (nband, npts) if vector_input else (nband, npts, nchan)
+    if(out is None):
+        out = np.empty(shape, dtype='float32')
+    elif(out.shape != shape):
+        raise ValueError("out must have shape {0}".format(shape))
+    #-- A view [ nband, npts, nchan ] either way, so writes land in out
+    out3 = out[:, :, None] if vector_input else out
+
+    soses = [bandpass_sos(fmin, fmax, df, corners=corners) for fmin, fmax in bands]
+    if(verbose):
+        for fmin, fmax in bands:
+            print("Filtering {0}Hz to {1}Hz".format(fmin,fmax))
+
+    if(method == "fft"):
+        #-- Zero-pad so the (decaying) impulse response doesn't wrap around
+        halfwidth = max(_impulse_halfwidth(sos, zerophase=zerophase) for sos in soses)
+        nfft = fft_backend.next_fast_len(npts + halfwidth, real=True)
+        responses = [_sos_response(sos, nfft, zerophase=zerophase) for sos in soses]
+    elif(method != "sos"):
+        raise ValueError("Unknown method: {0}".format(method))
+
+    #-- With several chunk threads, each FFT stays single-threaded
+    nworkers = parallel.get_workers(workers)
+    fft_workers = 1 if nworkers > 1 else None
+
+    def filter_chunk(c0, c1):
+        chunk = data[:, c0:c1].astype('float64')
+        if(taper>0):
+            chunk = block_cleaning.taper(chunk, taper_ratio=taper)
+
+        if(method == "fft"):
+            spec = fft_backend.rfft(chunk, n=nfft, axis=0, workers=fft_workers)
+            for ib, resp in enumerate(responses):
+                out3[ib, :, c0:c1] = fft_backend.irfft(spec * resp[:,None], n=nfft, axis=0, workers=fft_workers)[:npts]
+        else:
+            for ib, sos in enumerate(soses):
+                if(zerophase):
+                    firstpass = sosfilt(sos, chunk, axis=0)
+                    out3[ib, :, c0:c1] = sosfilt(sos, firstpass[::-1], axis=0)[::-1]
+                else:
+                    out3[ib, :, c0:c1] = sosfilt(sos, chunk, axis=0)
+
+    parallel.run_chunks(filter_chunk, parallel.channel_chunks(npts, nchan, nworkers, chunk_bytes=CHUNK_BYTES),
+                        workers=nworkers)
+
+    return out
+
+
+def _sos_response(sos, nfft, zerophase=False):
+    """
+    Complex frequency response of sos on the rfft grid of length nfft.
+    With zerophase, |H|^2 (the response of filtering forwards and backwards).
+    """
+    from scipy.signal import sosfreqz
+    w, h = sosfreqz(sos, worN=np.fft.rfftfreq(nfft)*2*np.pi)
+    if(zerophase):
+        return np.abs(h)**2
+    return h
+
+
+def _impulse_halfwidth(sos, zerophase=False, tol=1e-7, nmax=2**22):
+    """
+    Number of samples after which the impulse response of sos (or, with zerophase,
+    of sos forwards and backwards, on either side) has decayed below tol of its peak.
+    Capped at nmax.
+    """
+    key = (sos.tobytes(), zerophase)
+    if(key not in _HALFWIDTH_CACHE):
+        from scipy.signal import sosfilt
+        n = 2**12
+        while True:
+            impulse = np.zeros(n)
+            impulse[0] = 1.0
+            h = sosfilt(sos, impulse)
+            if(zerophase):
+                #-- The autocorrelation of h decays where h does, within a factor ~2 in length
+                h = sosfilt(sos, h[::-1])[::-1]
+            big = np.flatnonzero(np.abs(h) > tol*np.max(np.abs(h)))
+            width = big[-1] + 1
+            if(width < n//2 or n >= nmax):
+                break
+            n *= 4
+        if(zerophase):
+            width *= 2
+        _HALFWIDTH_CACHE[key] = int(min(width, nmax))
+    return _HALFWIDTH_CACHE[key]
+
+
+def fft_filter(data, sos, zerophase=False, block_size=None):
+    """
+    Apply an IIR filter (as second-order sections) by multiplying with its frequency
+    response, using batched real FFTs over all channels at once.
+
+    With zerophase, the response is |H(f)|^2: the same as filtering once forwards 
+    and once backwards, except that the forward pass is not truncated at the end
+    of the block before the backward pass (so edges differ slightly from block_bandpass
+    with engine="sos"). Data are treated as zero outside of the block.
+
+    Blocks longer than block_size are filtered with overlap-save: segments of about
+    block_size samples, overlapping by the length of the impulse response.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param sos: second-order sections, e.g. from bandpass_sos()
+    :param zerophase: zero-phase (|H|^2) instead of causal (H) response
+    :param block_size: segment length for overlap-save (default: FFT_BLOCK_SIZE)
+    :return: filtered data, float64 [ npts, nchan ]
+    """
+    if(block_size is None):
+        block_size = FFT_BLOCK_SIZE
+    npts = np.shape(data)[0]
+    halfwidth = _impulse_halfwidth(sos, zerophase=zerophase)
+
+    #-- Short enough: one FFT of the whole (zero-padded) block
+    if(npts <= block_size or halfwidth >= npts):
+        nfft = fft_backend.next_fast_len(npts + halfwidth, real=True)
+        resp = _sos_response(sos, nfft, zerophase=zerophase)
+        spec = fft_backend.rfft(data, n=nfft, axis=0)
+        spec *= resp[:,None]
+        return fft_backend.irfft(spec, n=nfft, axis=0)[:npts]
+
+    #-- Overlap-save. Each segment of nfft inputs starts halfwidth before the samples it
+    #--  outputs, and the halfwidth outputs at either end (wrapped around) are discarded.
+    nfft = fft_backend.next_fast_len(max(block_size, 2*halfwidth) + 2*halfwidth, real=True)
+    step = nfft - 2*halfwidth
+    resp = _sos_response(sos, nfft, zerophase=zerophase)[:,None]
+
+    out = np.empty(np.shape(data), dtype='float64')
+    segment = np.zeros((nfft,) + np.shape(data)[1:], dtype='float64')
+    for s0 in range(0, npts, step):
+        #-- input samples [s0-halfwidth, s0-halfwidth+nfft), zero outside the block
+        i0 = s0 - halfwidth
+        a = max(i0, 0)
+        b = min(i0 + nfft, npts)
+        segment[:] = 0.
+        segment[a-i0:b-i0] = data[a:b]
+
+        spec = fft_backend.rfft(segment, axis=0)
+        spec *= resp
+        y = fft_backend.irfft(spec, n=nfft, axis=0)
+
+        n_out = min(step, npts - s0)
+        out[s0:s0+n_out] = y[halfwidth:halfwidth+n_out]
+    return out
@@ -0,0 +1,244 @@
+"""
+Frequency-wavenumber (f-k) analysis and filtering of a contiguous
+block of DAS data [ npts, nchan ].
+
+The 2D transform is a real FFT along time and a complex FFT along
+the channel axis, so only positive frequencies are kept (and both
+signs of wavenumber, i.e. both directions of propagation along the fibre).
+
+Axes follow the headers:
+    f -- Hz, from headers['fs']
+    k -- cycles per meter, from the physical channel spacing headers['dx']*headers['fm']
+
+Channels from a mapping are not evenly spaced along the fibre (mapping['dd']);
+use regularize_channels() first to interpolate onto an even grid.
+For very long fibres, fk_filter_tiled() processes overlapping channel windows.
+
+Example (keep only apparent velocities between 1500 and 6000 m/s):
+    data_fk = block_fk.fk_filter(data, headers, vmin=1500, vmax=6000)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import numpy as np
+
+from pydas_readers.util import fft_backend
+
+
+def channel_spacing(headers):
+    """ Physical channel spacing in meters (reported dx is stretched by the fibre multiplier) """
+    return headers['dx'] * headers.get('fm', 1.0)
+
+
+def _edge_taper(n, ratio):
+    """ Linear taper window of length n, ratio (0 to 0.5) at each end """
+    win = np.ones(n)
+    lwind = int(n*ratio)
+    if(lwind > 0):
+        ramp = np.linspace(0, 1, lwind)
+        win[:lwind] = ramp
+        win[-lwind:] = ramp[::-1]
+    return win
+
+
+def fk_transform(data, headers, nfft_t=None, nfft_x=None, taper=0, float32=False, workers=None):
+    """
+    fk, f, k = block_fk.fk_transform(data, headers)
+
+    :param data: 2D numpy array [ npts, nchan ], evenly spaced channels
+    :param headers: dict of headers, needs 'fs' and 'dx' (and 'fm')
+    :param nfft_t: FFT length in time (default: next fast length >= npts)
+    :param nfft_x: FFT length along channels (default: next fast length >= nchan)
+    :param taper: Value between 0 and 0.5, linear taper of the edges in time and space
+    :param float32: compute in single precision (half the memory, faster)
+    :param workers: number of FFT threads (default: fft_backend.WORKERS)
+    :return: fk -- complex array [ nfft_t//2+1, nfft_x ], k not shifted (see np.fft.fftshift)
+             f  -- frequencies in Hz
+             k  -- wavenumbers in 1/m
+    """
+    npts, nchan = np.shape(data)
+    if(nfft_t is None):
+        nfft_t = fft_backend.next_fast_len(npts, real=True)
+    if(nfft_x is None):
+        nfft_x = fft_backend.next_fast_len(nchan, real=False)
+
+    dtype = 'float32' if float32 else 'float64'
+    data = np.asarray(data, dtype=dtype)
+    if(taper > 0):
+        data = data * _edge_taper(npts, taper).astype(dtype)[:,None]
+        data *= _edge_taper(nchan, taper).astype(dtype)[None,:]
+
+    #-- real FFT along time (axis 0, the last in "axes"), complex along channels
+    fk = fft_backend.rfftn(data, s=(nfft_x, nfft_t), axes=(1, 0), workers=workers)
+
+    f = fft_backend.rfftfreq(nfft_t, 1.0/headers['fs'])
+    k = fft_backend.fftfreq(nfft_x, channel_spacing(headers))
+    return fk, f, k
+
+
+def fk_inverse(fk, npts, nchan, workers=None):
+    """
+    data = block_fk.fk_inverse(fk, npts, nchan)
+    :Inverse of fk_transform, cut back to the original [ npts, nchan ]
+    """
+    nfft_t = 2*(np.shape(fk)[0]-1)
+    nfft_x = np.shape(fk)[1]
+    data = fft_backend.irfftn(fk, s=(nfft_x, nfft_t), axes=(1, 0), workers=workers)
+    return data[:npts, :nchan]
+
+
+def velocity_mask(f, k, vmin=0, vmax=np.inf, taper=0.1, direction=None):
+    """
+    mask = block_fk.velocity_mask(f, k, vmin=1500, vmax=6000)
+
+    Fan filter: pass apparent velocities |f/k| between vmin and vmax (m/s).
+
+    :param f, k: axes as returned by fk_transform
+    :param vmin, vmax: pass band of apparent velocity
+    :param taper: fractional width of a cosine roll-off on the velocity edges
+    :param direction: None for both, "positive" for waves travelling towards increasing
+                      distance, "negative" for decreasing distance
+    :return: mask [ len(f), len(k) ], values between 0 and 1
+    """
+    ff = np.abs(f)[:,None]
+    kk = k[None,:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = ff / np.abs(kk)
+
+    mask = np.ones((len(f), len(k)))
+    if(vmin > 0):
+        mask *= _cosine_edge(v, vmin*(1-taper), vmin)
+    if(np.isfinite(vmax)):
+        mask *= 1 - _cosine_edge(v, vmax, vmax*(1+taper))
+
+    #-- With rfft along time, f >= 0, so the sign of k gives the direction.
+    #--  (with numpy's sign convention, a wave exp(i*2pi*(f*t - k0*x)) travelling
+    #--   towards increasing distance shows up at k = -k0)
+    if(direction == "positive"):
+        mask[:, k > 0] = 0
+    elif(direction == "negative"):
+        mask[:, k < 0] = 0
+    elif(direction is not None):
+        raise ValueError("Unknown direction: {0}".format(direction))
+    return mask
+
+
+def fk_mask(f, k, fmin=0, fmax=np.inf, kmin=0, kmax=np.inf, taper=0.1):
+    """
+    mask = block_fk.fk_mask(f, k, fmin=1, fmax=20, kmax=0.05)
+
+    Rectangular pass band in frequency (Hz) and |wavenumber| (1/m), with cosine edges
+    of fractional width taper.
+    """
+    ff = np.abs(f)[:,None] * np.ones((1, len(k)))
+    kk = np.abs(k)[None,:] * np.ones((len(f), 1))
+    mask = np.ones((len(f), len(k)))
+    if(fmin > 0):
+        mask *= _cosine_edge(ff, fmin*(1-taper), fmin)
+    if(np.isfinite(fmax)):
+        mask *= 1 - _cosine_edge(ff, fmax, fmax*(1+taper))
+    if(kmin > 0):
+        mask *= _cosine_edge(kk, kmin*(1-taper), kmin)
+    if(np.isfinite(kmax)):
+        mask *= 1 - _cosine_edge(kk, kmax, kmax*(1+taper))
+    return mask
+
+
+def _cosine_edge(x, x0, x1):
+    """ 0 below x0, 1 above x1, half-cosine in between (NaN counts as 1) """
+    if(x1 <= x0):
+        out = (x >= x1).astype(float)
+    else:
+        out = 0.5 - 0.5*np.cos(np.pi * np.clip((x - x0)/(x1 - x0), 0, 1))
+    return np.where(np.isnan(x), 1.0, out)
+
+
+def fk_filter(data, headers, vmin=0, vmax=np.inf, direction=None, mask=None, taper=0.05,
+              mask_taper=0.1, float32=False, workers=None):
+    """
+    data_filtered = block_fk.fk_filter(data, headers, vmin=1500, vmax=6000)
+
+    Velocity (fan) filter, or any other f-k mask, applied to a block.
+
+    :param data: 2D numpy array [ npts, nchan ], evenly spaced channels
+    :param headers: dict of headers ('fs', 'dx', 'fm')
+    :param vmin, vmax, direction: see velocity_mask()
+    :param mask: (optional) function mask(f, k) returning an array [ len(f), len(k) ],
+                 used instead of the velocity mask. e.g.:
+                 mask = lambda f, k: block_fk.fk_mask(f, k, fmin=1, fmax=20)
+    :param taper: edge taper of the data before transforming (0 to 0.5)
+    :param mask_taper: fractional width of the cosine edges of the velocity mask
+    :param float32: compute in single precision
+    :param workers: number of FFT threads (default: fft_backend.WORKERS)
+    :return: filtered data [ npts, nchan ]
+    """
+    npts, nchan = np.shape(data)
+    fk, f, k = fk_transform(data, headers, taper=taper, float32=float32, workers=workers)
+    if(mask is None):
+        m = velocity_mask(f, k, vmin=vmin, vmax=vmax, taper=mask_taper, direction=direction)
+    else:
+        m = mask(f, k)
+    fk *= m.astype(fk.real.dtype)
+    return fk_inverse(fk, npts, nchan, workers=workers)
+
+
+def fk_filter_tiled(data, headers, tile=1024, overlap=0.5, **kwargs):
+    """
+    data_filtered = block_fk.fk_filter_tiled(data, headers, tile=1024, vmin=1500)
+
+    As fk_filter(), but over windows of "tile" channels that overlap by a fraction
+    "overlap". Outputs are blended with a triangular weight, so memory stays at
+    the size of one tile and each tile's FFT is small.
+
+    :param tile: number of channels per window
+    :param overlap: fraction of overlap between neighbouring windows (0 to <1)
+    :param kwargs: passed to fk_filter()
+    :return: filtered data [ npts, nchan ]
+    """
+    npts, nchan = np.shape(data)
+    if(nchan <= tile):
+        return fk_filter(data, headers, **kwargs)
+
+    step = max(1, int(tile*(1-overlap)))
+    starts = list(range(0, nchan-tile, step)) + [nchan-tile]
+
+    out = np.zeros((npts, nchan))
+    weight = np.zeros(nchan)
+    win = np.bartlett(tile+2)[1:-1]
+    for c0 in starts:
+        #-- First/last tile: full weight up to the edge of the fibre
+        w = win.copy()
+        if(c0 == 0):
+            w[:tile//2] = 1
+        if(c0 == nchan-tile):
+            w[tile//2:] = 1
+        out[:, c0:c0+tile] += fk_filter(data[:, c0:c0+tile], headers, **kwargs) * w[None,:]
+        weight[c0:c0+tile] += w
+    return out / weight[None,:]
+
+
+def regularize_channels(data, dd, dx=None):
+    """
+    data_even, dd_even = block_fk.regularize_channels(data, mapping['dd'])
+
+    Linearly interpolate channels at uneven distances dd (e.g. from a channel mapping)
+    onto an evenly spaced grid, as needed for the spatial FFT.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param dd: distance of each channel, increasing
+    :param dx: spacing of the new grid (default: median spacing of dd)
+    :return: data_even [ npts, nchan_even ], dd_even
+             (set headers['dx'] = dx_even / headers['fm'] to use them with fk_transform)
+    """
+    dd = np.asarray(dd, dtype=float)
+    if(dx is None):
+        dx = np.median(np.diff(dd))
+    dd_even = np.arange(dd[0], dd[-1] + dx/2, dx)
+
+    #-- Indices and weights are computed once, then applied to all samples at once
+    j1 = np.clip(np.searchsorted(dd, dd_even, side='right'), 1, len(dd)-1)
+    j0 = j1 - 1
+    w = np.clip((dd_even - dd[j0]) / (dd[j1] - dd[j0]), 0, 1)
+    data_even = data[:, j0] * (1-w)[None,:] + data[:, j1] * w[None,:]
+    return data_even, dd_even
@@ -0,0 +1,177 @@
+"""
+Resampling by any rational factor (1000 -> 250 Hz, 1000 -> 200/3 Hz, 1000 -> 3 Hz),
+as a cascade of stages planned once per (fs_in, fs_out) and re-used:
+
+ - integer decimation stages of at most MAX_FACTOR each, with the Chebychev lowpass
+   of block_filters.chebychev_lowpass_downsamp (stop band at the new Nyquist, 96 dB),
+   largest factor first so the filtering at the full rate is as cheap as possible
+ - a polyphase FIR stage (scipy.signal.resample_poly) for an up-sampling factor, or for
+   prime factors too large for one Chebychev stage. Its Kaiser window is designed so the
+   stop band also starts at the new Nyquist, with FIR_ATTENUATION dB.
+
+Every stage filters all channels at once along the time axis. Filter designs are cached.
+
+Example:
+    data2 = block_resample.block_resample(data, 1000., 200./3)
+    plan = block_resample.plan_resample(1000., 3.)     # [decimate 10, decimate 10, polyphase 3/10]
+    data2 = plan(data)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+from fractions import Fraction
+
+import numpy as np
+
+from pydas_readers.util import block_filters
+from pydas_readers.util import parallel
+
+#-- Largest factor of one Chebychev decimation stage (see chebychev_lowpass_downsamp)
+MAX_FACTOR = 10
+#-- Stop band attenuation and transition width (fraction of the new Nyquist) of polyphase stages
+FIR_ATTENUATION = 80.
+FIR_TRANSITION = 0.2
+
+#-- Largest up / down factor of one polyphase stage (the FIR length grows with it)
+MAX_POLYPHASE = 1000
+
+#-- Plans by (fs_in, fs_out, max_factor), FIR designs by (up, down)
+_PLAN_CACHE = dict()
+_FIR_CACHE = dict()
+
+
+def _prime_factors(n):
+    factors = []
+    p = 2
+    while(p*p <= n):
+        while(n % p == 0):
+            factors.append(p)
+            n //= p
+        p += 1
+    if(n > 1):
+        factors.append(n)
+    return factors
+
+
+def _group_factors(n, max_factor):
+    """ Split n into a product of stages of at most max_factor (where possible), largest first """
+    stages = []
+    for p in sorted(_prime_factors(n), reverse=True):
+        #-- First stage this prime still fits into, else a new stage
+        for i, s in enumerate(stages):
+            if(s * p <= max_factor):
+                stages[i] = s * p
+                break
+        else:
+            stages.append(p)
+    return sorted(stages, reverse=True)
+
+
+def polyphase_fir(up, down):
+    """
+    Lowpass FIR for resample_poly(x, up, down, window=h), cached per (up, down):
+    pass band to (1-FIR_TRANSITION) of the new Nyquist, stop band from the new Nyquist.
+    """
+    key = (int(up), int(down))
+    if(key not in _FIR_CACHE):
+        from scipy.signal import firwin, kaiserord
+        max_rate = max(up, down)
+        width = FIR_TRANSITION / max_rate
+        numtaps, beta = kaiserord(FIR_ATTENUATION, width)
+        numtaps += 1 - numtaps % 2
+        _FIR_CACHE[key] = firwin(numtaps, 1. / max_rate - width / 2, window=('kaiser', beta))
+    return _FIR_CACHE[key]
+
+
+class ResamplePlan(object):
+    """
+    plan = ResamplePlan(fs_in, fs_out)   (usually from plan_resample(), which caches plans)
+    data2 = plan(data)
+
+    plan.stages -- list of ("decimate", factor) and ("polyphase", up, down), in order
+    """
+
+    def __init__(self, fs_in, fs_out, max_factor=MAX_FACTOR, max_denominator=10**6):
+        ratio = Fraction(fs_out / fs_in).limit_denominator(max_denominator)
+        if(ratio <= 0 or abs(float(ratio) - fs_out / fs_in) > 1e-9 * fs_out / fs_in):
+            raise ValueError("Cannot resample {0} Hz to {1} Hz with a ratio of integers up to {2}".format(fs_in, fs_out, max_denominator))
+        self.fs_in = fs_in
+        self.fs_out = fs_out
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+
+        self.stages = []
+        if(self.up >= self.down):
+            self.stages.append(("polyphase", self.up, self.down))
+        else:
+            groups = _group_factors(self.down, max_factor)
+            decimate = [g for g in groups if g <= max_factor]
+            large = [g for g in groups if g > max_factor]
+            #-- An up factor goes into the last polyphase stage, at the lowest rate
+            if(self.up > 1):
+                last = large.pop() if len(large) > 0 else (decimate.pop() if len(decimate) > 0 else 1)
+            self.stages += [("decimate", g) for g in decimate]
+            self.stages += [("polyphase", 1, g) for g in large]
+            if(self.up > 1):
+                self.stages.append(("polyphase", self.up, last))
+        if(max(max(stage[1:]) for stage in self.stages) > MAX_POLYPHASE):
+            raise ValueError("Resampling {0} Hz to {1} Hz needs a polyphase stage of {2}; choose a rate with a simpler ratio".format(
+                fs_in, fs_out, self.stages[-1]))
+
+    def __repr__(self):
+        return "ResamplePlan({0} Hz -> {1} Hz: {2})".format(self.fs_in, self.fs_out, self.stages)
+
+    def __call__(self, data, zerophase=False, verbose=False, workers=None):
+        """
+        data2 = plan(data)
+        :param data: 2D numpy array [ npts, nchan ] (or 1D [ npts ])
+        :param zerophase: forward-backward filtering in the decimation stages (polyphase stages
+                          are linear phase, with the delay removed, either way)
+        :param workers: filter chunks of channels in parallel on this many threads, see parallel.run_channels()
+        """
+        if(parallel.get_workers(workers) > 1):
+            return parallel.run_channels(self, data, zerophase=zerophase, workers=workers)
+        from scipy.signal import resample_poly
+
+        fs = self.fs_in
+        for stage in self.stages:
+            if(stage[0] == "decimate"):
+                data = block_filters.chebychev_lowpass_downsamp(data, fs, stage[1], zerophase=zerophase)
+                fs = fs / stage[1]
+            else:
+                up, down = stage[1], stage[2]
+                data = resample_poly(np.asarray(data, dtype='float64'), up, down, axis=0, window=polyphase_fir(up, down))
+                fs = fs * up / down
+            if(verbose):
+                print("   {0}: now {1} Hz, {2} samples".format(stage, fs, np.shape(data)[0]))
+        return np.ascontiguousarray(data, dtype='float64')
+
+
+def plan_resample(fs_in, fs_out, max_factor=MAX_FACTOR):
+    """ The (cached) ResamplePlan from fs_in to fs_out """
+    key = (float(fs_in), float(fs_out), int(max_factor))
+    if(key not in _PLAN_CACHE):
+        _PLAN_CACHE[key] = ResamplePlan(fs_in, fs_out, max_factor=max_factor)
+    return _PLAN_CACHE[key]
+
+
+def block_resample(data, fs_in, fs_out, zerophase=False, verbose=False, workers=None):
+    """
+    data2 = block_resample(data, fs_in, fs_out)
+
+    Anti-aliased resampling from fs_in to fs_out (any rational ratio), planned as a
+    cascade of decimation and polyphase stages (see the top of this file).
+    The first output sample is at the time of the first input sample.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param fs_in: sampling rate of data in Hz
+    :param fs_out: wanted sampling rate in Hz
+    :param zerophase: see ResamplePlan.__call__
+    :param workers: filter chunks of channels in parallel on this many threads
+                  (-1: all cores, default: one), see parallel.run_channels()
+    """
+    plan = plan_resample(fs_in, fs_out)
+    if(verbose):
+        print("Resampling {0}Hz to {1}Hz: {2}".format(fs_in, fs_out, plan.stages))
+    return plan(data, zerophase=zerophase, verbose=verbose, workers=workers)
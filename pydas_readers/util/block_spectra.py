@@ -1,6 +1,17 @@
-from scipy.fftpack import fft, fftfreq, fftshift
 import numpy as np
-import matplotlib.pyplot as plt
+from datetime import timedelta
+
+from pydas_readers.util import block_cleaning
+from pydas_readers.util import fft_backend
+
+#-- Channels per batched FFT in spectrum(); bounds the memory of the complex spectra
+SPECTRUM_BATCH_BYTES = 2**26
+
+#-- Windows per batched FFT in spectrogram(), by the same memory bound
+SPECTROGRAM_BATCH_BYTES = 2**26
+
+#-- Spectrogram windows by (window, nperseg)
+_WINDOWS = dict()
 
 def spectrum(data, headers, ampl1, ampl2, dB=False, log=False, stack=False):
     """
@@ -38,7 +49,7 @@ def spectrum(data, headers, ampl1, ampl2, dB=False, log=False, stack=False):
     npts = headers['npts']
     scaling = 2/npts # to get correct amplitude out of the numpy fft
 
-    freq = np.fft.rfftfreq(npts, 1./headers['fs']) # fft frequencies
+    freq = fft_backend.rfftfreq(npts, 1./headers['fs']) # fft frequencies
     if log:
         freq1 = np.log10(freq[freq>0][0])
         freq2 = np.log10(freq[-1])
@@ -50,38 +61,36 @@ def spectrum(data, headers, ampl1, ampl2, dB=False, log=False, stack=False):
     if np.any(stack) != False:
         st = np.zeros(freq.shape)
 
-    # loop over all channels to calculate spectrum, and store results in averaging grid
-    for i in range(data.shape[1]):
-        tr = data[:,i].copy()
+    #-- Frequency cell of each fft frequency: the first of "frequencies" above it
+    #--  (the same for every channel, so only computed once)
+    ix = np.searchsorted(frequencies, freq, side='right')
 
-        sp = np.abs(np.fft.rfft(tr)) #fft
-        y = np.abs(sp) * scaling # scale amplitude to physical unit
+    #-- Channels are done in batches: one multi-threaded rfft per batch, 
+    #--  then the averaging grid is filled for all channels of the batch at once.
+    nchan = data.shape[1]
+    batch = max(1, int(SPECTRUM_BATCH_BYTES // (16*len(freq))))
+    for c0 in range(0, nchan, batch):
+        tr = data[:, c0:c0+batch]
+
+        sp = np.abs(fft_backend.rfft(tr, n=npts, axis=0)) #fft
+        y = sp * scaling # scale amplitude to physical unit
         if dB:
             y = 10*np.log10(y) # scale amplitude to dB scale
         if stack:
-            st += y
-        
-        # store spectrum in grid
-        pre_density = np.zeros((nf, na))
-        for ii in range(len(sp)):
-            f = np.where(frequencies > freq[ii])[0]
-            if len(f) == 0:
-                break
-            else:
-                ix = f[0]
-                
-            a = np.where(amplitudes > y[ii])[0]
-            if len(a) == 0:
-                break
-            else:
-                iy = a[0]
-                
-            pre_density[ix,iy] += 1
-            
-            #break
-        pre_density[pre_density>1] = 1
-        
-        density += pre_density
+            st += np.sum(y, axis=1)
+
+        # store spectrum in grid:
+        # walking up in frequency, each channel stops at the first sample that falls
+        # outside of the grid (above the highest frequency or amplitude)
+        iy = np.searchsorted(amplitudes, y, side='right')
+        inside = (ix[:,None] < nf) & (iy < na)
+        inside = np.logical_and.accumulate(inside, axis=0)
+
+        # each channel counts at most once per grid cell
+        ich, cell = np.nonzero(inside.T)
+        cell = ix[cell] * na + iy[cell, ich]
+        hits = np.unique(ich.astype(np.int64) * (nf*na) + cell) % (nf*na)
+        density += np.bincount(hits, minlength=nf*na).reshape(nf, na)
         
     if np.any(stack) != False:
         st /= data.shape[1]
@@ -97,6 +106,114 @@ def spectrum(data, headers, ampl1, ampl2, dB=False, log=False, stack=False):
 
 
 
+def _window(window, nperseg):
+    key = (window if isinstance(window, str) else tuple(window), nperseg)
+    if(key not in _WINDOWS):
+        from scipy.signal import get_window
+        _WINDOWS[key] = get_window(window, nperseg)
+    return _WINDOWS[key]
+
+
+def spectrogram(data, headers, nperseg=256, noverlap=None, window="hann", detrend=True, scaling="density",
+                channel_group=None, bands=None, workers=None):
+    """
+    spec, axis = block_spectra.spectrogram(data, headers, nperseg=1024)
+
+    Spectrogram (short-time power spectra) of all channels of a block at once: the windows are
+    a strided view of data (no copy), and each batch of windows is one multi-threaded rfft
+    over all channels. Scaled as scipy.signal.spectrogram (one-sided).
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param headers: dict with 'fs' (and 't0', for axis['date_times'])
+    :param nperseg: samples per window
+    :param noverlap: samples shared by consecutive windows (default: nperseg//2)
+    :param window: window name or tuple, as scipy.signal.get_window
+    :param detrend: remove the mean of each window first
+    :param scaling: "density" (power spectral density, units**2/Hz) or "spectrum" (power, units**2)
+    :param channel_group: (optional) average the power over groups of this many neighbouring channels
+    :param bands: (optional) list of (fmin, fmax): return the power in each band instead of every
+                  frequency (the density integrated over the band; with scaling="spectrum",
+                  the sum of the power of the frequencies in the band)
+    :param workers: threads for the FFTs (default: fft_backend.WORKERS)
+    :return: spec -- float32 [ nwin, nfreq (or nband), nchan (or ngroup) ]
+             axis -- dict with 'tt' (seconds from t0 to the centre of each window), 'date_times'
+                     (if headers has 't0'), 'ff' (frequencies) or 'bands', and 'channels'
+                     (first channel of each group, if channel_group is given)
+    """
+    fs = headers['fs']
+    noverlap = nperseg//2 if noverlap is None else noverlap
+    step = nperseg - noverlap
+    npts, nchan = np.shape(data)
+    if(npts < nperseg):
+        raise ValueError("Block of {0} samples is shorter than one window ({1})".format(npts, nperseg))
+
+    #-- Windows as a view [ nwin, nperseg, nchan ], computed in float32 unless data is float64
+    wins = block_cleaning.sliding_windows(data, nperseg, step)
+    nwin = np.shape(wins)[0]
+    ctype = 'float64' if data.dtype == np.float64 else 'float32'
+    win = _window(window, nperseg).astype(ctype)
+    ff = fft_backend.rfftfreq(nperseg, 1./fs)
+
+    if(scaling == "density"):
+        scale = 1. / (fs * np.sum(win.astype('float64')**2))
+    elif(scaling == "spectrum"):
+        scale = 1. / np.sum(win.astype('float64'))**2
+    else:
+        raise ValueError("Unknown scaling: {0}".format(scaling))
+    #-- One-sided: all but DC (and Nyquist for even nperseg) count twice
+    weight = np.full(len(ff), 2. * scale)
+    weight[0] = scale
+    if(nperseg % 2 == 0):
+        weight[-1] = scale
+    weight = weight.astype(ctype)[None, :, None]
+
+    #-- Channel groups and frequency bands, applied batch by batch
+    if(channel_group is not None and channel_group > 1):
+        gstarts = np.arange(0, nchan, channel_group)
+        gsize = np.diff(np.append(gstarts, nchan)).astype(ctype)
+    else:
+        gstarts = None
+    if(bands is not None):
+        #-- A density is integrated over the band, a power spectrum is just summed
+        df = fs / nperseg if scaling == "density" else 1.
+        bsel = []
+        for fmin, fmax in bands:
+            sel = np.flatnonzero((ff >= fmin) & (ff < fmax))
+            if(len(sel) == 0):
+                raise ValueError("No frequencies between {0} and {1} Hz with nperseg={2}".format(fmin, fmax, nperseg))
+            bsel.append(sel)
+    ncol = nchan if gstarts is None else len(gstarts)
+    spec = np.empty((nwin, len(ff) if bands is None else len(bands), ncol), dtype='float32')
+
+    batch = max(1, int(SPECTROGRAM_BATCH_BYTES // (8 * len(ff) * nchan)))
+    for w0 in range(0, nwin, batch):
+        w1 = min(w0 + batch, nwin)
+        x = wins[w0:w1].astype(ctype)
+        if(detrend):
+            x -= np.mean(x, axis=1, keepdims=True)
+        x *= win[None, :, None]
+        sp = fft_backend.rfft(x, axis=1, workers=workers)
+        power = sp.real**2 + sp.imag**2
+        power *= weight
+        if(gstarts is not None):
+            power = np.add.reduceat(power, gstarts, axis=2) / gsize
+        if(bands is not None):
+            power = np.stack([np.sum(power[:, sel], axis=1) * df for sel in bsel], axis=1)
+        spec[w0:w1] = power
+
+    axis = dict()
+    axis['tt'] = (np.arange(nwin) * step + nperseg / 2.) / fs
+    if('t0' in headers):
+        axis['date_times'] = [headers['t0'] + timedelta(seconds=t) for t in axis['tt']]
+    if(bands is None):
+        axis['ff'] = ff
+    else:
+        axis['bands'] = list(bands)
+    if(gstarts is not None):
+        axis['channels'] = gstarts
+    return spec, axis
+
+
 def plot_spectrum(density, frequencies, amplitudes, headers, dB=False, log=False, stack=False, freq=False, fname=False):
     """
     plotting function to plot frequency spectrum of DAS data.
@@ -114,6 +231,7 @@ def plot_spectrum(density, frequencies, amplitudes, headers, dB=False, log=False
     fname: path to store image
 
     """
+    import matplotlib.pyplot as plt
 
     plt.figure(1, figsize=(12,8), dpi=300)
     
@@ -0,0 +1,173 @@
+"""
+Processing steps that keep their state from one block to the next, so a
+stream of consecutive files (load_das_h5.stream_das, live_ingest.follow)
+gives the same result as processing one long block: no filter transients
+or lost samples at every file boundary.
+
+Each step is called as
+    data, headers, axis = step(data, headers, axis)
+and has reset() to forget its state (e.g. after a gap in the data).
+Any function with that signature can be part of a chain as well.
+
+Example:
+    chain = [block_stream.StreamBandpass(1., 20.),
+             block_stream.StreamDecimate(4),
+             block_stream.StreamDetect(block_detect.Detector(fs=250., sta=0.5, lta=10.))]
+    for data, headers, axis in load_das_h5.stream_das(t_start, t_end, input_dir=input_dir):
+        out = block_stream.run_chain(chain, data, headers, axis)
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from pydas_readers.util import block_cleaning
+from pydas_readers.util import block_filters
+
+
+def run_chain(chain, data, headers, axis):
+    """
+    data, headers, axis = block_stream.run_chain(chain, data, headers, axis)
+    :Pass a block through each step in turn. A step returning None stops the chain (returns None).
+    """
+    for step in chain:
+        result = step(data, headers, axis)
+        if(result is None):
+            return None
+        data, headers, axis = result
+    return data, headers, axis
+
+
+def reset_chain(chain):
+    """ Call reset() on every step that has one """
+    for step in chain:
+        if(hasattr(step, "reset")):
+            step.reset()
+
+
+class StreamBandpass(object):
+    """
+    step = block_stream.StreamBandpass(freqmin, freqmax, corners=4)
+
+    Causal Butterworth bandpass (as block_bandpass, zerophase=False), with the filter
+    memory carried over between blocks. Designed for headers['fs'] of the first block.
+    """
+
+    def __init__(self, freqmin, freqmax, corners=4):
+        self.freqmin = freqmin
+        self.freqmax = freqmax
+        self.corners = corners
+        self.reset()
+
+    def reset(self):
+        self._zi = None
+
+    def __call__(self, data, headers, axis):
+        from scipy.signal import sosfilt
+        sos = block_filters.bandpass_sos(self.freqmin, self.freqmax, headers['fs'], corners=self.corners)
+        data = np.asarray(data, dtype='float64')
+        if(self._zi is None):
+            self._zi = np.zeros((sos.shape[0], 2) + np.shape(data)[1:])
+        data, self._zi = sosfilt(sos, data, axis=0, zi=self._zi)
+        return data, headers, axis
+
+
+class StreamDecimate(object):
+    """
+    step = block_stream.StreamDecimate(factor)
+
+    Chebychev lowpass and decimation (as chebychev_lowpass_downsamp, zerophase=False),
+    carrying the filter memory and which sample is next to keep, so blocks whose length
+    is not a multiple of factor are decimated seamlessly. headers 'fs', 't0', 't1', 'npts'
+    and axis['tt'] are updated.
+    """
+
+    def __init__(self, factor):
+        self.factor = int(factor)
+        self.reset()
+
+    def reset(self):
+        self._zi = None
+        self._skip = 0
+
+    def __call__(self, data, headers, axis):
+        from scipy.signal import sosfilt
+        fs = headers['fs']
+        sos = block_filters.decimation_sos(fs, self.factor)
+        data = np.asarray(data, dtype='float64')
+        if(self._zi is None):
+            self._zi = np.zeros((sos.shape[0], 2) + np.shape(data)[1:])
+        filtered, self._zi = sosfilt(sos, data, axis=0, zi=self._zi)
+
+        #-- First sample to keep in this block, then every factor-th
+        first = self._skip
+        npts = np.shape(data)[0]
+        self._skip = (first - npts) % self.factor
+        data = np.ascontiguousarray(filtered[first::self.factor])
+
+        headers = dict(headers)
+        headers['t0'] = headers['t0'] + timedelta(seconds=first/fs)
+        headers['fs'] = fs / self.factor
+        headers['npts'] = np.shape(data)[0]
+        headers['t1'] = headers['t0'] + timedelta(seconds=(headers['npts']-1)/headers['fs'])
+        axis = dict(axis)
+        axis['tt'] = np.arange(headers['npts']) / headers['fs']
+        if('date_times' in axis):
+            del axis['date_times']
+        if(headers['npts'] == 0):
+            return None
+        return data, headers, axis
+
+
+class StreamCommonMode(object):
+    """
+    step = block_stream.StreamCommonMode(method="median", window=None)
+
+    block_cleaning.remove_common_mode on each block (it needs no state between blocks).
+    Float blocks are cleaned in place unless inplace=False; other keyword arguments are
+    passed on, e.g. window, step, trim, workers.
+    """
+
+    def __init__(self, method="median", inplace=True, **kwargs):
+        self.method = method
+        self.inplace = inplace
+        self.kwargs = kwargs
+
+    def __call__(self, data, headers, axis):
+        inplace = self.inplace and np.issubdtype(data.dtype, np.floating) and data.flags['WRITEABLE']
+        data = block_cleaning.remove_common_mode(data, method=self.method, inplace=inplace, **self.kwargs)
+        return data, headers, axis
+
+
+class StreamDetect(object):
+    """
+    step = block_stream.StreamDetect(detector, callback=None)
+
+    Run a block_detect.Detector on each block. Finished triggers are appended to
+    step.triggers and passed to callback(trigger), if given. Data pass through unchanged.
+    """
+
+    def __init__(self, detector, callback=None):
+        self.detector = detector
+        self.callback = callback
+        self.triggers = []
+        self._dd = None
+
+    def reset(self):
+        #-- Triggers still open before a gap are finished, not lost
+        self._emit(self.detector.flush(self._dd))
+        self.detector.reset()
+
+    def _emit(self, triggers):
+        for trig in triggers:
+            self.triggers.append(trig)
+            if(self.callback is not None):
+                self.callback(trig)
+
+    def __call__(self, data, headers, axis):
+        self._dd = axis.get('dd')
+        self._emit(self.detector.process(data, headers, dd=self._dd))
+        return data, headers, axis
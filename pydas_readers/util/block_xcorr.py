@@ -0,0 +1,327 @@
+"""
+Ambient-noise cross-correlation of DAS channels.
+
+A block [ npts, nchan ] is cut into time windows, which are all
+preprocessed at once (demean, taper, one-bit or running-absolute-mean
+normalisation, spectral whitening) and then correlated in the frequency
+domain, either:
+ - a virtual source channel against all channels, or
+ - all pairs of channels up to a maximum channel offset.
+
+Windows are summed in the frequency domain before the single inverse FFT,
+so the cost of the correlation itself does not grow with the number of windows.
+
+For long archives, run_noise_correlation() splits the time range into chunks
+(e.g. 1 hour), correlates them on a pool of processes, and adds each result
+to a CorrelationStack on disk (HDF5). Chunks already in the stack are skipped,
+so an interrupted run can simply be started again.
+
+Example:
+    stack = block_xcorr.run_noise_correlation(t_start, t_end, "stack_src100.h5", input_dir=input_dir,
+                                              source=100, max_lag=10., window=60., nproc=8,
+                                              mapchan=mapping['i0'])
+    cc, lags = stack.mean(), stack.lags
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import multiprocessing
+from datetime import timedelta
+
+import h5py
+import numpy as np
+
+from pydas_readers.readers import load_das_h5
+from pydas_readers.util import fft_backend
+from pydas_readers.util import block_filters
+
+#-- Working memory per batch of windows
+WINDOW_BATCH_BYTES = 2**27
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#-- PREPROCESSING
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def cut_windows(data, nwin_pts, step):
+    """
+    windows = block_xcorr.cut_windows(data, nwin_pts, step)
+    :Strided view (no copy) of the block as windows [ nwin, nwin_pts, nchan ]
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(data, nwin_pts, axis=0)[::step]
+    return np.moveaxis(windows, -1, 1)
+
+
+def running_abs_mean(windows, nsmooth):
+    """
+    Running-absolute-mean normalisation, along axis 1 of [ nwin, npts, nchan ].
+    Each sample is divided by the mean |amplitude| over nsmooth samples around it.
+    """
+    a = np.abs(windows)
+    csum = np.cumsum(a, axis=1)
+    csum = np.concatenate((np.zeros_like(csum[:, :1]), csum), axis=1)
+    npts = np.shape(windows)[1]
+    half = nsmooth // 2
+    i1 = np.clip(np.arange(npts) + half + 1, 0, npts)
+    i0 = np.clip(np.arange(npts) - half, 0, npts)
+    weight = (csum[:, i1] - csum[:, i0]) / (i1 - i0)[None, :, None]
+    weight[weight == 0] = 1.
+    return windows / weight
+
+
+def whiten(spec, freq, freqmin, freqmax, smooth=0, taper=0.1):
+    """
+    Spectral whitening of spectra [ ..., nfreq, nchan ] along the frequency axis (-2).
+    The amplitude spectrum is set to 1 (or divided by its running mean over 'smooth' bins)
+    between freqmin and freqmax, with cosine roll-offs of fractional width taper, zero outside.
+    """
+    amp = np.abs(spec)
+    if(smooth > 1):
+        kernel = np.ones(smooth) / smooth
+        amp = np.apply_along_axis(np.convolve, -2, amp, kernel, mode='same')
+    amp[amp == 0] = 1.
+
+    band = np.zeros(len(freq))
+    f0, f1 = freqmin*(1-taper), freqmax*(1+taper)
+    band[(freq >= freqmin) & (freq <= freqmax)] = 1.
+    lo = (freq > f0) & (freq < freqmin)
+    band[lo] = 0.5 - 0.5*np.cos(np.pi*(freq[lo]-f0)/(freqmin-f0))
+    hi = (freq > freqmax) & (freq < f1)
+    band[hi] = 0.5 + 0.5*np.cos(np.pi*(freq[hi]-freqmax)/(f1-freqmax))
+
+    return spec / amp * band[:, None]
+
+
+def preprocess_spectra(windows, fs, nfft, normalize="onebit", ram_window=0, freqmin=None, freqmax=None,
+                       whiten_smooth=0, taper=0.05):
+    """
+    spec = block_xcorr.preprocess_spectra(windows, fs, nfft)
+
+    :param windows: [ nwin, npts, nchan ] windows, e.g. from cut_windows()
+    :param fs: sample rate in Hz
+    :param nfft: FFT length (>= npts + max lag)
+    :param normalize: None, "onebit" or "ram" (running absolute mean)
+    :param ram_window: window length in seconds for "ram"
+    :param freqmin, freqmax: band for spectral whitening. No whitening if None.
+    :param whiten_smooth: number of frequency bins to smooth the amplitude spectrum before whitening
+    :param taper: Value between 0 and 0.5 (i.e., 0.01 means 1%), linear taper of each window
+    :return: spectra [ nwin, nfft//2+1, nchan ] (complex)
+    """
+    w = np.array(windows, dtype='float64')
+    w -= np.mean(w, axis=1, keepdims=True)
+
+    if(normalize == "onebit"):
+        w = np.sign(w)
+    elif(normalize == "ram"):
+        w = running_abs_mean(w, max(1, int(ram_window*fs)))
+    elif(normalize is not None):
+        raise ValueError("Unknown normalize: {0}".format(normalize))
+
+    #-- Taper after the normalisation (which would otherwise undo it)
+    npts = np.shape(w)[1]
+    lwind = int(npts*taper)
+    if(lwind > 0):
+        ramp = np.linspace(0, 1, lwind)
+        w[:, :lwind] *= ramp[None, :, None]
+        w[:, -lwind:] *= ramp[::-1][None, :, None]
+
+    spec = fft_backend.rfft(w, n=nfft, axis=1)
+    if(freqmin is not None and freqmax is not None):
+        freq = fft_backend.rfftfreq(nfft, 1.0/fs)
+        spec = whiten(spec, freq, freqmin, freqmax, smooth=whiten_smooth)
+    return spec
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#-- CORRELATION
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def _lags_from_cross_spectrum(cross, nfft, max_lag_pts):
+    """ irfft of summed cross-spectra [ nfreq, ... ] -> correlation at lags -max_lag..+max_lag """
+    cc = fft_backend.irfft(cross, n=nfft, axis=0)
+    return np.concatenate((cc[nfft-max_lag_pts:], cc[:max_lag_pts+1]), axis=0)
+
+
+def correlate_block(data, fs, window=60., overlap=0., max_lag=10., source=None, max_offset=None, **kwargs):
+    """
+    cc, lags, nwin = block_xcorr.correlate_block(data, headers['fs'], source=100)
+
+    Sum of the cross-correlations of all time windows in a block.
+
+    :param data: 2D numpy array [ npts, nchan ]
+    :param fs: sample rate in Hz
+    :param window: window length in seconds
+    :param overlap: fraction of overlap between windows
+    :param max_lag: maximum lag in seconds
+    :param source: index (column of data) of a virtual source, correlated against all channels
+    :param max_offset: instead of a source, all pairs (i, i+o) for o = 0..max_offset channels
+    :param kwargs: preprocessing, see preprocess_spectra()
+    :return: cc   -- [ nlag, nchan ] for a source, or [ nlag, nchan, max_offset+1 ] for pairs
+                     (pair (i, i+o) at [:, i, o]; zero where i+o is beyond the last channel)
+             lags -- lag times in seconds
+             nwin -- number of windows summed
+    """
+    if((source is None) == (max_offset is None)):
+        raise ValueError("Give either a virtual source or a max_offset")
+
+    npts, nchan = np.shape(data)
+    nwin_pts = int(round(window*fs))
+    step = max(1, int(round(nwin_pts*(1-overlap))))
+    max_lag_pts = int(round(max_lag*fs))
+    nfft = fft_backend.next_fast_len(nwin_pts + max_lag_pts, real=True)
+    nfreq = nfft//2 + 1
+    lags = np.arange(-max_lag_pts, max_lag_pts+1) / fs
+
+    if(npts < nwin_pts):
+        nwin = 0
+        windows = np.zeros((0, nwin_pts, nchan))
+    else:
+        windows = cut_windows(data, nwin_pts, step)
+        nwin = np.shape(windows)[0]
+
+    if(source is not None):
+        cross = np.zeros((nfreq, nchan), dtype=complex)
+    else:
+        cross = np.zeros((nfreq, nchan, max_offset+1), dtype=complex)
+
+    #-- All windows of a batch are preprocessed and correlated together
+    batch = max(1, int(WINDOW_BATCH_BYTES // (16*nfreq*nchan)))
+    for w0 in range(0, nwin, batch):
+        spec = preprocess_spectra(windows[w0:w0+batch], fs, nfft, **kwargs)
+        if(source is not None):
+            cross += np.sum(np.conj(spec[:, :, source:source+1]) * spec, axis=0)
+        else:
+            for o in range(min(max_offset+1, nchan)):
+                cross[:, :nchan-o, o] += np.sum(np.conj(spec[:, :, :nchan-o]) * spec[:, :, o:], axis=0)
+
+    cc = _lags_from_cross_spectrum(cross, nfft, max_lag_pts)
+    return cc, lags, nwin
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#-- STACK ON DISK
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class CorrelationStack(object):
+    """
+    stack = CorrelationStack(filename)
+    :
+    :Running sum of correlations in an HDF5 file:
+    :  /stack_sum -- sum of all correlations added
+    :  /lags      -- lag times in seconds
+    :  /done      -- keys (e.g. chunk start times) already added
+    :  attrs "count" -- number of windows in the sum, plus any settings given to add()
+    :
+    :Every add() is written to disk immediately, so the file is always a valid stack.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def done_keys(self):
+        try:
+            with h5py.File(self.filename, "r") as f:
+                return set(k.decode('utf-8') if isinstance(k, bytes) else k for k in f["done"][:])
+        except (OSError, KeyError):
+            return set()
+
+    def add(self, cc, lags, nwin, key=None, attrs=None):
+        sdt = h5py.string_dtype('utf-8')
+        with h5py.File(self.filename, "a") as f:
+            if("stack_sum" not in f):
+                f.create_dataset("stack_sum", data=np.zeros(np.shape(cc)))
+                f.create_dataset("lags", data=lags)
+                f.create_dataset("done", shape=(0,), maxshape=(None,), dtype=sdt)
+                f.attrs["count"] = 0
+                if(attrs is not None):
+                    for k, v in attrs.items():
+                        f.attrs[k] = v
+            elif(f["stack_sum"].shape != np.shape(cc)):
+                raise ValueError("Correlations of shape {0} don't match the stack {1}".format(np.shape(cc), f["stack_sum"].shape))
+
+            f["stack_sum"][...] += cc
+            f.attrs["count"] = f.attrs["count"] + nwin
+            if(key is not None):
+                done = f["done"]
+                done.resize((done.shape[0]+1,))
+                done[-1] = key
+
+    @property
+    def lags(self):
+        with h5py.File(self.filename, "r") as f:
+            return f["lags"][:]
+
+    @property
+    def count(self):
+        with h5py.File(self.filename, "r") as f:
+            return int(f.attrs["count"])
+
+    def mean(self):
+        """ Stacked (averaged over windows) correlations """
+        with h5py.File(self.filename, "r") as f:
+            return f["stack_sum"][:] / max(1, f.attrs["count"])
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#-- ARCHIVE DRIVER
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def _correlate_chunk(args):
+    """ Pool worker: load one chunk of time and correlate it """
+    t0, t1, load_kwargs, bandpass, corr_kwargs = args
+    try:
+        data, headers = load_das_h5.load_das_custom(t0, t1, return_axis=False, **load_kwargs)
+    except Exception:
+        print("ERROR loading {0} -- {1}".format(t0, t1))
+        return None
+    if(bandpass is not None):
+        data = block_filters.block_bandpass(data, bandpass[0], bandpass[1], headers['fs'], zerophase=True, taper=0.01)
+    cc, lags, nwin = correlate_block(data, headers['fs'], **corr_kwargs)
+    return t0.strftime('%Y-%m-%dT%H:%M:%S'), cc, lags, nwin, headers['fs']
+
+
+def run_noise_correlation(t_start, t_end, stack_file, input_dir='./', chunk=timedelta(hours=1), nproc=1,
+                          mapchan=[], ichan=[], mapchan_dx=None, bandpass=None, verbose=False, **corr_kwargs):
+    """
+    stack = block_xcorr.run_noise_correlation(t_start, t_end, "stack.h5", input_dir=input_dir, source=100)
+
+    Correlate an archive time range chunk by chunk, accumulating into a CorrelationStack.
+
+    :param t_start, t_end: datetime objects of the full range
+    :param stack_file: HDF5 file of the stack (created, or continued if it exists)
+    :param input_dir: directory of the archive, as for load_das_h5.load_das_custom
+    :param chunk: timedelta of data loaded and correlated per task
+    :param nproc: number of processes; chunks are correlated in parallel
+    :param mapchan, ichan, mapchan_dx: channel selection, as for load_das_custom
+    :param bandpass: (optional) (freqmin, freqmax) zero-phase Butterworth applied to each chunk first
+    :param corr_kwargs: passed to correlate_block() (source / max_offset, window, max_lag, normalize, ...)
+    :return: the CorrelationStack
+    """
+    stack = CorrelationStack(stack_file)
+    done = stack.done_keys()
+
+    load_kwargs = dict(input_dir=input_dir, mapchan=mapchan, ichan=ichan, mapchan_dx=mapchan_dx)
+    tasks = []
+    t = t_start
+    while(t < t_end):
+        t1 = min(t + chunk, t_end)
+        if(t.strftime('%Y-%m-%dT%H:%M:%S') not in done):
+            tasks.append((t, t1, load_kwargs, bandpass, corr_kwargs))
+        t = t1
+    if(verbose):
+        print("{0} chunks to correlate ({1} already in the stack)".format(len(tasks), len(done)))
+
+    attrs = {k: v for k, v in corr_kwargs.items() if v is not None and np.isscalar(v)}
+    def add(result):
+        if(result is None):
+            return
+        key, cc, lags, nwin, fs = result
+        stack.add(cc, lags, nwin, key=key, attrs=dict(attrs, fs=fs))
+        if(verbose):
+            print("   added {0}: {1} windows".format(key, nwin))
+
+    if(nproc > 1):
+        with multiprocessing.Pool(processes=nproc) as pool:
+            for result in pool.imap_unordered(_correlate_chunk, tasks):
+                add(result)
+    else:
+        for task in tasks:
+            add(_correlate_chunk(task))
+    return stack
@@ -0,0 +1,95 @@
+"""
+One place for all FFTs of the util functions (block_spectra, block_fk,
+the frequency-domain engine of block_filters), so they share:
+ - scipy.fft (pocketfft) with several threads, set once with set_workers()
+ - cached "next fast length" FFT sizes
+ - batched real-to-complex transforms along the time axis (axis 0) of
+   C-contiguous [ npts, nchan ] blocks
+
+Example, use 16 threads for every spectral function:
+    from pydas_readers.util import fft_backend
+    fft_backend.set_workers(16)
+
+Inside the chunk jobs of parallel.run_channels / shared_blocks.map_channels the
+FFTs run on one thread (single_threaded()), so parallel chunks don't each start
+WORKERS threads of their own.
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+#-- Threads used by scipy.fft; -1 means all cores
+WORKERS = -1
+
+#-- Per-thread override of WORKERS (set by single_threaded())
+_LOCAL = threading.local()
+
+
+def set_workers(workers):
+    """ Number of threads for all FFTs in pydas_readers (-1: all cores) """
+    global WORKERS
+    WORKERS = int(workers)
+
+def _sfft():
+    #-- scipy.fft is imported on first use rather than with the package
+    import scipy.fft
+    return scipy.fft
+
+
+def get_workers(workers=None):
+    if(workers is None):
+        return getattr(_LOCAL, 'workers', WORKERS)
+    return workers
+
+
+@contextmanager
+def single_threaded():
+    """ FFTs called from this thread use one thread, e.g. inside a job that already runs in parallel """
+    previous = getattr(_LOCAL, 'workers', None)
+    _LOCAL.workers = 1
+    try:
+        yield
+    finally:
+        if(previous is None):
+            del _LOCAL.workers
+        else:
+            _LOCAL.workers = previous
+
+
+@lru_cache(maxsize=1024)
+def next_fast_len(n, real=True):
+    """ Smallest length >= n that is fast for pocketfft (cached, used for every block of the same size) """
+    return _sfft().next_fast_len(int(n), real=real)
+
+
+def _time_major(data):
+    #-- FFT along axis 0 is batched over the contiguous channel axis; make sure we have that layout
+    if(not data.flags['C_CONTIGUOUS']):
+        data = np.ascontiguousarray(data)
+    return data
+
+
+def rfft(data, n=None, axis=0, workers=None):
+    """ Real-to-complex FFT along axis (default: time axis 0), batched over all other axes """
+    return _sfft().rfft(_time_major(data), n=n, axis=axis, workers=get_workers(workers))
+
+def irfft(spec, n=None, axis=0, workers=None):
+    return _sfft().irfft(spec, n=n, axis=axis, workers=get_workers(workers))
+
+def rfftn(data, s=None, axes=None, workers=None):
+    return _sfft().rfftn(_time_major(data), s=s, axes=axes, workers=get_workers(workers))
+
+def irfftn(spec, s=None, axes=None, workers=None):
+    return _sfft().irfftn(spec, s=s, axes=axes, workers=get_workers(workers))
+
+def rfftfreq(n, d=1.0):
+    return _sfft().rfftfreq(n, d)
+
+def fftfreq(n, d=1.0):
+    return _sfft().fftfreq(n, d)
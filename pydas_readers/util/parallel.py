@@ -0,0 +1,147 @@
+"""
+Run a block function over chunks of channels in parallel.
+
+Filtering, detrending etc. treat every channel on its own, so a block
+[ npts, nchan ] can be split along the channel axis into chunks that fit in
+cache, processed on several cores, and written into one preallocated output.
+
+Two backends:
+    "thread"  -- a thread pool on the same memory. SciPy releases the GIL in
+                 sosfilt / lfilter / FFTs / BLAS, so this scales with cores
+                 for the filters and costs no copies. (default)
+    "process" -- a process pool with input and output in shared memory
+                 (see shared_blocks), for functions that hold the GIL.
+
+Every public function of block_filters and block_cleaning has a workers=
+argument that ends up here, e.g.:
+    data2 = block_filters.block_bandpass(data, 0.1, 10, headers['fs'], workers=16)
+
+or use it directly on any function f(data, *args, **kwargs):
+    data2 = parallel.run_channels(my_function, data, arg1, workers=16, backend="process")
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pydas_readers.util import fft_backend
+from pydas_readers.util import shared_blocks
+
+#-- Default backend for workers= of the block functions, "thread" or "process"
+BACKEND = "thread"
+
+#-- Target size of one channel chunk (input samples), about the size of a core's L2/L3 share
+CHUNK_BYTES = 2**22
+
+
+def set_backend(backend):
+    """ Backend used by the workers= argument of all block functions: "thread" or "process" """
+    global BACKEND
+    if(backend not in ("thread", "process")):
+        raise ValueError("Unknown backend: {0}".format(backend))
+    BACKEND = backend
+
+
+def get_workers(workers=None):
+    """ Number of workers: None -> 1 (serial), -1 -> all cores """
+    if(workers is None):
+        return 1
+    if(workers < 0):
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def channel_chunks(npts, nchan, workers, itemsize=8, chunk_bytes=None):
+    """
+    [(c0, c1), ...] chunks of channels of about chunk_bytes each,
+    and at least one per worker so none of them sits idle.
+    """
+    if(chunk_bytes is None):
+        chunk_bytes = CHUNK_BYTES
+    per_chunk = max(1, int(chunk_bytes // max(1, npts*itemsize)))
+    nchunk = max(int(np.ceil(nchan / per_chunk)), workers)
+    return shared_blocks.channel_chunks(nchan, nchunk)
+
+
+def run_chunks(job, chunks, workers=None):
+    """
+    Call job(c0, c1) for every chunk on a thread pool (in order if workers is 1).
+    Jobs write their own output; return values are collected in chunk order.
+    FFTs inside parallel jobs run on one thread each (fft_backend.single_threaded).
+    """
+    workers = get_workers(workers)
+    if(workers == 1 or len(chunks) == 1):
+        return [job(c0, c1) for c0, c1 in chunks]
+
+    def pinned(c0, c1):
+        with fft_backend.single_threaded():
+            return job(c0, c1)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        futures = [pool.submit(pinned, c0, c1) for c0, c1 in chunks]
+        return [f.result() for f in futures]
+
+
+def run_channels(func, data, *args, workers=None, backend=None, chunk_bytes=None, halo=0, out=None, **kwargs):
+    """
+    data_out = parallel.run_channels(func, data, *args, workers=8, **kwargs)
+
+    Same result as func(data, *args, **kwargs), computed over chunks of channels.
+
+    :param func: function(data [ npts, n ], *args, **kwargs) returning [ npts_out, n ]
+                 (for backend="process" it must be picklable, i.e. module-level)
+    :param data: 2D numpy array [ npts, nchan ] (1D input just calls func)
+    :param workers: number of threads / processes (None: 1, -1: all cores)
+    :param backend: "thread" or "process" (default: parallel.BACKEND)
+    :param chunk_bytes: target input size of one chunk (default: CHUNK_BYTES)
+    :param halo: (thread backend) extra neighbouring channels given to func on each side of
+                 a chunk and cut off its output, for functions that use nearby channels
+    :param out: (optional) preallocated array [ npts_out, nchan ] to write into
+    :return: data_out [ npts_out, nchan ]
+    """
+    workers = get_workers(workers)
+    if(backend is None):
+        backend = BACKEND
+    if(np.ndim(data) != 2 or (workers == 1 and out is None)):
+        return func(data, *args, **kwargs)
+
+    npts, nchan = np.shape(data)
+    chunks = channel_chunks(npts, nchan, workers, itemsize=data.dtype.itemsize, chunk_bytes=chunk_bytes)
+
+    if(backend == "process"):
+        if(halo > 0):
+            raise ValueError("halo is only supported by the thread backend")
+        if(out is not None):
+            with shared_blocks.SharedBlock.create(np.shape(out), out.dtype) as block_out:
+                shared_blocks.map_channels(func, data, *args, nproc=workers, nchunk=len(chunks), out=block_out, **kwargs)
+                out[...] = block_out.array
+            return out
+        return shared_blocks.map_channels(func, data, *args, nproc=workers, nchunk=len(chunks), **kwargs)
+    elif(backend != "thread"):
+        raise ValueError("Unknown backend: {0}".format(backend))
+
+    def job(c0, c1):
+        h0 = max(0, c0-halo)
+        h1 = min(nchan, c1+halo)
+        result = np.asarray(func(data[:, h0:h1], *args, **kwargs))
+        if(result.ndim == 1):
+            result = result[:, None]
+        return result[:, c0-h0:c0-h0+(c1-c0)]
+
+    #-- The first chunk gives the output length and dtype (e.g. after decimation)
+    first = job(*chunks[0])
+    if(out is None):
+        out = np.empty((np.shape(first)[0], nchan), dtype=first.dtype)
+    c0, c1 = chunks[0]
+    out[:, c0:c1] = first
+    del first
+
+    def write(c0, c1):
+        out[:, c0:c1] = job(c0, c1)
+
+    run_chunks(write, chunks[1:], workers=workers)
+    return out
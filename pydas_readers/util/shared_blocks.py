@@ -0,0 +1,178 @@
+"""
+Blocks of DAS data [ npts, nchan ] in shared memory, so a process pool
+can work on one big in-memory block without pickling it to every worker.
+
+A SharedBlock owns a multiprocessing.shared_memory segment. What goes to the
+workers is only its descriptor (name, shape, dtype, headers): each worker
+attaches to the same memory, reads its channel chunk and writes its result
+directly into a shared output block.
+
+Example, run a bandpass over channel chunks on 8 cores:
+    from pydas_readers.util import shared_blocks, block_filters
+    data2 = shared_blocks.map_channels(block_filters.block_bandpass, data, 0.1, 10, headers['fs'], nproc=8)
+
+or, to keep a block shared between several calls:
+    with shared_blocks.SharedBlock.from_array(data, headers) as block:
+        data2 = shared_blocks.map_channels(block_filters.block_bandpass, block, 0.1, 10, headers['fs'], nproc=8)
+        data3 = shared_blocks.map_channels(block_cleaning.detrend, block, nproc=8)
+
+Any function f(data, *args, **kwargs) of block_filters / block_cleaning that
+treats channels independently and returns one array [ npts_out, nchan ] can be
+mapped (block_bandpass, chebychev_lowpass_downsamp, detrend, demean, taper, ...).
+Functions that mix channels (pws_rolling_average, f-k filters) can not.
+
+Daniel Bowden, ETH Zürich
+daniel.bowden@erdw.ethz.ch
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pydas_readers.util import fft_backend
+
+
+class SharedBlock(object):
+    """
+    block = shared_blocks.SharedBlock.create(shape, dtype, headers)
+    block = shared_blocks.SharedBlock.from_array(data, headers)
+    block = shared_blocks.SharedBlock.attach(descriptor)   # in a worker
+
+    block.array      -- numpy array [ npts, nchan ] on the shared memory
+    block.headers    -- dict of headers (copied, not shared)
+    block.descriptor -- small picklable dict to pass to other processes
+
+    The process that created the block unlinks the memory on close();
+    attached processes only detach.
+    """
+
+    def __init__(self, shm, shape, dtype, headers=None, owner=False):
+        self.shm = shm
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.headers = dict(headers) if headers is not None else dict()
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype='float64', headers=None):
+        """ New (uninitialised) shared block """
+        nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        return cls(shm, shape, dtype, headers, owner=True)
+
+    @classmethod
+    def from_array(cls, data, headers=None):
+        """ Copy an array (e.g. from load_das_custom) into a new shared block """
+        block = cls.create(np.shape(data), np.asarray(data).dtype, headers)
+        block.array[...] = data
+        return block
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Attach to a block created in another process, from its descriptor """
+        shm = shared_memory.SharedMemory(name=descriptor['name'])
+        return cls(shm, descriptor['shape'], descriptor['dtype'], descriptor.get('headers'))
+
+    @property
+    def descriptor(self):
+        return dict(name=self.shm.name, shape=self.shape, dtype=self.dtype.str, headers=self.headers)
+
+    def close(self):
+        #-- Drop our view first, the memory can't be released while it's exported
+        self.array = None
+        self.shm.close()
+        if(self.owner):
+            self.shm.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "SharedBlock({0}, shape={1}, dtype={2})".format(self.shm.name, self.shape, self.dtype)
+
+
+def channel_chunks(nchan, nchunk):
+    """ [(c0, c1), ...] splitting nchan channels into nchunk contiguous, near-equal chunks """
+    nchunk = max(1, min(int(nchunk), nchan))
+    edges = np.linspace(0, nchan, nchunk+1).astype(int)
+    return [(int(c0), int(c1)) for c0, c1 in zip(edges[:-1], edges[1:])]
+
+
+def _map_chunk(task):
+    """ Pool worker: attach to the input and output blocks, process one channel chunk """
+    func, src, dst, c0, c1, args, kwargs = task
+    block_in = SharedBlock.attach(src)
+    block_out = SharedBlock.attach(dst)
+    try:
+        #-- One FFT thread per process, the pool already uses the cores
+        with fft_backend.single_threaded():
+            block_out.array[:, c0:c1] = func(block_in.array[:, c0:c1], *args, **kwargs)
+    finally:
+        block_in.close()
+        block_out.close()
+    return c0, c1
+
+
+def map_channels(func, data, *args, nproc=None, nchunk=None, out=None, pool=None, **kwargs):
+    """
+    data_out = shared_blocks.map_channels(func, data, *args, nproc=8, **kwargs)
+
+    Run func(data[:, c0:c1], *args, **kwargs) over channel chunks on a process pool.
+    Input and output stay in shared memory; only descriptors go to the workers.
+
+    :param func: module-level function (picklable) returning [ npts_out, c1-c0 ]
+    :param data: 2D numpy array [ npts, nchan ], or a SharedBlock (not copied again)
+    :param nproc: number of processes (default: all cores)
+    :param nchunk: number of channel chunks (default: nproc, i.e. one per process)
+    :param out: (optional) SharedBlock [ npts_out, nchan ] to write the result into;
+                if given, it is also what's returned (keep it open until you're done)
+    :param pool: (optional) existing multiprocessing.Pool to use
+    :return: numpy array [ npts_out, nchan ] (a normal, private array unless out is given)
+    """
+    if(nproc is None):
+        nproc = multiprocessing.cpu_count()
+    if(nchunk is None):
+        nchunk = nproc
+
+    own_input = not isinstance(data, SharedBlock)
+    block_in = SharedBlock.from_array(data) if own_input else data
+    nchan = block_in.shape[1]
+    chunks = channel_chunks(nchan, nchunk)
+
+    block_out = None
+    try:
+        #-- The first chunk is done here, which gives the output length and dtype
+        #--  (e.g. decimation) without the caller having to know them
+        c0, c1 = chunks[0]
+        first = np.asarray(func(block_in.array[:, c0:c1], *args, **kwargs))
+        if(first.ndim == 1):
+            first = first[:, None]
+        if(out is None):
+            block_out = SharedBlock.create((np.shape(first)[0], nchan), first.dtype, block_in.headers)
+        else:
+            block_out = out
+        block_out.array[:, c0:c1] = first
+        del first
+
+        tasks = [(func, block_in.descriptor, block_out.descriptor, c0, c1, args, kwargs) for c0, c1 in chunks[1:]]
+        if(len(tasks) > 0):
+            if(pool is not None):
+                pool.map(_map_chunk, tasks)
+            else:
+                with multiprocessing.Pool(min(nproc, len(tasks))) as p:
+                    p.map(_map_chunk, tasks)
+
+        if(out is not None):
+            return out.array
+        return block_out.array.copy()
+    finally:
+        if(own_input):
+            block_in.close()
+        if(out is None and block_out is not None):
+            block_out.close()